@@ -1,8 +1,13 @@
 import os
 import json
 from datetime import datetime
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, jsonify, make_response, g
 import database
+import admin_session
+import llm_gateway
+import response_cache
+import background
+import password_hasher
 
 # Try importing psutil for system health (optional)
 try:
@@ -21,10 +26,20 @@ except Exception as e:
     print("🔥 Admin Route DB Error:", e)
     db = None
 
+sessions = admin_session.AdminSessions(db)
+
 # --- ADMIN HELPERS ---
 
 def verify_admin_request(req):
-    """Checks Email and Password against Database."""
+    """
+    Checks the session token from /api/admin/verify_access (x-admin-token). Requests without one
+    (scripts, older dashboards) fall back to Email and Password against the Database.
+    """
+    token = req.headers.get("x-admin-token")
+    if token:
+        g.admin_session = sessions.verify(token)
+        return g.admin_session is not None
+
     email = req.args.get("admin_email") or (req.json and req.json.get("admin_email"))
     password = req.headers.get("x-admin-password")
     
@@ -34,17 +49,36 @@ def verify_admin_request(req):
     return database.verify_admin_credentials(db, email, password)
 
 def get_admin_email(req): 
+    session = g.get("admin_session")
+    if session: return session["e"]
     return req.args.get("admin_email") or (req.json and req.json.get("admin_email"))
 
 # --- ADMIN ROUTES ---
 
 @admin_bp.route("/api/admin/verify_access", methods=["POST"])
 def api_admin_verify_access():
-    if verify_admin_request(request):
-        database.log_admin_action(db, get_admin_email(request), "LOGIN", "Admin logged in")
-        return jsonify({"success": True, "message": "Access Granted"})
+    email = request.json and request.json.get("admin_email")
+    password = request.headers.get("x-admin-password")
+    if email and password and database.verify_admin_credentials(db, email, password):
+        database.log_admin_action(db, email, "LOGIN", "Admin logged in")
+        token, expires_at = sessions.issue(email)
+        return jsonify({"success": True, "message": "Access Granted", "token": token, "expires_at": expires_at})
     return jsonify({"success": False, "message": "Invalid Credentials"}), 401
 
+@admin_bp.route("/api/admin/session/refresh", methods=["POST"])
+def api_admin_refresh_session():
+    """Swaps a still-valid token for a fresh one, so an open dashboard never re-enters the password."""
+    if not verify_admin_request(request) or not g.get("admin_session"): return jsonify({"success": False}), 401
+    # Not revoked outright: dashboard polls sent with the old token may still be in flight
+    sessions.revoke(g.admin_session, grace=admin_session.REFRESH_GRACE_SECONDS)
+    token, expires_at = sessions.issue(g.admin_session["e"])
+    return jsonify({"success": True, "token": token, "expires_at": expires_at})
+
+@admin_bp.route("/api/admin/logout", methods=["POST"])
+def api_admin_logout():
+    if verify_admin_request(request) and g.get("admin_session"): sessions.revoke(g.admin_session)
+    return jsonify({"success": True})
+
 @admin_bp.route("/api/admin/dashboard", methods=["GET"])
 def api_admin_dashboard():
     if not verify_admin_request(request): return jsonify({"success": False}), 401
@@ -54,7 +88,7 @@ def api_admin_dashboard():
 @admin_bp.route("/api/admin/analytics/growth", methods=["GET"])
 def api_admin_growth_chart():
     if not verify_admin_request(request): return jsonify({"success": False}), 401
-    data = database.get_daily_signups(db)
+    data = database.get_daily_signups(db, request.args.get("days", 7, type=int))
     return jsonify({"success": True, "chartData": data})
 
 @admin_bp.route("/api/admin/system/health", methods=["GET"])
@@ -70,7 +104,7 @@ def api_admin_health():
         # Mock data if psutil missing
         cpu = 15; ram = 40; disk = 55
         
-    return jsonify({"success": True, "health": {"cpu": cpu, "ram": ram, "disk": disk}})
+    return jsonify({"success": True, "health": {"cpu": cpu, "ram": ram, "disk": disk, "user_cache": database.get_user_cache_stats(), "mongo_pool": database.get_pool_stats(), "password_hasher": password_hasher.stats(), "llm": llm_gateway.stats(), "response_cache": response_cache.stats(), "background": background.stats()}})
 
 @admin_bp.route("/api/admin/users", methods=["GET"])
 def api_admin_users():
@@ -111,6 +145,11 @@ def api_admin_broadcast():
     database.log_admin_action(db, get_admin_email(request), "BROADCAST", f"Sent to {count} users")
     return jsonify({"success": True, "message": f"Sent to {count} users."})
 
+@admin_bp.route("/api/admin/system/maintenance", methods=["POST"])
+def api_admin_maintenance():
+    if not verify_admin_request(request): return jsonify({"success": False}), 401
+    active = bool((request.json or {}).get("active"))
+    database.set_maintenance_mode(db, active)
     database.log_admin_action(db, get_admin_email(request), "MAINTENANCE", f"Set to {active}")
     return jsonify({"success": True, "status": active})
 
@@ -135,9 +174,12 @@ def api_admin_feedback():
 @admin_bp.route("/api/admin/messages/search", methods=["GET"])
 def api_admin_search_messages():
     if not verify_admin_request(request): return jsonify({"success": False}), 401
-    query = request.args.get("query", "")
-    messages = database.search_chat_messages(db, query)
-    return jsonify({"success": True, "messages": messages})
+    query = request.args.get("query", "").strip()
+    if not query: return jsonify({"success": True, "messages": [], "page": 1, "has_more": False})
+    page = request.args.get("page", 1, type=int)
+    limit = request.args.get("limit", database.MESSAGE_SEARCH_PAGE_SIZE, type=int)
+    messages, has_more = database.search_chat_messages(db, query, page=page, limit=limit)
+    return jsonify({"success": True, "messages": messages, "page": page, "has_more": has_more})
 
 @admin_bp.route("/api/admin/users/<user_id>/update", methods=["POST"])
 def api_admin_update_user(user_id):
@@ -199,5 +241,6 @@ def api_admin_delete_helper():
 
     success = database.delete_admin(db, email)
     if success:
+        sessions.revoke_admin(email)
         database.log_admin_action(db, get_admin_email(request), "DELETE_ADMIN", f"Deleted admin {email}")
     return jsonify({"success": success})
\ No newline at end of file
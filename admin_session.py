@@ -0,0 +1,135 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+# Signed admin session tokens: "<payload>.<signature>", both base64url, HMAC-SHA256.
+# Verifying one is a hash and a dict lookup, so admin calls skip the bcrypt check after login.
+#
+# Rotation: signing keys are derived from one master secret per time epoch, so every worker
+# computes the same keys with no coordination, and a key is retired after two epochs.
+# Revocation: by token id (logout) or by admin email (deleted admin), kept in Mongo with a TTL
+# and mirrored in memory; each worker re-syncs at most every REVOCATION_SYNC_SECONDS.
+SESSION_TTL_SECONDS = int(os.getenv("ADMIN_SESSION_TTL_SECONDS", 30 * 60))
+ROTATION_SECONDS = max(int(os.getenv("ADMIN_SESSION_ROTATION_SECONDS", SESSION_TTL_SECONDS)), SESSION_TTL_SECONDS)
+REVOCATION_SYNC_SECONDS = float(os.getenv("ADMIN_SESSION_REVOCATION_SYNC_SECONDS", 5))
+# A refreshed token stays valid this long, so requests already in flight with it still succeed.
+REFRESH_GRACE_SECONDS = int(os.getenv("ADMIN_SESSION_REFRESH_GRACE_SECONDS", 30))
+SECRET_CONFIG_ID = "admin_session_secret"
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class AdminSessions:
+    def __init__(self, db):
+        self.db = db
+        self._master = None
+        self._keys = {}  # epoch -> key
+        self._revoked_ids = {}      # jti -> (revoked_from, exp)
+        self._revoked_emails = {}   # email -> tokens issued before this are invalid
+        self._synced_at = 0.0
+        self._sync_marker = datetime.min
+        self._lock = threading.Lock()
+
+    # --- Keys ---
+
+    def _master_secret(self):
+        """ADMIN_SESSION_SECRET, or a random secret created once in system_config and shared by every worker."""
+        if self._master is None:
+            env_secret = os.getenv("ADMIN_SESSION_SECRET")
+            if env_secret:
+                self._master = env_secret.encode("utf-8")
+            else:
+                doc = self.db.system_config.find_one_and_update(
+                    {"_id": SECRET_CONFIG_ID},
+                    {"$setOnInsert": {"secret": secrets.token_hex(32)}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                self._master = doc["secret"].encode("utf-8")
+        return self._master
+
+    def _key(self, epoch):
+        key = self._keys.get(epoch)
+        if key is None:
+            key = hmac.new(self._master_secret(), f"admin-session:{epoch}".encode("ascii"), hashlib.sha256).digest()
+            with self._lock:
+                self._keys = {e: k for e, k in self._keys.items() if e >= epoch - 1}
+                self._keys[epoch] = key
+        return key
+
+    # --- Tokens ---
+
+    def issue(self, email):
+        """Returns (token, expires_at_unix)."""
+        now = int(time.time())
+        epoch = now // ROTATION_SECONDS
+        payload = {"e": email, "iat": now, "exp": now + SESSION_TTL_SECONDS, "jti": secrets.token_urlsafe(12), "k": epoch}
+        body = _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        signature = _b64encode(hmac.new(self._key(epoch), body.encode("ascii"), hashlib.sha256).digest())
+        return f"{body}.{signature}", payload["exp"]
+
+    def verify(self, token):
+        """Returns the token's payload if it is authentic, unexpired and not revoked; else None."""
+        try:
+            body, signature = token.split(".", 1)
+            payload = json.loads(_b64decode(body))
+            epoch, now = int(payload["k"]), time.time()
+        except (ValueError, KeyError, TypeError):
+            return None
+        if epoch not in (int(now) // ROTATION_SECONDS, int(now) // ROTATION_SECONDS - 1): return None  # Retired key
+        expected = _b64encode(hmac.new(self._key(epoch), body.encode("ascii"), hashlib.sha256).digest())
+        if not hmac.compare_digest(expected, signature): return None
+        if payload.get("exp", 0) <= now: return None
+        self._sync_revocations()
+        revoked = self._revoked_ids.get(payload.get("jti"))
+        if revoked and revoked[0] <= now: return None
+        if payload.get("iat", 0) <= self._revoked_emails.get(payload.get("e"), -1): return None
+        return payload
+
+    # --- Revocation ---
+
+    def revoke(self, payload, grace=0):
+        """Logs out one session, `grace` seconds from now."""
+        revoked_from = time.time() + grace
+        self._revoked_ids[payload["jti"]] = (revoked_from, payload["exp"])
+        self._store_revocation({"_id": f"jti:{payload['jti']}", "jti": payload["jti"], "revoked_from": revoked_from, "exp": payload["exp"]})
+
+    def revoke_admin(self, email):
+        """Invalidates every session issued so far to this admin."""
+        now = int(time.time())
+        self._revoked_emails[email] = now
+        self._store_revocation({"_id": f"email:{email}", "email": email, "before": now})
+
+    def _store_revocation(self, doc):
+        now = datetime.utcnow()
+        # Nothing it revokes can outlive one TTL, so neither does the record.
+        doc.update({"created_at": now, "expire_at": now + timedelta(seconds=SESSION_TTL_SECONDS)})
+        try: self.db.admin_revocations.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+        except Exception as e: print(f"⚠️ Could not persist admin session revocation: {e}")
+
+    def _sync_revocations(self):
+        """Pulls revocations made on other workers; at most one query per REVOCATION_SYNC_SECONDS."""
+        if time.monotonic() - self._synced_at < REVOCATION_SYNC_SECONDS: return
+        with self._lock:
+            if time.monotonic() - self._synced_at < REVOCATION_SYNC_SECONDS: return
+            self._synced_at = time.monotonic()
+            now = time.time()
+            self._revoked_ids = {jti: entry for jti, entry in self._revoked_ids.items() if entry[1] > now}
+            try:
+                for doc in self.db.admin_revocations.find({"created_at": {"$gte": self._sync_marker}}):
+                    if "jti" in doc: self._revoked_ids[doc["jti"]] = (doc.get("revoked_from", 0), doc.get("exp", now + SESSION_TTL_SECONDS))
+                    else: self._revoked_emails[doc["email"]] = max(doc["before"], self._revoked_emails.get(doc["email"], -1))
+                    self._sync_marker = max(self._sync_marker, doc["created_at"])
+            except Exception as e:
+                print(f"⚠️ Admin revocation sync failed: {e}")
@@ -0,0 +1,28 @@
+import database
+
+def main():
+    print("--- Friendix Friend ID Backfill ---")
+
+    # 1. Connect to Database
+    try:
+        database.load_config()
+        db = database.get_db()
+        if db is None:
+            print("🔥 Error: Could not connect to MongoDB.")
+            return
+        print("✅ Connected to Database.")
+    except Exception as e:
+        print(f"🔥 Connection Error: {e}")
+        return
+
+    # 2. Assign IDs by created_at rank
+    try:
+        highest = database.seed_friend_id_counter(db)
+        print(f"Friend ID counter seeded at: {highest}")
+        assigned = database.backfill_friend_ids(db)
+        print(f"✅ Assigned friend IDs to {assigned} user(s).")
+    except Exception as e:
+        print(f"🔥 Backfill Error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import time
+import queue
+import atexit
+import threading
+
+# In-process queue for writes the HTTP response does not depend on.
+WORKERS = int(os.getenv("BACKGROUND_WORKERS", 2))
+MAX_QUEUED = int(os.getenv("BACKGROUND_QUEUE_SIZE", 5000))
+BATCH_SIZE = 100
+BATCH_WAIT_SECONDS = 0.05
+
+
+class WorkQueue:
+    """
+    Bounded queue drained by a few worker threads.
+    - submit(fn, *args): run fn(*args) later.
+    - submit_batched(handler, item): items for the same handler are collected
+      (up to BATCH_SIZE, or BATCH_WAIT_SECONDS) and passed to handler(items) in one call.
+    When the queue is full the job runs inline, so work is never dropped.
+    """
+
+    def __init__(self, workers=WORKERS, maxsize=MAX_QUEUED):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.counters = {"submitted": 0, "ran_inline": 0, "completed": 0, "failed": 0, "batches": 0}
+
+    def _ensure_started(self):
+        if self._threads: return
+        with self._lock:
+            if self._threads: return
+            for i in range(self._workers):
+                t = threading.Thread(target=self._run, name=f"background-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        self._put((None, fn, args, kwargs))
+
+    def submit_batched(self, handler, item):
+        self._put((handler, None, (item,), None))
+
+    def _put(self, job):
+        self.counters["submitted"] += 1
+        if not self._stopping:
+            self._ensure_started()
+            try:
+                self._queue.put_nowait(job)
+                return
+            except queue.Full:
+                pass
+        self.counters["ran_inline"] += 1
+        self._execute([job])
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            jobs = [job]
+            deadline = time.monotonic() + BATCH_WAIT_SECONDS
+            while len(jobs) < BATCH_SIZE:
+                try: jobs.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty: break
+            try:
+                self._execute(jobs)
+            finally:
+                for _ in jobs: self._queue.task_done()
+
+    def _execute(self, jobs):
+        batches = {}
+        for handler, fn, args, kwargs in jobs:
+            if handler is not None:
+                batches.setdefault(handler, []).append(args[0])
+                continue
+            try:
+                fn(*args, **(kwargs or {}))
+                self.counters["completed"] += 1
+            except Exception as e:
+                self.counters["failed"] += 1
+                print(f"🔥 Background job {getattr(fn, '__name__', fn)} failed: {e}")
+        for handler, items in batches.items():
+            try:
+                handler(items)
+                self.counters["completed"] += len(items)
+                self.counters["batches"] += 1
+            except Exception as e:
+                self.counters["failed"] += len(items)
+                print(f"🔥 Background batch {getattr(handler, '__name__', handler)} failed: {e}")
+
+    def flush(self, timeout=10):
+        """Waits (up to `timeout`) for everything queued so far to finish."""
+        end = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < end:
+            time.sleep(0.01)
+        return self._queue.unfinished_tasks == 0
+
+    def shutdown(self, timeout=10):
+        self._stopping = True
+        if self._threads: self.flush(timeout)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+
+_queue = WorkQueue()
+atexit.register(_queue.shutdown)
+
+def submit(fn, *args, **kwargs):
+    _queue.submit(fn, *args, **kwargs)
+
+def submit_batched(handler, item):
+    _queue.submit_batched(handler, item)
+
+def flush(timeout=10):
+    return _queue.flush(timeout)
+
+def shutdown(timeout=10):
+    _queue.shutdown(timeout)
+
+def stats():
+    return _queue.stats()
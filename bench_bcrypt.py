@@ -0,0 +1,31 @@
+import sys
+import time
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from password_hasher import WORKERS
+
+# Logins/second (one bcrypt check each) per cost factor, on one thread and on the hashing pool.
+#   python bench_bcrypt.py [min_cost] [max_cost]
+
+def checks_per_second(hashed, workers, seconds=2.0):
+    password = b"correct horse battery staple"
+    done = 0
+    deadline = time.perf_counter() + seconds
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while time.perf_counter() < deadline:
+            done += sum(pool.map(lambda _: bcrypt.checkpw(password, hashed), range(workers)))
+    return done / seconds
+
+def main():
+    low = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    high = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+    print(f"--- bcrypt logins/sec (pool = {WORKERS} workers) ---")
+    for cost in range(low, high + 1):
+        hashed = bcrypt.hashpw(b"correct horse battery staple", bcrypt.gensalt(cost))
+        seconds = 1.0 if cost < 12 else 4.0
+        single = checks_per_second(hashed, 1, seconds)
+        pooled = checks_per_second(hashed, WORKERS, seconds)
+        print(f"cost {cost:>2}: {1000 / single:8.1f} ms/check | {single:8.1f}/s single | {pooled:8.1f}/s pooled")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import re
+import timeit
+from emoji_injector import DEFAULT_EMOJI_MAP, add_emojis
+
+def legacy_add_emojis(response_text):
+    """The previous implementation: one re.sub per keyword, map rebuilt per call."""
+    inline_emoji_map = dict(DEFAULT_EMOJI_MAP)
+    for keyword, emoji_char in inline_emoji_map.items():
+        pattern = r'\b' + re.escape(keyword) + r'\b'
+        response_text = re.sub(pattern, r'\g<0> ' + emoji_char, response_text, count=1, flags=re.IGNORECASE)
+    return response_text
+
+def main():
+    sentence = "Hi! I think about you and I miss you so much, good night and sweet dreams. "
+    filler = "This is a perfectly ordinary sentence without any of the keywords in it. "
+    for label, text in [("short", sentence), ("long (~8 KB)", sentence + filler * 110), ("very long (~80 KB)", sentence + filler * 1100)]:
+        runs = 200 if len(text) < 10000 else 20
+        old = timeit.timeit(lambda: legacy_add_emojis(text), number=runs) / runs * 1e6
+        new = timeit.timeit(lambda: add_emojis(text), number=runs) / runs * 1e6
+        print(f"{label:>20}: legacy {old:9.1f} µs | single-pass {new:9.1f} µs | {old / new:5.1f}x")
+
+if __name__ == "__main__":
+    main()
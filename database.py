@@ -1,11 +1,19 @@
 import os
-import bcrypt
+import time
+import password_hasher
+import background
+import threading
 import mimetypes
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import prompt_builder
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument, UpdateOne
+from pymongo import monitoring
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from bson.binary import Binary, BINARY_SUBTYPE
 from pymongo.errors import DuplicateKeyError, OperationFailure
 
@@ -15,89 +23,826 @@ def load_config():
     """Load .env file."""
     load_dotenv()
 
-def get_db():
-    """Connects to MongoDB and returns the database object."""
+# One MongoClient (and so one connection pool) per process. Every get_db() caller shares it.
+MONGO_DB_NAME = "luvisa"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 20000))
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def _available_compressors():
+    """Requested compressors whose Python packages are installed (zlib always is)."""
+    modules = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+    available = []
+    for name in MONGO_COMPRESSORS.split(","):
+        name = name.strip()
+        if name not in modules: continue
+        try:
+            __import__(modules[name])
+            available.append(name)
+        except ImportError:
+            pass
+    return available
+
+def get_client():
+    """
+    The process's shared MongoClient, created on first use. A client must not cross fork(), so
+    if the pid changed (gunicorn --preload, multiprocessing) a fresh one is built for this process.
+    """
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid(): return _client
     uri = os.getenv("MONGODB_URI")
     if not uri: return None
-    client = MongoClient(uri, server_api=ServerApi('1'))
-    return client.luvisa
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _pool_stats.reset()
+            compressors = _available_compressors()
+            options = {"compressors": ",".join(compressors)} if compressors else {}
+            _client = MongoClient(
+                uri, server_api=ServerApi('1'),
+                maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                readPreference=MONGO_READ_PREFERENCE,
+                event_listeners=[_pool_stats],
+                **options
+            )
+            _client_pid = os.getpid()
+    return _client
+
+class _ForkSafeDatabase:
+    """
+    Stand-in for the Database object that modules keep in a global `db`. Each attribute or item
+    lookup goes through get_client(), so a handle captured before a fork still talks to the
+    child's own pool.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def _db(self):
+        return get_client()[self._name]
+
+    def __getattr__(self, attr):
+        return getattr(self._db(), attr)
+
+    def __getitem__(self, key):
+        return self._db()[key]
+
+    def __repr__(self):
+        return f"_ForkSafeDatabase({self._name!r})"
+
+def get_db():
+    """Returns the shared database handle, or None when MONGODB_URI isn't set."""
+    if get_client() is None: return None
+    return _ForkSafeDatabase(MONGO_DB_NAME)
+
+# --- Connection Pool Metrics ---
+
+class _PoolStats(monitoring.ConnectionPoolListener):
+    """Checkout wait times and pool occupancy, fed by pymongo's CMAP events."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Greenlet-local under gevent's monkey patching
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checkout_timeouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+            self.open_connections = 0
+            self.in_use = 0
+            self._recent = deque(maxlen=self._window)
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        wait = time.perf_counter() - started if started else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._recent.append(wait)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT: self.checkout_timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock: self.in_use = max(self.in_use - 1, 0)
+
+    def connection_created(self, event):
+        with self._lock: self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock: self.open_connections = max(self.open_connections - 1, 0)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+
+    def stats(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            p95 = recent[int(len(recent) * 0.95) - 1] if recent else 0.0
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "open_connections": self.open_connections,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_timeouts": self.checkout_timeouts,
+                "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "p95_wait_ms": round(p95 * 1000, 2),
+                "max_wait_ms": round(self.max_wait * 1000, 2),
+            }
+
+_pool_stats = _PoolStats()
+
+def get_pool_stats():
+    return _pool_stats.stats()
+
+# --- Indexes ---
+
+# TTL indexes let Mongo's TTL monitor (a ~60s sweep) delete expired docs, so the request path
+# never has to. Reads still check expiry themselves since a doc can outlive its TTL by a minute.
+TOGETHER_SPACE_TTL_SECONDS = 300
+
+# collection -> [(keys, options)]. create_index is a no-op when the same spec already exists.
+INDEXES = {
+    "users": [
+        ([("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+        ([("profile.friend_id", ASCENDING)], {"name": "friend_id", "sparse": True}),
+        ([("created_at", ASCENDING)], {"name": "created_at"}),
+        ([("profile.last_active", ASCENDING)], {"name": "last_active"}),
+    ],
+    "chats": [
+        # Trailing _id matches the history pager's (timestamp, _id) sort, so pages come off the index in order
+        ([("user_id", ASCENDING), ("companion_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {"name": "user_companion_timestamp"}),
+        ([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {"name": "user_timestamp"}),
+        ([("timestamp", ASCENDING)], {"name": "timestamp"}),
+        ([("message", TEXT)], {"name": "message_text", "default_language": "english"}),
+    ],
+    "chat_summaries": [
+        ([("user_id", ASCENDING), ("companion_id", ASCENDING)], {"name": "user_companion_unique", "unique": True}),
+    ],
+    "password_resets": [
+        ([("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+        ([("expire_at", ASCENDING)], {"name": "expire_at_ttl", "expireAfterSeconds": 0}),
+    ],
+    "otps": [
+        ([("expire_at", ASCENDING)], {"name": "expire_at_ttl", "expireAfterSeconds": 0}),
+    ],
+    "otp_sends": [
+        ([("expire_at", ASCENDING)], {"name": "expire_at_ttl", "expireAfterSeconds": 0}),
+    ],
+    "together_spaces": [
+        ([("name", ASCENDING)], {"name": "name"}),
+        ([("created_at", ASCENDING)], {"name": "created_at_ttl", "expireAfterSeconds": TOGETHER_SPACE_TTL_SECONDS}),
+    ],
+    "admins": [
+        ([("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+    ],
+    "admin_revocations": [
+        ([("expire_at", ASCENDING)], {"name": "expire_at_ttl", "expireAfterSeconds": 0}),
+        ([("created_at", ASCENDING)], {"name": "created_at"}),
+    ],
+    "admin_logs": [
+        ([("timestamp", DESCENDING)], {"name": "timestamp"}),
+    ],
+}
+
+INDEX_CONFLICT_CODES = (85, 86)  # IndexOptionsConflict, IndexKeySpecsConflict
+
+def _find_index_by_keys(collection, keys):
+    for name, info in collection.index_information().items():
+        if list(info["key"]) == list(keys): return name, info
+    return None, None
+
+def _reconcile_index(collection, keys, options):
+    """
+    Brings an index whose options drifted from INDEXES (e.g. a plain index that is now a TTL index,
+    or a changed expireAfterSeconds) back in line: collMod when only the TTL differs, otherwise
+    drop and recreate.
+    """
+    existing = collection.index_information()
+    if options.get("name") in existing and list(existing[options["name"]]["key"]) != list(keys):
+        collection.drop_index(options["name"])  # Name reused for a different key pattern
+    name, info = _find_index_by_keys(collection, keys)
+    if name is None:
+        collection.create_index(keys, **options)
+        return
+    if name == options.get("name") and "expireAfterSeconds" in info and "expireAfterSeconds" in options:
+        collection.database.command("collMod", collection.name, index={"name": name, "expireAfterSeconds": options["expireAfterSeconds"]})
+    else:
+        collection.drop_index(name)
+        collection.create_index(keys, **options)
+    print(f"🔧 Reconciled index {collection.name}.{options.get('name')} (was {name}).")
+
+def ensure_indexes(db):
+    """Creates every index in INDEXES. Safe to run repeatedly. Returns a list of (collection, name, error) failures."""
+    failures = []
+    for coll_name, specs in INDEXES.items():
+        for keys, options in specs:
+            try:
+                try:
+                    db[coll_name].create_index(keys, **options)
+                except OperationFailure as e:
+                    if e.code not in INDEX_CONFLICT_CODES: raise
+                    _reconcile_index(db[coll_name], keys, options)
+            except (OperationFailure, DuplicateKeyError) as e:
+                print(f"🔥 Index {coll_name}.{options.get('name')} failed: {e}")
+                failures.append((coll_name, options.get("name"), str(e)))
+    return failures
+
+def check_ttl_indexes(db):
+    """Returns (collection, name, expected, actual) for every TTL index in INDEXES that is missing or has a different expireAfterSeconds."""
+    mismatches = []
+    for coll_name, specs in INDEXES.items():
+        for keys, options in specs:
+            if "expireAfterSeconds" not in options: continue
+            _, info = _find_index_by_keys(db[coll_name], keys)
+            actual = info.get("expireAfterSeconds") if info else None
+            if actual != options["expireAfterSeconds"]:
+                mismatches.append((coll_name, options["name"], options["expireAfterSeconds"], actual))
+    return mismatches
+
+def _hot_queries():
+    """(label, collection, filter, sort) for the queries that run on the request path."""
+    uid = ObjectId()
+    return [
+        ("users by email", "users", {"email": "probe@example.com"}, None),
+        ("users by friend_id", "users", {"profile.friend_id": "FRD-000000"}, None),
+        ("users by created_at", "users", {"created_at": {"$gte": datetime.utcnow()}}, None),
+        ("inactive users", "users", {"profile.last_active": {"$lte": datetime.utcnow()}}, None),
+        ("luvisa history", "chats", _chat_history_query(uid, "luvisa"), [("timestamp", -1)]),
+        ("coder history", "chats", _chat_history_query(uid, "coder"), [("timestamp", -1)]),
+        ("all history", "chats", _chat_history_query(uid, "all"), [("timestamp", -1)]),
+        ("coder history page", "chats", _chat_history_page_query(uid, "coder", _encode_history_cursor({"timestamp": datetime.utcnow(), "_id": ObjectId()})), HISTORY_PAGE_SORT),
+        ("all history page", "chats", _chat_history_page_query(uid, "all", _encode_history_cursor({"timestamp": datetime.utcnow(), "_id": ObjectId()})), HISTORY_PAGE_SORT),
+        ("old chats cleanup", "chats", {"timestamp": {"$lt": datetime.utcnow()}}, None),
+        ("password reset by email", "password_resets", {"email": "probe@example.com"}, None),
+        ("together space by name", "together_spaces", {"name": "probe"}, None),
+        ("admin by email", "admins", {"email": "probe@example.com"}, None),
+        ("admin message search", "chats", {"$text": {"$search": "probe"}}, None),
+    ]
+
+def _plan_stages(plan):
+    """Yields every 'stage' name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan: yield plan["stage"]
+        for value in plan.values(): yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan: yield from _plan_stages(item)
+
+def verify_query_plans(db):
+    """Runs explain() on each hot query. Returns the labels whose winning plan contains a COLLSCAN,
+    or a blocking in-memory SORT (the index doesn't provide the requested order)."""
+    offenders = []
+    for label, coll_name, query, sort in _hot_queries():
+        cursor = db[coll_name].find(query).limit(1)
+        if sort: cursor = cursor.sort(sort)
+        winning = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = set(_plan_stages(winning))
+        if "COLLSCAN" in stages or (sort and "SORT" in stages):
+            offenders.append(label)
+    return offenders
+
+# --- User Cache ---
+
+class _UserCache:
+    """Process-local TTL + LRU cache of user documents, keyed by _id with an email -> _id alias."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()  # _id -> (expires_at, doc)
+        self._ids_by_email = {}
+        self._lock = threading.Lock()
+
+    def _get(self, uid):
+        entry = self._docs.get(uid)
+        if entry and entry[0] > time.monotonic():
+            self._docs.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+        if entry: self._drop(uid)
+        self.misses += 1
+        return None
+
+    def get_by_id(self, uid):
+        with self._lock: return self._get(uid)
+
+    def get_by_email(self, email):
+        with self._lock:
+            uid = self._ids_by_email.get(email)
+            if uid is None:
+                self.misses += 1
+                return None
+            return self._get(uid)
+
+    def put(self, doc):
+        if not doc or "_id" not in doc: return
+        with self._lock:
+            self._drop(doc["_id"])
+            self._docs[doc["_id"]] = (time.monotonic() + self.ttl, doc)
+            if doc.get("email"): self._ids_by_email[doc["email"]] = doc["_id"]
+            while len(self._docs) > self.maxsize:
+                self._drop(next(iter(self._docs)))
+
+    def patch(self, uid, fields):
+        """Applies a $set-style dict (dotted keys allowed) to the cached copy, if any."""
+        with self._lock:
+            entry = self._docs.get(uid)
+            if not entry: return
+            doc = entry[1]
+            for path, value in fields.items():
+                target = doc
+                *parents, leaf = path.split(".")
+                for key in parents:
+                    target = target.setdefault(key, {})
+                target[leaf] = value
+
+    def increment(self, uid, path, amount):
+        """Adds `amount` to a numeric field of the cached copy, if any."""
+        with self._lock:
+            entry = self._docs.get(uid)
+            if not entry: return
+            *parents, leaf = path.split(".")
+            target = entry[1]
+            for key in parents:
+                target = target.setdefault(key, {})
+            target[leaf] = target.get(leaf, 0) + amount
+
+    def raise_to(self, uid, path, value):
+        """Sets a numeric field of the cached copy to max(cached, value), like $max."""
+        with self._lock:
+            entry = self._docs.get(uid)
+            if not entry: return
+            *parents, leaf = path.split(".")
+            target = entry[1]
+            for key in parents:
+                target = target.setdefault(key, {})
+            target[leaf] = max(target.get(leaf, value), value)
+
+    def invalidate(self, uid=None, email=None):
+        with self._lock:
+            if uid is None and email is not None: uid = self._ids_by_email.get(email)
+            if uid is not None: self._drop(uid)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self._ids_by_email.clear()
+
+    def _drop(self, uid):
+        entry = self._docs.pop(uid, None)
+        if entry and entry[1].get("email"): self._ids_by_email.pop(entry[1]["email"], None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._docs),
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+_user_cache = _UserCache(maxsize=int(os.getenv("USER_CACHE_SIZE", 2048)), ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", 30)))
+
+# Auth-critical fields are never cached: each worker has its own cache and nothing invalidates the
+# others, so a password reset or ban on one worker must not be missed by another for a TTL.
+# get_user_by_* leave them out; read them with get_user_auth().
+AUTH_FIELDS = ("hashed_password", "is_banned")
+_CACHED_USER_PROJECTION = {field: 0 for field in AUTH_FIELDS}
+
+def get_user_auth(db, user_id):
+    """Fresh {"hashed_password", "is_banned"} for a user, straight from Mongo (None if missing)."""
+    return db.users.find_one({"_id": ObjectId(user_id)}, {field: 1 for field in AUTH_FIELDS})
+
+def get_user_cache_stats():
+    return _user_cache.stats()
+
+def invalidate_user(user_id=None, email=None):
+    """Drops a user from the cache. Call after any write to `users` that bypasses this module."""
+    _user_cache.invalidate(ObjectId(user_id) if user_id is not None else None, email)
+
+def patch_cached_user(user_id, fields):
+    """Applies `fields` to the cached copy only. Use when the matching write is queued for later."""
+    _user_cache.patch(ObjectId(user_id), fields)
+
+def update_user_fields(db, user_id, fields):
+    """$set `fields` (dotted paths allowed) on a user and patch the cached copy to match."""
+    uid = ObjectId(user_id)
+    db.users.update_one({"_id": uid}, {"$set": fields})
+    _user_cache.patch(uid, fields)
+
+# --- Friend IDs ---
+
+FRIEND_ID_COUNTER = "friend_id"
+EARLY_USER_LIMIT = 99
+
+def next_sequence(db, name, count=1):
+    """Atomically reserves `count` numbers from a counter. Returns the last one reserved."""
+    doc = db.counters.find_one_and_update({"_id": name}, {"$inc": {"value": count}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return doc["value"]
+
+def friend_id_fields(sequential_number, creation_year):
+    six_digit_id = f"{sequential_number:06d}"
+    return {
+        "creation_year": creation_year,
+        "friend_id": f"FRD-{six_digit_id}",
+        "friend_id_number": six_digit_id,
+        "is_early_user": 0 < sequential_number <= EARLY_USER_LIMIT
+    }
+
+def seed_friend_id_counter(db):
+    """
+    Raises the counter above every number an existing user has or could be backfilled with: the
+    numeric max of issued IDs, and the user count (the highest created_at rank). New signups then
+    never take a number an older user is entitled to. Idempotent.
+    """
+    top = list(db.users.aggregate([
+        {"$match": {"profile.friend_id_number": {"$regex": "^[0-9]+$"}}},
+        {"$group": {"_id": None, "highest": {"$max": {"$toInt": "$profile.friend_id_number"}}}}
+    ]))
+    highest = max(top[0]["highest"] if top else 0, db.users.count_documents({}))
+    db.counters.update_one({"_id": FRIEND_ID_COUNTER}, {"$max": {"value": highest}}, upsert=True)
+    return highest
+
+def _created_at_rank(db, user_doc):
+    """1-based position by created_at (ties by _id), the number the original scheme gave each user."""
+    created_at, uid = user_doc.get("created_at"), user_doc["_id"]
+    if created_at is None: before = {"created_at": None, "_id": {"$lt": uid}}  # Undated users sort first
+    else: before = {"$or": [{"created_at": {"$lt": created_at}}, {"created_at": None}, {"created_at": created_at, "_id": {"$lt": uid}}]}
+    return db.users.count_documents(before) + 1
+
+def _friend_id_taken(db, number):
+    return db.users.find_one({"profile.friend_id": f"FRD-{number:06d}"}, {"_id": 1}) is not None
+
+def assign_friend_id(db, user_doc):
+    """Gives an existing user without a friend ID their created_at rank (the counter's next number if
+    a deleted account shifted ranks and it is taken). Returns the profile's friend ID fields."""
+    created_at = user_doc.get("created_at")
+    creation_year = created_at.year if created_at else user_doc["_id"].generation_time.year
+    number = _created_at_rank(db, user_doc)
+    if _friend_id_taken(db, number): number = next_sequence(db, FRIEND_ID_COUNTER)
+    fields = friend_id_fields(number, creation_year)
+    result = db.users.update_one({"_id": user_doc["_id"], "profile.friend_id": {"$exists": False}},
+                                 {"$set": {f"profile.{k}": v for k, v in fields.items()}})
+    if result.modified_count == 0:
+        # Another request assigned one first; use theirs
+        invalidate_user(user_doc["_id"])
+        profile = get_user_by_id(db, user_doc["_id"]).get("profile", {})
+        return {k: profile.get(k, v) for k, v in fields.items()}
+    _user_cache.patch(user_doc["_id"], {f"profile.{k}": v for k, v in fields.items()})
+    return fields
+
+def backfill_friend_ids(db, batch_size=1000):
+    """
+    One-off: gives every user missing a friend ID their created_at rank, in a single streaming pass
+    over users in created_at order. Ranks already taken (after deleted accounts shifted them) get
+    numbers from the counter, which seed_friend_id_counter has moved above every rank.
+    """
+    seed_friend_id_counter(db)
+    taken = {int(n) for n in db.users.distinct("profile.friend_id_number") if str(n).isdigit()}
+    rank, assigned, ops, deferred = 0, 0, [], []
+    for user in db.users.find({}, {"created_at": 1, "profile.friend_id": 1}).sort([("created_at", 1), ("_id", 1)]).batch_size(batch_size):
+        rank += 1
+        if user.get("profile", {}).get("friend_id"): continue
+        if rank in taken:
+            deferred.append(user)
+            continue
+        ops.append(_friend_id_update(user, rank))
+        taken.add(rank)
+        if len(ops) >= batch_size:
+            assigned += db.users.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if deferred:
+        first = next_sequence(db, FRIEND_ID_COUNTER, len(deferred)) - len(deferred) + 1
+        ops.extend(_friend_id_update(user, first + i) for i, user in enumerate(deferred))
+    if ops: assigned += db.users.bulk_write(ops, ordered=False).modified_count
+    _user_cache.clear()
+    return assigned
+
+def _friend_id_update(user, number):
+    created_at = user.get("created_at")
+    year = created_at.year if created_at else user["_id"].generation_time.year
+    fields = friend_id_fields(number, year)
+    return UpdateOne({"_id": user["_id"], "profile.friend_id": {"$exists": False}}, {"$set": {f"profile.{k}": v for k, v in fields.items()}})
 
 # --- User Operations ---
 
 def register_user(db, email, password):
     try:
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = password_hasher.hash_password(password)
+        now = datetime.utcnow()
+        profile = {
+            "display_name": email.split('@')[0],
+            "bio": "Hey there! I’m using Friendix",
+            "xp": 0, "level": 1, "streak": 1,
+            "notifications": [], "has_seen_notifications": True
+        }
+        profile.update(friend_id_fields(next_sequence(db, FRIEND_ID_COUNTER), now.year))
         user_document = {
             "email": email,
             "hashed_password": hashed_password,
-            "created_at": datetime.utcnow(),
-            "profile": {
-                "display_name": email.split('@')[0],
-                "bio": "Hey there! I’m using Friendix",
-                "xp": 0, "level": 1, "streak": 1,
-                "notifications": [], "has_seen_notifications": True
-            }
+            "created_at": now,
+            "profile": profile
         }
         result = db.users.insert_one(user_document)
+        bump_stats(db, users=1, daily={now: {"signups": 1}})
         return result.inserted_id
+    except password_hasher.HasherBusy: raise
     except: return None
 
 def get_user_by_email(db, email):
-    return db.users.find_one({"email": email})
+    user = _user_cache.get_by_email(email)
+    if user is None:
+        user = db.users.find_one({"email": email}, _CACHED_USER_PROJECTION)
+        _user_cache.put(user)
+    return user
 
 def get_user_by_id(db, user_id):
-    try: return db.users.find_one({"_id": ObjectId(user_id)})
+    try:
+        uid = ObjectId(user_id)
+        user = _user_cache.get_by_id(uid)
+        if user is None:
+            user = db.users.find_one({"_id": uid}, _CACHED_USER_PROJECTION)
+            _user_cache.put(user)
+        return user
     except: return None
 
-def check_user_password(user_doc, password):
+def _rehash_if_outdated(db, collection, doc_id, hashed, password):
+    """After a successful check, upgrades a hash made at an old cost. Runs off the request path."""
+    if db is None or not password_hasher.needs_rehash(hashed): return
+    def rehash():
+        db[collection].update_one({"_id": doc_id, "hashed_password": hashed}, {"$set": {"hashed_password": password_hasher.hash_password(password)}})
+        if collection == "users": invalidate_user(doc_id)
+    background.submit(rehash)
+
+def check_user_password(user_doc, password, db=None):
     if user_doc and password:
-        hp = user_doc.get("hashed_password")
-        if hp: return bcrypt.checkpw(password.encode('utf-8'), hp)
+        # Cached user docs carry no hash; read it fresh so a reset on another worker applies at once
+        auth = get_user_auth(db, user_doc["_id"]) if db is not None else user_doc
+        hp = (auth or {}).get("hashed_password")
+        if hp and password_hasher.check_password(password, hp):
+            _rehash_if_outdated(db, "users", user_doc["_id"], hp, password)
+            return True
     return False
 
+def set_user_password(db, email, password):
+    result = db.users.update_one({"email": email}, {"$set": {"hashed_password": password_hasher.hash_password(password)}})
+    invalidate_user(email=email)
+    return result.matched_count == 1
+
 def update_user_profile(db, user_id, display_name, status_message):
     try:
-        db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"profile.display_name": display_name, "profile.bio": status_message}})
+        update_user_fields(db, user_id, {"profile.display_name": display_name, "profile.bio": status_message})
         return True
     except: return False
 
 def update_profile_picture(db, user_id, image_data, content_type):
     try:
         db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"profile.profile_pic.data": Binary(image_data), "profile.profile_pic.content_type": content_type}})
+        invalidate_user(user_id)
         return True
     except: return False
 
+def bulk_increment_xp(db, increments):
+    """increments: {user_id: (xp_to_add, level_at_least)}. One bulk_write for the whole batch."""
+    if not increments: return 0
+    ops = [UpdateOne({"_id": ObjectId(uid)}, {"$inc": {"profile.xp": n}, "$max": {"profile.level": level}}) for uid, (n, level) in increments.items()]
+    result = db.users.bulk_write(ops, ordered=False)
+    bump_stats(db, xp=sum(n for n, _ in increments.values()))
+    for uid, (n, level) in increments.items():
+        _user_cache.increment(ObjectId(uid), "profile.xp", n)
+        _user_cache.raise_to(ObjectId(uid), "profile.level", level)
+    return result.modified_count
+
+def apply_login_update(db, user_id, last_active, fields, xp=0, level=1):
+    """
+    Records a login as one compare-and-set on profile.last_active: $set `fields`, $inc the login
+    XP and $max the level, but only if no other request (or worker) has recorded activity since
+    `last_active` was read. Returns the updated user, or None when the caller's copy was stale.
+    """
+    update = {"$set": fields, "$max": {"profile.level": level}}
+    if xp: update["$inc"] = {"profile.xp": xp}
+    doc = db.users.find_one_and_update({"_id": ObjectId(user_id), "profile.last_active": last_active}, update,
+                                       projection=_CACHED_USER_PROJECTION, return_document=ReturnDocument.AFTER)
+    if doc is None: return None
+    _user_cache.put(doc)
+    if xp: bump_stats(db, xp=xp)
+    return doc
+
+def raise_user_level(db, user_id, level):
+    db.users.update_one({"_id": ObjectId(user_id)}, {"$max": {"profile.level": level}})
+    _user_cache.raise_to(ObjectId(user_id), "profile.level", level)
+
 def update_user_xp_and_level(db, user_id, new_xp, new_level):
     try:
-        db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"profile.xp": new_xp, "profile.level": new_level}})
+        before = db.users.find_one_and_update({"_id": ObjectId(user_id)}, {"$set": {"profile.xp": new_xp, "profile.level": new_level}}, projection={"profile.xp": 1})
+        patch_cached_user(user_id, {"profile.xp": new_xp, "profile.level": new_level})
+        if before: bump_stats(db, xp=new_xp - before.get("profile", {}).get("xp", 0))
         return True
     except: return False
 
 # --- Chat History ---
 
-def get_chat_history(db, user_id, companion_id=None):
+def _chat_history_query(user_id, companion_id=None):
     query = {"user_id": ObjectId(user_id)}
     if companion_id == 'all':
         pass # Fetch everything
     elif companion_id == 'coder': query["companion_id"] = "coder"
     elif companion_id == 'coach': query["companion_id"] = "coach"
     else: query["$or"] = [{"companion_id": "luvisa"}, {"companion_id": {"$exists": False}}]
-    return list(db.chats.find(query, {"_id": 0}).sort("timestamp", 1))
+    return query
+
+def get_chat_history(db, user_id, companion_id=None, limit=None):
+    """Oldest-first history. With `limit`, only the newest `limit` messages are read (indexed desc sort)."""
+    query = _chat_history_query(user_id, companion_id)
+    if not limit:
+        return list(db.chats.find(query, {"_id": 0}).sort("timestamp", 1))
+    docs = list(db.chats.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit))
+    docs.reverse()
+    return docs
+
+def _encode_history_cursor(doc):
+    # Docs without a timestamp sort before every dated one (null < date), so they page by _id alone
+    ts = doc.get("timestamp")
+    return f"{ts.isoformat() if ts else ''}~{doc['_id']}"
+
+def _decode_history_cursor(cursor):
+    """Raises ValueError for anything that isn't a cursor we issued."""
+    try:
+        ts_str, oid = cursor.split("~", 1)
+        return (datetime.fromisoformat(ts_str) if ts_str else None), ObjectId(oid)
+    except (ValueError, TypeError, InvalidId) as e:
+        raise ValueError(f"Invalid history cursor: {cursor!r}") from e
+
+HISTORY_PAGE_SORT = [("timestamp", -1), ("_id", -1)]
+
+def _chat_history_page_query(user_id, companion_id=None, cursor=None):
+    query = _chat_history_query(user_id, companion_id)
+    if not cursor: return query
+    ts, oid = _decode_history_cursor(cursor)
+    if ts is None: page = {"timestamp": None, "_id": {"$lt": oid}}
+    else: page = {"$or": [{"timestamp": {"$lt": ts}}, {"timestamp": None}, {"timestamp": ts, "_id": {"$lt": oid}}]}
+    return {"$and": [query, page]}
+
+def get_chat_history_page(db, user_id, companion_id=None, limit=50, cursor=None):
+    """
+    Cursor-paginated history, newest page first.
+    Returns (messages oldest-first, next_cursor) where next_cursor fetches the page before it (None when exhausted).
+    """
+    query = _chat_history_page_query(user_id, companion_id, cursor)
+    docs = list(db.chats.find(query).sort(HISTORY_PAGE_SORT).limit(limit + 1))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = _encode_history_cursor(docs[-1]) if has_more else None
+    docs.reverse()
+    return docs, next_cursor
+
+def build_chat_doc(user_id, sender, message, timestamp, **kwargs):
+    # Token estimate is stored once so prompt assembly never re-tokenizes old messages
+    doc = {"user_id": ObjectId(user_id), "sender": sender, "message": message, "timestamp": timestamp, "tokens": prompt_builder.estimate_tokens(message)}
+    doc.update(kwargs)
+    return doc
 
 def add_message_to_history(db, user_id, sender, message, timestamp, **kwargs):
     try:
-        doc = {"user_id": ObjectId(user_id), "sender": sender, "message": message, "timestamp": timestamp}
-        doc.update(kwargs)
+        doc = build_chat_doc(user_id, sender, message, timestamp, **kwargs)
         db.chats.insert_one(doc)
+        _bump_message_stats(db, [doc])
         return True
     except: return False
 
+def insert_chat_docs(db, docs):
+    """Batch insert of docs from build_chat_doc."""
+    if not docs: return 0
+    inserted = len(db.chats.insert_many(docs, ordered=False).inserted_ids)
+    _bump_message_stats(db, docs)
+    return inserted
+
 def delete_chat_history(db, user_id):
     try:
-        db.chats.delete_many({"user_id": ObjectId(user_id)})
+        result = db.chats.delete_many({"user_id": ObjectId(user_id)})
+        bump_stats(db, messages=-result.deleted_count)
+        db.chat_summaries.delete_many({"user_id": ObjectId(user_id)})
         return True
     except: return False
 
+# --- Conversation Summaries ---
+
+def _summary_companion(companion_id):
+    return companion_id if companion_id in ("coder", "coach") else "luvisa"
+
+def touch_chat_summary(db, user_id, companion_id):
+    """Counts one more turn towards the next summary and returns the summary doc (one round trip)."""
+    return db.chat_summaries.find_one_and_update(
+        {"user_id": ObjectId(user_id), "companion_id": _summary_companion(companion_id)},
+        {"$inc": {"pending": 1}, "$setOnInsert": {"summary": "", "summarized_until": None}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+
+def get_chat_summary(db, user_id, companion_id):
+    return db.chat_summaries.find_one({"user_id": ObjectId(user_id), "companion_id": _summary_companion(companion_id)})
+
+def save_chat_summary(db, user_id, companion_id, summary, summarized_until, consumed):
+    """Stores a new summary and takes the `consumed` turns off pending. Turns counted while the
+    summary was being generated stay pending, so they are folded into the next one."""
+    key = {"user_id": ObjectId(user_id), "companion_id": _summary_companion(companion_id)}
+    db.chat_summaries.update_one(key,
+        {"$set": {"summary": summary, "summarized_until": summarized_until, "updated_at": datetime.utcnow()}, "$inc": {"pending": -consumed}},
+        upsert=True)
+    # Messages from before turn counting started can outnumber pending; don't let it go negative
+    db.chat_summaries.update_one({**key, "pending": {"$lt": 0}}, {"$set": {"pending": 0}})
+
+def get_messages_since(db, user_id, companion_id, since=None, limit=60):
+    """Oldest-first messages newer than `since` (all messages when None)."""
+    query = _chat_history_query(user_id, companion_id)
+    if since: query["timestamp"] = {"$gt": since}
+    return list(db.chats.find(query, {"_id": 0, "sender": 1, "message": 1, "timestamp": 1}).sort("timestamp", 1).limit(limit))
+
+# --- Inactivity Job ---
+
+INACTIVE_USER_FIELDS = {
+    "email": 1, "created_at": 1, "profile.display_name": 1, "profile.last_active": 1,
+    "profile.daily_msg_sent": 1, "profile.last_reengagement_sent": 1, "profile.reengagement_level": 1,
+}
+
+def _inactive_since(cutoff):
+    """Users whose last activity (or signup, if they were never active) is at or before cutoff."""
+    return {"$or": [
+        {"profile.last_active": {"$lte": cutoff}},
+        {"profile.last_active": None, "created_at": {"$lte": cutoff}},
+    ]}
+
+def inactive_user_candidates(db, now, levels, batch_size=1000):
+    """
+    Cursor over the users the inactivity job may act on: inactive a day without the miss-you message,
+    or inactive long enough for a re-engagement level (days, level) above the one they last got.
+    Everyone else is filtered out server-side, and only the fields the job reads are returned.
+    """
+    clauses = [{"$and": [_inactive_since(now - timedelta(days=1)), {"profile.daily_msg_sent": {"$ne": True}}]}]
+    for days, level in levels:
+        clauses.append({"$and": [_inactive_since(now - timedelta(days=days)), {"profile.reengagement_level": {"$not": {"$gte": level}}}]})
+    return db.users.find({"$or": clauses}, INACTIVE_USER_FIELDS, batch_size=batch_size)
+
+def bulk_update_users(db, ops, user_ids):
+    """bulk_write of UpdateOne ops on users; drops the affected users from the cache."""
+    if not ops: return None
+    result = db.users.bulk_write(ops, ordered=False)
+    for user_id in user_ids: invalidate_user(user_id)
+    return result
+
+# --- Job Runs ---
+# job_runs holds one doc per scheduled job. Every gunicorn worker runs the scheduler, so a job
+# first claims a lease; the others see it held (or recently finished) and skip the run.
+
+def claim_job(db, name, owner, lease_seconds, min_interval_seconds):
+    """Returns True if `owner` now holds the job's lease."""
+    now = datetime.utcnow()
+    try:
+        db.job_runs.find_one_and_update(
+            {"_id": name,
+             "lease_until": {"$not": {"$gt": now}},
+             "finished_at": {"$not": {"$gt": now - timedelta(seconds=min_interval_seconds)}}},
+            {"$set": {"owner": owner, "lease_until": now + timedelta(seconds=lease_seconds), "started_at": now, "progress": {}}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False  # Doc exists but is leased or finished recently
+
+def renew_job(db, name, owner, lease_seconds, progress=None):
+    update = {"lease_until": datetime.utcnow() + timedelta(seconds=lease_seconds)}
+    if progress is not None: update["progress"] = progress
+    return db.job_runs.update_one({"_id": name, "owner": owner}, {"$set": update}).modified_count == 1
+
+def finish_job(db, name, owner, progress):
+    now = datetime.utcnow()
+    db.job_runs.update_one({"_id": name, "owner": owner}, {"$set": {"finished_at": now, "lease_until": now, "progress": progress}})
+
 # --- Journal ---
 
 def get_journal_entry(db, user_id, date_str):
@@ -107,9 +852,40 @@ def get_journal_entry(db, user_id, date_str):
 def save_journal_entry(db, user_id, date_str, content, unlocked=False):
     entry = {"date": date_str, "content": content, "unlocked": unlocked}
     db.users.update_one({"_id": ObjectId(user_id)}, {"$push": {"profile.journal_entries": entry}})
+    invalidate_user(user_id)
 
 def unlock_journal_entry(db, user_id, date_str):
     db.users.update_one({"_id": ObjectId(user_id), "profile.journal_entries.date": date_str}, {"$set": {"profile.journal_entries.$.unlocked": True}})
+    invalidate_user(user_id)
+
+# --- Together Spaces ---
+# A message's seq is its index in the space's history array. msg_count is bumped in the same
+# update as the $push, so the post-update count identifies the message without re-reading the array.
+
+def push_together_message(db, space_id, message, set_fields=None, recent=0):
+    """
+    Appends a message to a space. Returns (seq, space_doc) or (None, None) if the space is gone.
+    With recent=N the returned doc also carries the last N messages (including this one), so
+    callers that need context get it from the same round trip.
+    """
+    update = {"$push": {"history": message}, "$inc": {"msg_count": 1}}
+    if set_fields: update["$set"] = set_fields
+    projection = {"msg_count": 1, "ai_active": 1, "created_at": 1}
+    if recent: projection["history"] = {"$slice": -recent}
+    space = db.together_spaces.find_one_and_update(
+        {"_id": ObjectId(space_id)}, update,
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+    if not space: return None, None
+    return space["msg_count"] - 1, space
+
+def get_together_messages(db, space_id, since=-1, limit=500):
+    """Space metadata plus the messages after seq `since` (history is sliced server-side)."""
+    return db.together_spaces.find_one(
+        {"_id": ObjectId(space_id)},
+        {"history": {"$slice": [max(since + 1, 0), limit]}, "ai_active": 1, "created_at": 1, "msg_count": 1}
+    )
 
 # ==========================================
 # --- ADMIN FUNCTIONS (SEPARATE COLLECTION) ---
@@ -119,7 +895,7 @@ def ensure_admin(db, email, password):
     """Creates an admin in the 'admins' collection if they don't exist."""
     # Check 'admins' collection, NOT 'users'
     if not db.admins.find_one({"email": email}):
-        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        hashed = password_hasher.hash_password(password)
         db.admins.insert_one({
             "email": email,
             "hashed_password": hashed,
@@ -133,14 +909,16 @@ def verify_admin_credentials(db, email, password):
     admin = db.admins.find_one({"email": email})
     if admin:
         hp = admin.get("hashed_password")
-        if hp: return bcrypt.checkpw(password.encode('utf-8'), hp)
+        if hp and password_hasher.check_password(password, hp):
+            _rehash_if_outdated(db, "admins", admin["_id"], hp, password)
+            return True
     return False
 
 # --- Admin Management Tools ---
 
 def create_new_admin(db, email, password):
     """Force creates/updates an admin in the 'admins' collection."""
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed = password_hasher.hash_password(password)
     
     # Check if exists to update or insert
     existing = db.admins.find_one({"email": email})
@@ -197,36 +975,81 @@ def log_admin_action(db, admin_email, action, details):
         })
     except: pass
 
+# --- Dashboard Stats ---
+# The dashboard reads pre-aggregated docs from `stats` instead of scanning users/chats:
+#   {"_id": "totals", "users", "messages", "total_xp", "updated_at", "recomputed_at"}
+#   {"_id": "daily:YYYY-MM-DD", "date", "signups", "messages"}   (one per day, kept forever)
+# Writes bump them with $inc as they happen. recompute_stats() rebuilds the totals and the
+# signup history from the source collections on a schedule, correcting any drift from
+# absolute XP edits or direct database changes.
+
+STATS_TOTALS_ID = "totals"
+STATS_MAX_DAYS = 365
+
+def _stats_day_id(when):
+    return "daily:" + when.strftime("%Y-%m-%d")
+
+def bump_stats(db, users=0, messages=0, xp=0, daily=None):
+    """daily: {datetime_or_date: {"signups": n, "messages": n}}. Never raises; stats must not break writes."""
+    inc = {k: v for k, v in (("users", users), ("messages", messages), ("total_xp", xp)) if v}
+    ops = []
+    if inc: ops.append(UpdateOne({"_id": STATS_TOTALS_ID}, {"$inc": inc, "$set": {"updated_at": datetime.utcnow()}}, upsert=True))
+    for when, counts in (daily or {}).items():
+        counts = {k: v for k, v in counts.items() if v}
+        if counts: ops.append(UpdateOne({"_id": _stats_day_id(when)}, {"$inc": counts, "$setOnInsert": {"date": when.strftime("%Y-%m-%d")}}, upsert=True))
+    if not ops: return
+    try: db.stats.bulk_write(ops, ordered=False)
+    except Exception as e: print(f"⚠️ Stats update failed: {e}")
+
+def _bump_message_stats(db, docs):
+    per_day = {}
+    for doc in docs:
+        ts = doc.get("timestamp")
+        day = (ts if isinstance(ts, datetime) else datetime.utcnow()).date()
+        per_day[day] = per_day.get(day, 0) + 1
+    bump_stats(db, messages=len(docs), daily={day: {"messages": n} for day, n in per_day.items()})
+
+def recompute_stats(db):
+    """Full rebuild of the totals and per-day signups. Daily message counts are left alone:
+    chats are pruned after a week, so the incremental counts are the only record of older days."""
+    user_count = db.users.count_documents({})
+    chat_count = db.chats.count_documents({})
+    xp_res = list(db.users.aggregate([{"$group": {"_id": None, "total_xp": {"$sum": "$profile.xp"}}}]))
+    total_xp = xp_res[0]['total_xp'] if xp_res else 0
+    signups = db.users.aggregate([
+        {"$match": {"created_at": {"$type": "date"}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "count": {"$sum": 1}}}
+    ])
+    ops = [UpdateOne({"_id": "daily:" + r["_id"]}, {"$set": {"date": r["_id"], "signups": r["count"]}}, upsert=True) for r in signups]
+    now = datetime.utcnow()
+    ops.append(UpdateOne({"_id": STATS_TOTALS_ID}, {"$set": {"users": user_count, "messages": chat_count, "total_xp": total_xp, "updated_at": now, "recomputed_at": now}}, upsert=True))
+    db.stats.bulk_write(ops, ordered=False)
+    return {"users": user_count, "messages": chat_count, "total_xp": total_xp}
+
+def ensure_stats(db):
+    """Totals that were never rebuilt from source (e.g. first created by a $inc on an existing
+    deployment) only count writes since then, so they are recomputed before being served."""
+    totals = db.stats.find_one({"_id": STATS_TOTALS_ID})
+    if totals is None or "recomputed_at" not in totals: totals = recompute_stats(db)
+    return totals
+
 def get_system_stats(db):
     try:
-        user_count = db.users.count_documents({})
-        chat_count = db.chats.count_documents({})
-        pipeline = [{"$group": {"_id": None, "total_xp": {"$sum": "$profile.xp"}}}]
-        xp_res = list(db.users.aggregate(pipeline))
-        total_xp = xp_res[0]['total_xp'] if xp_res else 0
-        maintenance = is_maintenance_active(db)
-        return {"users": user_count, "messages": chat_count, "maintenance": maintenance, "total_xp": total_xp}
+        totals = ensure_stats(db)
+        return {"users": totals.get("users", 0), "messages": totals.get("messages", 0), "maintenance": is_maintenance_active(db), "total_xp": totals.get("total_xp", 0)}
     except: return {}
 
-def get_daily_signups(db):
+def get_daily_signups(db, days=7):
     try:
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=6)
-        pipeline = [
-            {"$match": {"created_at": {"$gte": start_date}}},
-            {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "count": {"$sum": 1}}},
-            {"$sort": {"_id": 1}}
-        ]
-        results = list(db.users.aggregate(pipeline))
-        labels = []
-        data = []
-        date_map = {r['_id']: r['count'] for r in results}
-        for i in range(7):
-            d = (start_date + timedelta(days=i)).strftime("%Y-%m-%d")
-            labels.append(d)
-            data.append(date_map.get(d, 0))
-        return {"labels": labels, "data": data}
-    except: return {"labels": [], "data": []}
+        days = max(1, min(int(days), STATS_MAX_DAYS))
+        start_date = datetime.utcnow() - timedelta(days=days - 1)
+        dates = [start_date + timedelta(days=i) for i in range(days)]
+        docs = {d["_id"]: d for d in db.stats.find({"_id": {"$in": [_stats_day_id(d) for d in dates]}})}
+        labels = [d.strftime("%Y-%m-%d") for d in dates]
+        data = [docs.get(_stats_day_id(d), {}).get("signups", 0) for d in dates]
+        messages = [docs.get(_stats_day_id(d), {}).get("messages", 0) for d in dates]
+        return {"labels": labels, "data": data, "messages": messages}
+    except: return {"labels": [], "data": [], "messages": []}
 
 def get_all_users_admin(db, limit=100):
     cursor = db.users.find({}, {"email": 1, "profile": 1, "created_at": 1, "is_banned": 1}).sort("created_at", -1).limit(limit)
@@ -248,8 +1071,11 @@ def get_all_users_admin(db, limit=100):
 def delete_user_complete(db, user_id):
     try:
         uid = ObjectId(user_id)
-        db.users.delete_one({"_id": uid})
-        db.chats.delete_many({"user_id": uid})
+        user = db.users.find_one_and_delete({"_id": uid}, projection={"profile.xp": 1})
+        chats = db.chats.delete_many({"user_id": uid})
+        db.chat_summaries.delete_many({"user_id": uid})
+        invalidate_user(uid)
+        bump_stats(db, users=-1 if user else 0, messages=-chats.deleted_count, xp=-(user or {}).get("profile", {}).get("xp", 0))
         return True
     except: return False
 
@@ -257,7 +1083,7 @@ def toggle_user_ban(db, user_id):
     try:
         user = db.users.find_one({"_id": ObjectId(user_id)})
         new_status = not user.get("is_banned", False)
-        db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"is_banned": new_status}})
+        update_user_fields(db, user_id, {"is_banned": new_status})
         return new_status
     except: return None
 
@@ -265,18 +1091,62 @@ def broadcast_notification(db, message, filters=None):
     try:
         notif = {"message": message, "iconClass": "bx-broadcast", "timestamp": datetime.utcnow()}
         result = db.users.update_many({}, {"$push": {"profile.notifications": notif}, "$set": {"profile.has_seen_notifications": False}})
+        _user_cache.clear()
         return result.modified_count
     except: return 0
 
+# The maintenance flag is checked before every request, so it is served from memory. A daemon
+# poller re-reads it every MAINTENANCE_REFRESH_SECONDS, which bounds how long a toggle made on
+# another worker takes to apply. The worker that toggles it updates its own copy immediately.
+MAINTENANCE_REFRESH_SECONDS = float(os.getenv("MAINTENANCE_REFRESH_SECONDS", 5))
+
+class _MaintenanceFlag:
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self.active = False
+        self.refreshed_at = None
+        self._poller_pid = None
+        self._lock = threading.Lock()
+
+    def set(self, active):
+        self.active = bool(active)
+        self.refreshed_at = time.monotonic()
+
+    def refresh(self, db):
+        try:
+            config = db.system_config.find_one({"_id": "maintenance"}, {"active": 1})
+            self.set(config.get("active", False) if config else False)
+        except Exception as e:
+            print(f"⚠️ Maintenance flag refresh failed: {e}")  # Keep the last known value
+
+    def _poll(self, db):
+        while True:
+            time.sleep(self.refresh_seconds)
+            self.refresh(db)
+
+    def _ensure_poller(self, db):
+        if self._poller_pid == os.getpid(): return
+        with self._lock:
+            if self._poller_pid == os.getpid(): return
+            threading.Thread(target=self._poll, args=(db,), name="maintenance-poller", daemon=True).start()
+            self._poller_pid = os.getpid()
+
+    def get(self, db):
+        self._ensure_poller(db)
+        # First call, or the poller has stalled: read synchronously rather than serve a stale flag.
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.refresh_seconds * 3:
+            self.refresh(db)
+        return self.active
+
+_maintenance_flag = _MaintenanceFlag(MAINTENANCE_REFRESH_SECONDS)
+
 def is_maintenance_active(db):
-    try:
-        config = db.system_config.find_one({"_id": "maintenance"})
-        return config.get("active", False) if config else False
-    except: return False
+    return _maintenance_flag.get(db)
 
 def set_maintenance_mode(db, active):
     try:
         db.system_config.update_one({"_id": "maintenance"}, {"$set": {"active": active}}, upsert=True)
+        _maintenance_flag.set(active)
     except: pass
 
 def get_admin_logs(db, limit=50):
@@ -285,21 +1155,36 @@ def get_admin_logs(db, limit=50):
         return [{"time": l["timestamp"].strftime("%Y-%m-%d %H:%M"), "admin": l["admin"], "action": l["action"], "details": l["details"]} for l in cursor]
     except: return []
 
-def search_chat_messages(db, query):
+MESSAGE_SEARCH_PAGE_SIZE = 20
+MESSAGE_SEARCH_MAX_PAGE_SIZE = 100
+
+def search_chat_messages(db, query, page=1, limit=MESSAGE_SEARCH_PAGE_SIZE):
+    """
+    Full-text search over chats via the message_text index (word/stem matches; "quoted phrases"
+    and -negations follow Mongo's $text syntax). Ranked by text score, newest first on ties.
+    Returns (results, has_more).
+    """
     try:
-        cursor = db.chats.find({"message": {"$regex": query, "$options": "i"}}).sort("timestamp", -1).limit(20)
-        results = []
-        for m in cursor:
-            user = db.users.find_one({"_id": m["user_id"]})
-            email = user["email"] if user else "Unknown"
-            results.append({
-                "time": m["timestamp"].strftime("%Y-%m-%d %H:%M"),
-                "sender": m["sender"],
-                "email": email,
-                "message": m["message"]
-            })
-        return results
-    except: return []
+        page = max(1, int(page))
+        limit = max(1, min(int(limit), MESSAGE_SEARCH_MAX_PAGE_SIZE))
+        cursor = db.chats.find(
+            {"$text": {"$search": query}},
+            {"score": {"$meta": "textScore"}, "user_id": 1, "sender": 1, "message": 1, "timestamp": 1}
+        ).sort([("score", {"$meta": "textScore"}), ("timestamp", -1)]).skip((page - 1) * limit).limit(limit + 1)
+        docs = list(cursor)
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        user_ids = list({m["user_id"] for m in docs if m.get("user_id")})
+        emails = {u["_id"]: u["email"] for u in db.users.find({"_id": {"$in": user_ids}}, {"email": 1})} if user_ids else {}
+        results = [{
+            "time": m["timestamp"].strftime("%Y-%m-%d %H:%M"),
+            "sender": m["sender"],
+            "email": emails.get(m.get("user_id"), "Unknown"),
+            "message": m["message"],
+            "score": round(m.get("score", 0), 3)
+        } for m in docs]
+        return results, has_more
+    except: return [], False
 
 def delete_old_messages(db, days=7):
     """Deletes messages older than the specified number of days."""
@@ -307,6 +1192,7 @@ def delete_old_messages(db, days=7):
         from datetime import datetime, timedelta, timezone
         cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
         result = db.chats.delete_many({"timestamp": {"$lt": cutoff_date}})
+        bump_stats(db, messages=-result.deleted_count)  # Daily counts keep the history
         print(f"🧹 Cleanup: Deleted {result.deleted_count} messages older than {days} days.")
         return result.deleted_count
     except Exception as e:
@@ -345,8 +1231,10 @@ def admin_update_user(db, user_id, name, xp, level, sub, password=None):
 
         update_data = {"profile.display_name": name, "profile.xp": new_xp, "profile.level": new_level, "subscription": sub}
         if password:
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+            hashed = password_hasher.hash_password(password)
             update_data["hashed_password"] = hashed
-        db.users.update_one({"_id": ObjectId(user_id)}, {"$set": update_data})
+        before = db.users.find_one_and_update({"_id": ObjectId(user_id)}, {"$set": update_data}, projection={"profile.xp": 1})
+        invalidate_user(user_id)
+        if before: bump_stats(db, xp=new_xp - before.get("profile", {}).get("xp", 0))
         return True
     except: return False
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os
+import re
+import html
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from email.utils import formataddr
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# "brevo" (HTTP API) or "smtp"
+BACKEND = os.getenv("EMAIL_BACKEND", "brevo")
+BREVO_API_URL = os.getenv("BREVO_API_URL", "https://api.brevo.com/v3")  # Point at mock_brevo.py locally
+BREVO_BATCH_SIZE = int(os.getenv("BREVO_BATCH_SIZE", 1000))             # messageVersions per request
+HTTP_TIMEOUT_SECONDS = float(os.getenv("EMAIL_HTTP_TIMEOUT_SECONDS", 15))
+HTTP_POOL_SIZE = int(os.getenv("EMAIL_HTTP_POOL_SIZE", 16))
+HTTP_RETRIES = int(os.getenv("EMAIL_HTTP_RETRIES", 3))
+
+_PARAM_RE = re.compile(r"\{\{\s*params\.(\w+)\s*\}\}")
+
+
+def render_params(template, params):
+    """Local stand-in for Brevo's {{ params.x }} substitution (values are HTML-escaped)."""
+    return _PARAM_RE.sub(lambda m: html.escape(str(params.get(m.group(1), ""))), template)
+
+
+class BrevoTransport:
+    """
+    Brevo transactional API over one pooled requests.Session: connections are kept alive across
+    sends. Only failures where the request most likely wasn't processed (connect errors, 429,
+    gateway errors) are retried, with exponential backoff, so a retry shouldn't double-send.
+    """
+
+    def __init__(self, api_key, sender_email, base_url=BREVO_API_URL, timeout=HTTP_TIMEOUT_SECONDS):
+        self.api_key = api_key
+        self.sender_email = sender_email
+        self.url = base_url.rstrip("/") + "/smtp/email"
+        self.timeout = timeout
+        self.session = requests.Session()
+        # read=0/other=0: a POST that timed out or dropped mid-response may already have been sent
+        retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, other=0, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"accept": "application/json", "api-key": api_key or "", "content-type": "application/json"})
+
+    def _configured(self):
+        if self.api_key and self.sender_email: return True, ""
+        msg = "BREVO_API_KEY or BREVO_SENDER_EMAIL not configured"
+        print("⚠️", msg)
+        return False, msg
+
+    def _post(self, body):
+        try:
+            response = self.session.post(self.url, json=body, timeout=self.timeout)
+            return (response.status_code in (200, 201, 202)), response.text
+        except requests.RequestException as e:
+            return False, str(e)
+
+    def send(self, recipient_email, subject, html_content):
+        ok, msg = self._configured()
+        if not ok: return False, msg
+        return self._post({
+            "sender": {"email": self.sender_email},
+            "to": [{"email": recipient_email}],
+            "subject": subject,
+            "htmlContent": html_content
+        })
+
+    def send_batch(self, subject, html_template, recipients):
+        """
+        One personalised campaign: `html_template` may use {{ params.x }}, and each recipient is
+        {"email": ..., "params": {...}}. Sent as Brevo messageVersions, BREVO_BATCH_SIZE per request.
+        Returns one bool per recipient.
+        """
+        ok, _ = self._configured()
+        if not ok: return [False] * len(recipients)
+        results = []
+        for start in range(0, len(recipients), BREVO_BATCH_SIZE):
+            chunk = recipients[start:start + BREVO_BATCH_SIZE]
+            sent, info = self._post({
+                "sender": {"email": self.sender_email},
+                "subject": subject,
+                "htmlContent": html_template,
+                "messageVersions": [{"to": [{"email": r["email"]}], "params": r.get("params", {})} for r in chunk]
+            })
+            if not sent: print(f"Brevo batch of {len(chunk)} failed: {info}")
+            results.extend([sent] * len(chunk))
+        return results
+
+
+class SMTPTransport:
+    """Plain SMTP backend with the same interface; a batch reuses one connection."""
+
+    def __init__(self, host, port, username, password, sender_email, use_tls=True, timeout=HTTP_TIMEOUT_SECONDS):
+        self.host, self.port = host, port
+        self.username, self.password = username, password
+        self.sender_email = sender_email
+        self.use_tls = use_tls
+        self.timeout = timeout
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls: server.starttls()
+        if self.username: server.login(self.username, self.password)
+        return server
+
+    def _message(self, recipient_email, subject, html_content):
+        msg = MIMEText(html_content, "html", "utf-8")
+        msg["Subject"] = subject
+        msg["From"] = formataddr(("Friendix.ai", self.sender_email))
+        msg["To"] = recipient_email
+        return msg
+
+    def send(self, recipient_email, subject, html_content):
+        try:
+            with self._connect() as server:
+                server.sendmail(self.sender_email, [recipient_email], self._message(recipient_email, subject, html_content).as_string())
+            return True, "sent"
+        except (smtplib.SMTPException, OSError) as e:
+            return False, str(e)
+
+    def send_batch(self, subject, html_template, recipients):
+        results = []
+        try:
+            with self._connect() as server:
+                for r in recipients:
+                    try:
+                        body = render_params(html_template, r.get("params", {}))
+                        server.sendmail(self.sender_email, [r["email"]], self._message(r["email"], subject, body).as_string())
+                        results.append(True)
+                    except smtplib.SMTPRecipientsRefused:
+                        results.append(False)
+        except (smtplib.SMTPException, OSError) as e:
+            print(f"SMTP batch failed: {e}")
+        return results + [False] * (len(recipients) - len(results))
+
+
+_transport = None
+_lock = threading.Lock()
+
+def get_transport():
+    """Process-wide transport built from EMAIL_BACKEND and its settings."""
+    global _transport
+    if _transport is None:
+        with _lock:
+            if _transport is None:
+                sender = os.getenv("BREVO_SENDER_EMAIL")
+                if BACKEND == "smtp":
+                    _transport = SMTPTransport(
+                        os.getenv("SMTP_HOST", "localhost"), int(os.getenv("SMTP_PORT", 587)),
+                        os.getenv("SMTP_USERNAME"), os.getenv("SMTP_PASSWORD"),
+                        os.getenv("SMTP_SENDER_EMAIL", sender),
+                        use_tls=os.getenv("SMTP_USE_TLS", "true").lower() in ("1", "true", "yes")
+                    )
+                else:
+                    _transport = BrevoTransport(os.getenv("BREVO_API_KEY"), sender)
+    return _transport
@@ -0,0 +1,50 @@
+import re
+
+# Keyword -> emoji, per companion. Compiled once at import.
+DEFAULT_EMOJI_MAP = {
+    "love": "❤️", "happy": "😊", "sad": "😥", "laugh": "😂", "smile": "😄", "cry": "😢",
+    "miss you": "🥺", "kiss": "😘", "hug": "🤗", "think": "🤔", "sweet": "🥰", "blush": "😊",
+    "heart": "❤️", "star": "⭐", "yay": "🎉", "oh no": "😟", "sorry": "😔", "please": "🙏",
+    "hi": "👋", "hello": "👋", "bye": "👋", "good night": "😴", "sleep": "😴", "dream": "💭"
+}
+
+COMPANION_EMOJI_MAPS = {
+    "luvisa": DEFAULT_EMOJI_MAP,
+    "victor": DEFAULT_EMOJI_MAP,
+    "coder": {},  # code replies are left untouched
+}
+
+
+class EmojiInjector:
+    """Adds an emoji after the first occurrence of each keyword, in one regex scan."""
+
+    def __init__(self, emoji_map):
+        self.emoji_map = {k.lower(): v for k, v in emoji_map.items()}
+        # Longest first so multi-word keywords win over any shorter prefix
+        alternation = "|".join(re.escape(k) for k in sorted(self.emoji_map, key=len, reverse=True))
+        self.pattern = re.compile(r"\b(?:" + alternation + r")\b", re.IGNORECASE) if self.emoji_map else None
+
+    def inject(self, text):
+        if not isinstance(text, str): text = str(text)
+        if self.pattern is None: return text
+        seen = set()
+        parts = []
+        last = 0
+        for match in self.pattern.finditer(text):
+            key = match.group(0).lower()
+            if key in seen: continue
+            seen.add(key)
+            parts.append(text[last:match.end()])
+            parts.append(" " + self.emoji_map[key])
+            last = match.end()
+            if len(seen) == len(self.emoji_map): break  # nothing left to insert
+        if not parts: return text
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+_injectors = {companion: EmojiInjector(emoji_map) for companion, emoji_map in COMPANION_EMOJI_MAPS.items()}
+_default_injector = _injectors["luvisa"]
+
+def add_emojis(text, companion_id="luvisa"):
+    return _injectors.get(companion_id, _default_injector).inject(text)
@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import time
+import codecs
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from pypdf import PdfReader
+from docx import Document
+
+# Per-file and per-message caps on extracted text (~4 chars per token).
+FILE_MAX_CHARS = int(os.getenv("FILE_MAX_CHARS", 24000))
+TOTAL_MAX_CHARS = int(os.getenv("FILE_CONTEXT_MAX_CHARS", 48000))
+FILE_MAX_BYTES = int(os.getenv("FILE_MAX_BYTES", 25 * 1024 * 1024))
+CACHE_ENTRIES = int(os.getenv("FILE_CACHE_ENTRIES", 128))
+READ_CHUNK_BYTES = 64 * 1024
+
+# PDF/Word parsing is CPU-bound and runs in a shared process pool, isolated from the web worker.
+POOL_WORKERS = int(os.getenv("FILE_WORKERS", max(2, min(4, os.cpu_count() or 1))))
+EXTRACT_TIMEOUT_SECONDS = float(os.getenv("FILE_EXTRACT_TIMEOUT_SECONDS", 20))
+WORKER_MEMORY_MB = int(os.getenv("FILE_WORKER_MEMORY_MB", 512))
+POOLED_EXTENSIONS = ('.pdf', '.doc', '.docx')
+
+_cache = OrderedDict()  # (sha256, ext, max_chars) -> (text, truncated)
+_cache_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# -----------------------
+# Extraction (runs in the pool for PDF/Word, inline for text)
+# -----------------------
+def iter_text_chunks(stream, file_ext):
+    """Yields text a page (PDF), a paragraph (Word) or a read-chunk (text/code) at a time."""
+    if file_ext == '.pdf':
+        for page in PdfReader(stream).pages:
+            yield (page.extract_text() or "") + "\n"
+    elif file_ext in ['.doc', '.docx']:
+        for para in Document(stream).paragraphs:
+            yield para.text + "\n"
+    else:
+        yield from _iter_decoded(stream)
+
+class _NotUtf8(Exception):
+    pass
+
+def _iter_decoded(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for block in iter(lambda: stream.read(READ_CHUNK_BYTES), b""):
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        # Not UTF-8: start over as latin-1 (the caller discards what it has so far)
+        raise _NotUtf8()
+
+def _collect(chunks, max_chars):
+    parts, size = [], 0
+    for chunk in chunks:
+        if size + len(chunk) >= max_chars:
+            parts.append(chunk[:max_chars - size])
+            return "".join(parts), True  # stop pulling pages/chunks once the budget is spent
+        parts.append(chunk)
+        size += len(chunk)
+    return "".join(parts), False
+
+def extract_bytes(data, file_ext, max_chars=FILE_MAX_CHARS):
+    """Returns (text, truncated). Extraction stops as soon as `max_chars` is reached."""
+    stream = io.BytesIO(data)
+    try:
+        return _collect(iter_text_chunks(stream, file_ext), max_chars)
+    except _NotUtf8:
+        stream.seek(0)
+        latin = (block.decode('latin-1') for block in iter(lambda: stream.read(READ_CHUNK_BYTES), b""))
+        return _collect(latin, max_chars)
+
+
+# -----------------------
+# Process pool
+# -----------------------
+def _limit_worker_memory():
+    """Pool initializer: caps the worker's address space so a hostile file fails with MemoryError."""
+    try:
+        import resource
+        limit = WORKER_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass  # Not supported on this platform
+
+def _new_pool(workers):
+    # forkserver: workers start from a clean process, not a fork of the (gevent, MongoClient) web worker
+    method = "forkserver" if sys.platform.startswith("linux") else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method), initializer=_limit_worker_memory)
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(POOL_WORKERS)
+        return _pool
+
+def _kill_pool(pool):
+    # concurrent.futures has no public way to stop a running task, so terminate the workers directly.
+    # _processes is None once the pool has been shut down (e.g. by another request's reset).
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _reset_pool(pool):
+    """Kills a pool with a stuck or crashed worker; the next call starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is not pool: return  # Already replaced by another request
+        _pool = None
+    _kill_pool(pool)
+
+def _extract_isolated(data, file_ext, max_chars):
+    """
+    Retry path for files whose shared-pool task died with the pool (another upload's timeout or
+    crash, or their own). Each runs in a single-use one-worker pool, so a file that really does
+    hang or crash the worker fails alone instead of taking other requests down with it.
+    """
+    pool = _new_pool(1)
+    try:
+        return pool.submit(extract_bytes, data, file_ext, max_chars).result(timeout=EXTRACT_TIMEOUT_SECONDS)
+    finally:
+        _kill_pool(pool)
+
+
+# -----------------------
+# Public API
+# -----------------------
+def _read_upload(stream):
+    stream.seek(0)
+    data = stream.read(FILE_MAX_BYTES + 1)
+    stream.seek(0)
+    return data
+
+def extract_many(uploads, max_chars=FILE_MAX_CHARS):
+    """
+    uploads: [(stream, file_ext)]. Returns [(text, truncated, error)] in the same order,
+    where error is None, "too_large", "timeout" or "error".
+    Cached by content hash; PDF/Word files are parsed in parallel in the process pool.
+    """
+    results = [None] * len(uploads)
+    pending = []  # (index, cache key, future, deadline)
+    pool = None
+
+    for i, (stream, file_ext) in enumerate(uploads):
+        data = _read_upload(stream)
+        if len(data) > FILE_MAX_BYTES:
+            results[i] = ("", False, "too_large")
+            continue
+        key = (hashlib.sha256(data).hexdigest(), file_ext, max_chars)
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+                results[i] = _cache[key] + (None,)
+                continue
+        if file_ext in POOLED_EXTENSIONS:
+            pool = pool or _get_pool()
+            pending.append((i, key, data, file_ext, pool.submit(extract_bytes, data, file_ext, max_chars), time.monotonic() + EXTRACT_TIMEOUT_SECONDS))
+        else:
+            try:
+                results[i] = _remember(key, extract_bytes(data, file_ext, max_chars)) + (None,)
+            except Exception as e:
+                print(f"File extraction error: {e}")
+                results[i] = ("", False, "error")
+
+    stuck, retry = False, []
+    for i, key, data, file_ext, future, deadline in pending:
+        try:
+            results[i] = _remember(key, future.result(timeout=max(deadline - time.monotonic(), 0))) + (None,)
+        except FutureTimeout:
+            results[i] = ("", False, "timeout")
+            stuck = True
+        except BrokenProcessPool:
+            retry.append((i, key, data, file_ext))
+        except Exception as e:
+            print(f"File extraction error: {e}")
+            results[i] = ("", False, "error")
+    # One of ours is stuck, or the pool died under us: replace it. Tasks lost with it (ours, or
+    # other requests' that were running alongside) get one isolated retry.
+    if stuck or retry: _reset_pool(pool)
+    for i, key, data, file_ext in retry:
+        try:
+            results[i] = _remember(key, _extract_isolated(data, file_ext, max_chars)) + (None,)
+        except FutureTimeout:
+            results[i] = ("", False, "timeout")
+        except Exception as e:
+            print(f"File extraction error: {e}")
+            results[i] = ("", False, "error")
+    return results
+
+def _remember(key, result):
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return result
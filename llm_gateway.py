@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+from groq import Groq
+
+# Per-API-key limit on concurrent upstream calls, and how long a call may queue for a slot.
+# Under the gevent worker (see Procfile) these semaphores are cooperative, so queued calls
+# wait without holding an OS thread.
+MAX_IN_FLIGHT_PER_KEY = int(os.getenv("LLM_MAX_IN_FLIGHT_PER_KEY", 32))
+QUEUE_DEADLINE_SECONDS = float(os.getenv("LLM_QUEUE_DEADLINE_SECONDS", 15))
+
+
+class GatewayBusy(Exception):
+    """Raised when no upstream slot frees up before the queue deadline."""
+
+
+class GatedClient:
+    """
+    Wraps a Groq client so every chat completion first takes a slot from a
+    semaphore shared by all callers of the same API key.
+    Exposes the same `client.chat.completions.create(...)` call as the SDK.
+    """
+
+    def __init__(self, api_key, max_in_flight=MAX_IN_FLIGHT_PER_KEY, deadline=QUEUE_DEADLINE_SECONDS):
+        self._client = Groq(api_key=api_key)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.chat = self  # client.chat.completions.create(...)
+        self.completions = self
+
+    def _acquire(self):
+        started = time.monotonic()
+        with self._lock: self.waiting += 1
+        got = self._slots.acquire(timeout=self.deadline)
+        with self._lock:
+            self.waiting -= 1
+            self.total_wait += time.monotonic() - started
+            if not got:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+        if not got:
+            raise GatewayBusy(f"No LLM slot free within {self.deadline}s")
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def create(self, **params):
+        if params.get("stream"):
+            return self._stream(params)
+        self._acquire()
+        try:
+            return self._client.chat.completions.create(**params)
+        finally:
+            self._release()
+
+    def _stream(self, params):
+        # The slot is held until the stream is exhausted or closed
+        self._acquire()
+        try:
+            for chunk in self._client.chat.completions.create(**params):
+                yield chunk
+        finally:
+            self._release()
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.rejected
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.total_wait / finished * 1000, 1) if finished else 0.0
+            }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key):
+    """Returns the shared GatedClient for an API key (one pool per key, however many companions use it)."""
+    if not api_key: return None
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = GatedClient(api_key)
+        return _clients[api_key]
+
+def stats():
+    """Pool stats keyed by the last 4 chars of each API key."""
+    with _clients_lock:
+        return {f"...{key[-4:]}": client.stats() for key, client in _clients.items()}
@@ -1,38 +1,44 @@
 import os
 import time
+import queue
 import random
 import base64
 import json
 import secrets
-import requests
 from datetime import datetime, timezone, timedelta 
 import hashlib 
-from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
-import bcrypt
-import re
+import password_hasher
 import traceback
 import mimetypes
 from io import BytesIO
-from pypdf import PdfReader
-from docx import Document
+import file_ingest
 from admin_routes import admin_bp
 
 # --- APScheduler Imports ---
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
 
-# Groq client
-from groq import Groq
+# Groq client (bounded per-key pool)
+import llm_gateway
+import response_cache
+import prompt_builder
+import summarizer
+import background
+import emoji_injector
+import email_transport
+import together_hub
+import otp_store as otp_backends
 # UPDATED: Use a valid, high-performance model default
 GROQ_MODEL = os.getenv("GROQ_MODEL", "openai/gpt-oss-120b")
+GROQ_PROMPT_BUDGET = prompt_builder.DEFAULT_BUDGET  # Input tokens per request for GROQ_MODEL
 
-# Email provider (Brevo / SendinBlue)
-BREVO_API_KEY = os.getenv("BREVO_API_KEY")
-BREVO_SENDER_EMAIL = os.getenv("BREVO_SENDER_EMAIL")
+# Email provider: see email_transport (EMAIL_BACKEND=brevo|smtp, BREVO_API_KEY, BREVO_SENDER_EMAIL)
 
 # Firebase (best-effort initialization)
 import firebase_admin
@@ -94,7 +100,7 @@ def get_groq_client():
         print("⚠️ GROQ_API_KEY not set; AI features will be limited.")
         return None
     try:
-        _groq_client = Groq(api_key=key)
+        _groq_client = llm_gateway.get_client(key)
         print("✅ Groq client initialized.")
         return _groq_client
     except Exception as e:
@@ -133,12 +139,28 @@ try:
     db = database.get_db()
     if db is None:
         print("⚠️ database.get_db() returned None")
+    else:
+        database.ensure_indexes(db)
+        for coll_name, name, expected, actual in database.check_ttl_indexes(db):
+            print(f"⚠️ TTL index {coll_name}.{name} expected {expected}s, found {actual}; expired docs won't be reaped.")
+        database.seed_friend_id_counter(db)
+        database.ensure_stats(db)
         
 except Exception as e:
     print("🔥 Database initialization error:", e)
     db = None
 
 
+# -----------------------
+# Chat history windows (messages sent to the model per companion)
+# -----------------------
+LUVISA_HISTORY_WINDOW = 60
+CODER_HISTORY_WINDOW = 10
+COACH_HISTORY_WINDOW = 20
+CHAT_HISTORY_PAGE_SIZE = 100
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+
+
 # -----------------------
 # XP / Leveling Logic
 # -----------------------
@@ -151,12 +173,31 @@ def calculate_level(xp):
     return 5 + (xp - 800) // 500 # Simple scaling after lvl 5
 
 
+# -----------------------
+# Deferred writes (see background.py)
+# -----------------------
+# Chat messages are not deferred: they are the conversation itself, and a queued write would be
+# lost if the worker died before the flush. Only XP (below) goes through the batched queue.
+
+def _apply_xp_batch(items):
+    increments = {}
+    for user_id, base_xp in items:
+        count, base = increments.get(user_id, (0, base_xp))
+        increments[user_id] = (count + 1, max(base, base_xp))
+    database.bulk_increment_xp(db, {uid: (n, calculate_level(base + n)) for uid, (n, base) in increments.items()})
+
+def queue_xp_gain(user_doc):
+    """+1 XP per message; the level is raised to match in the same batched write."""
+    background.submit_batched(_apply_xp_batch, (user_doc["_id"], user_doc.get("profile", {}).get("xp", 0)))
+
+
 # -----------------------
 # OTP stores
 # -----------------------
-otp_store = {}
-OTP_EXPIRY_SECONDS = 5 * 60
-reset_otp_store = {}
+# Backend from OTP_STORE_BACKEND (memory | local | mongo); defaults to Mongo so every worker sees the same codes.
+OTP_EXPIRY_SECONDS = otp_backends.OTP_EXPIRY_SECONDS
+otp_store = otp_backends.create_store("signup", db)
+reset_otp_store = otp_backends.create_store("reset", db)
 
 # -----------------------
 # Helpers
@@ -168,27 +209,11 @@ def _generate_otp():
 def _store_otp(store, email, otp=None):
     if otp is None:
         otp = _generate_otp()
-    store[email] = {"otp": otp, "ts": int(time.time())}
-    return otp
-
-
-def _is_otp_valid_in_store(store, email, otp_value, expiry_seconds=OTP_EXPIRY_SECONDS):
-    rec = store.get(email)
-    if not rec:
-        return False, "No OTP found."
-    if "ts" in rec:
-        age = int(time.time()) - rec["ts"]
-        if age > expiry_seconds:
-            store.pop(email, None)
-            return False, "OTP expired."
-    if "expires" in rec:
-        if int(time.time()) > rec["expires"]:
-            store.pop(email, None)
-            return False, "OTP expired."
-    if str(rec.get("otp")) == str(otp_value).strip():
-        store.pop(email, None)
-        return True, "OTP valid."
-    return False, "Invalid OTP."
+    return store.put(email, otp)
+
+
+def _is_otp_valid_in_store(store, email, otp_value):
+    return store.consume(email, otp_value)
 
 def get_or_create_sequential_data(db, user_doc):
     try:
@@ -201,47 +226,10 @@ def get_or_create_sequential_data(db, user_doc):
                 "is_early_user": profile.get("is_early_user", False)
             }
 
-        print(f"No permanent ID found for {user_doc['email']}. Generating one...")
-        all_users_cursor = db["users"].find({}, ["_id", "created_at"]).sort("created_at", 1)
-        sorted_users_ids = [user["_id"] for user in all_users_cursor]
-        
-        current_user_id = user_doc.get("_id")
-        try:
-            user_index = sorted_users_ids.index(current_user_id)
-            sequential_number = user_index + 1 
-        except ValueError:
-            sequential_number = 0 
-
-        is_early = (sequential_number <= 99) and (sequential_number > 0)
-        six_digit_id = f"{sequential_number:06d}"
-
-        creation_time = user_doc.get("created_at")
-        if creation_time:
-            creation_year = creation_time.year
-        else:
-            creation_year = user_doc.get("_id").generation_time.year
-
-        formatted_id = f"FRD-{six_digit_id}"
-        
-        db["users"].update_one(
-            {"_id": current_user_id},
-            {
-                "$set": {
-                    "profile.creation_year": creation_year,
-                    "profile.friend_id": formatted_id,
-                    "profile.friend_id_number": six_digit_id,
-                    "profile.is_early_user": is_early 
-                }
-            }
-        )
-        print(f"Saved new ID {formatted_id} for user. Early user: {is_early}")
-
-        return {
-            "creation_year": creation_year,
-            "friend_id": formatted_id,
-            "friend_id_number": six_digit_id,
-            "is_early_user": is_early
-        }
+        print(f"No permanent ID found for {user_doc['email']}. Assigning one...")
+        fields = database.assign_friend_id(db, user_doc)
+        print(f"Saved new ID {fields['friend_id']} for user. Early user: {fields['is_early_user']}")
+        return fields
     except Exception as e:
         print(f"🔥 Error in get_or_create_sequential_data: {e}")
         _id = user_doc.get("_id")
@@ -259,21 +247,11 @@ def get_or_create_sequential_data(db, user_doc):
 
 
 # -----------------------
-# Send OTP via Brevo (SendinBlue)
+# Send OTP email (Brevo or SMTP via email_transport)
 # -----------------------
 def send_otp_email(recipient_email, otp):
     try:
-        if not BREVO_API_KEY or not BREVO_SENDER_EMAIL:
-            msg = "BREVO_API_KEY or BREVO_SENDER_EMAIL not configured"
-            print("⚠️", msg)
-            return False, msg
-
-        url = "https://api.brevo.com/v3/smtp/email"
-        body = {
-            "sender": {"email": BREVO_SENDER_EMAIL},
-            "to": [{"email": recipient_email}],
-            "subject": "Your Friendix.ai OTP Code 💖",
-            "htmlContent": f"""
+        html_content = f"""
                 <div style="font-family: Arial, sans-serif; padding: 20px; color: #333; line-height: 1.5;">
         <h2 style="text-align:center;">Dear User,</h2>
 
@@ -301,46 +279,21 @@ def send_otp_email(recipient_email, otp):
         </p>
     </div>
     """
-        }
-        headers = {
-            "accept": "application/json",
-            "api-key": BREVO_API_KEY,
-            "content-type": "application/json"
-        }
-
-        response = requests.post(url, json=body, headers=headers, timeout=15)
-        print("Brevo send status:", response.status_code, response.text)
-        return (response.status_code in (200, 201, 202)), response.text
+        ok, info = email_transport.get_transport().send(recipient_email, "Your Friendix.ai OTP Code 💖", html_content)
+        print("OTP email sent:" if ok else "OTP email failed:", info)
+        return ok, info
     except Exception as e:
-        print("Brevo send exception:", e)
+        print("Email send exception:", e)
         return False, str(e)
 
 
 def send_brevo_email(recipient_email, subject_line, html_content):
     try:
-        if not BREVO_API_KEY or not BREVO_SENDER_EMAIL:
-            msg = "BREVO_API_KEY or BREVO_SENDER_EMAIL not configured"
-            print("⚠️", msg)
-            return False, msg
-
-        url = "https://api.brevo.com/v3/smtp/email"
-        body = {
-            "sender": {"email": BREVO_SENDER_EMAIL},
-            "to": [{"email": recipient_email}],
-            "subject": subject_line,
-            "htmlContent": html_content
-        }
-        headers = {
-            "accept": "application/json",
-            "api-key": BREVO_API_KEY,
-            "content-type": "application/json"
-        }
-
-        response = requests.post(url, json=body, headers=headers, timeout=15)
-        print(f"Brevo send status for {recipient_email}: {response.status_code}")
-        return (response.status_code in (200, 201, 202)), response.text
+        ok, info = email_transport.get_transport().send(recipient_email, subject_line, html_content)
+        print(f"Email send for {recipient_email}: {'ok' if ok else info}")
+        return ok, info
     except Exception as e:
-        print(f"Brevo send exception for {recipient_email}: {e}")
+        print(f"Email send exception for {recipient_email}: {e}")
         return False, str(e)
 
 
@@ -361,6 +314,10 @@ def api_send_otp():
     except Exception as e:
         print("Error checking existing user for OTP:", e)
 
+    allowed, retry_after = otp_store.allow_send(email)
+    if not allowed:
+        return jsonify({"success": False, "message": f"Too many OTP requests. Try again in {retry_after}s."}), 429
+
     otp = _store_otp(otp_store, email)
     ok, info = send_otp_email(email, otp)
     if ok:
@@ -403,6 +360,11 @@ def api_check_email():
         return jsonify({"exists": False}), 500
 
 
+def _hasher_busy_response():
+    # bcrypt slots are all taken (see password_hasher); the client should back off and retry
+    return jsonify({"success": False, "message": "Too many logins right now, please retry."}), 503
+
+
 # -----------------------
 # API: Signup after OTP verified
 # -----------------------
@@ -423,7 +385,7 @@ def api_signup_verified():
         print("Signup check error:", e)
         return jsonify({"success": False, "message": "Database validation error"}), 500
 
-    if email in otp_store:
+    if otp_store.pending(email):
         return jsonify({"success": False, "message": "OTP not verified yet."}), 403
 
     try:
@@ -437,6 +399,8 @@ def api_signup_verified():
         if user_id is None:
             return jsonify({"success": False, "message": "User already exists."}), 409
             
+    except password_hasher.HasherBusy:
+        return _hasher_busy_response()
     except Exception as e:
         print("Signup DB error:", e)
         return jsonify({"success": False, "message": "Database error during signup."}), 500
@@ -455,6 +419,22 @@ def api_signup_verified():
 # --- STREAK & ABSENCE LOGIC ---
 # -----------------------
 def update_user_stats_on_login(db, user_doc, now):
+    # user_doc may come from the per-worker cache. The write only applies if last_active is still
+    # what we read; otherwise re-read the user from Mongo and recompute once.
+    for attempt in range(2):
+        try:
+            result = _apply_login_stats(db, user_doc, now)
+        except Exception as e:
+            print(f"Warning: Could not update stats/streak for user: {e}")
+            return 0, False
+        if result is not None: return result
+        database.invalidate_user(user_doc["_id"])
+        user_doc = database.get_user_by_id(db, user_doc["_id"])
+        if not user_doc: break
+    return 0, False
+
+def _apply_login_stats(db, user_doc, now):
+    """Returns (xp_gained, is_new_day), or None if user_doc was stale."""
     profile = user_doc.get("profile", {})
     current_xp = profile.get("xp", 0)
     last_active = profile.get("last_active")
@@ -487,27 +467,23 @@ def update_user_stats_on_login(db, user_doc, now):
     if is_new_day:
         xp_gained = 10
         current_xp += xp_gained
-        new_level = calculate_level(current_xp)
-    else:
-        new_level = profile.get("level", 1)
-
-    try:
-        db.users.update_one(
-            {"_id": user_doc["_id"]}, 
-            {"$set": {
-                "profile.last_active": now,
-                "profile.daily_msg_sent": False, # Reset trigger
-                "profile.reengagement_level": 0,
-                "profile.streak": streak_update,
-                "profile.last_absence_duration": absence_duration_days,
-                "profile.last_xp_login": now if is_new_day else profile.get("last_xp_login"),
-                "profile.xp": current_xp,
-                "profile.level": new_level
-            }}
-        )
-    except Exception as e:
-        print(f"Warning: Could not update stats/streak for user: {e}")
+    # current_xp may lag writes made elsewhere, so this level is only a floor ($max)
+    new_level = calculate_level(current_xp)
+
+    fields = {
+        "profile.last_active": now,
+        "profile.daily_msg_sent": False, # Reset trigger
+        "profile.reengagement_level": 0,
+        "profile.streak": streak_update,
+        "profile.last_absence_duration": absence_duration_days,
+    }
+    if is_new_day: fields["profile.last_xp_login"] = now
+    updated = database.apply_login_update(db, user_doc["_id"], last_active, fields, xp=xp_gained, level=new_level)
+    if updated is None: return None
 
+    # XP is added with $inc, so the stored total can be higher than ours; level up from the real one
+    actual_level = calculate_level(updated.get("profile", {}).get("xp", 0))
+    if actual_level > updated.get("profile", {}).get("level", 1): database.raise_user_level(db, user_doc["_id"], actual_level)
     return xp_gained, is_new_day
 
 # -----------------------
@@ -526,16 +502,7 @@ def api_login():
         if not user_doc:
             return jsonify({"success": False, "message": "User not found"}), 404
 
-        if hasattr(database, "check_user_password"):
-            ok = database.check_user_password(user_doc, password)
-        else:
-            ok = False
-            hp = user_doc.get("hashed_password") or user_doc.get("password")
-            if hp:
-                try:
-                    ok = bcrypt.checkpw(password.encode("utf-8"), hp) if isinstance(hp, bytes) else bcrypt.checkpw(password.encode("utf-8"), hp.encode("utf-8"))
-                except Exception:
-                    ok = False
+        ok = database.check_user_password(user_doc, password, db=db)
 
         if ok:
             now = datetime.now(timezone.utc)
@@ -550,6 +517,8 @@ def api_login():
         else:
             return jsonify({"success": False, "message": "Invalid password"}), 401
 
+    except password_hasher.HasherBusy:
+        return _hasher_busy_response()
     except Exception as e:
         print("Login error:", e)
         return jsonify({"success": False, "message": "Error during login."}), 500
@@ -588,11 +557,12 @@ def api_request_reset():
     if not email:
         return jsonify({"success": False, "message": "Email required"}), 400
 
+    allowed, retry_after = reset_otp_store.allow_send(email)
+    if not allowed:
+        return jsonify({"success": False, "message": f"Too many OTP requests. Try again in {retry_after}s."}), 429
+
     try:
-        otp = "%06d" % random.randint(0, 999999)
-        expires_at = int(time.time()) + OTP_EXPIRY_SECONDS
-        pr = db["password_resets"]
-        pr.update_one({"email": email}, {"$set": {"email": email, "otp": str(otp), "expires_at": expires_at, "verified": False}}, upsert=True)
+        otp = _store_otp(reset_otp_store, email)
 
         try:
             ok, info = send_otp_email(email, otp)
@@ -619,15 +589,17 @@ def api_verify_reset_otp():
         return jsonify({"success": False, "message": "Email and OTP required"}), 400
 
     try:
-        pr = db["password_resets"]
-        now = int(time.time())
-        entry = pr.find_one({"email": email, "otp": str(otp), "expires_at": {"$gt": now}})
-        if not entry:
+        valid, _ = _is_otp_valid_in_store(reset_otp_store, email, otp)
+        if not valid:
             return jsonify({"success": False, "message": "Invalid or expired OTP"}), 403
 
+        # The code is consumed; from here on the reset is authorised by this token.
+        pr = db["password_resets"]
+        now = int(time.time())
         token = secrets.token_urlsafe(32)
         token_expires = now + 10 * 60
-        pr.update_one({"_id": entry["_id"]}, {"$set": {"verified": True, "token": token, "token_expires": token_expires}})
+        # expire_at drives the TTL index; token_expires is what api_update_password compares.
+        pr.update_one({"email": email}, {"$set": {"email": email, "verified": True, "token": token, "token_expires": token_expires, "expire_at": datetime.fromtimestamp(token_expires, timezone.utc)}}, upsert=True)
 
         # NOTE: Returning the generated token. Client should use this token to reset password.
         return jsonify({"success": True, "token": token}), 200
@@ -657,18 +629,12 @@ def api_update_password():
         if not entry:
             return jsonify({"success": False, "message": "Invalid or expired token"}), 403
 
-        hashed = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt())
-
-        if hasattr(database, "update_user_password"):
-            ok = database.update_user_password(db, email, new_password)
-            if not ok:
-                db["users"].update_one({"email": email}, {"$set": {"password": hashed}})
-        else:
-            db["users"].update_one({"email": email}, {"$set": {"password": hashed}})
-
+        database.set_user_password(db, email, new_password)
         pr.delete_many({"email": email})
 
         return jsonify({"success": True, "message": "Password updated successfully"}), 200
+    except password_hasher.HasherBusy:
+        return _hasher_busy_response()
     except Exception as e:
         print("Exception in update_password:", e)
         return jsonify({"success": False, "message": "Server error"}), 500
@@ -772,121 +738,147 @@ def get_email_templates(level, user_name):
 
     return subject, base_html.replace("{{content}}", content).replace("{{cta}}", cta)
 
-def send_reengagement_email(db, user_doc, level):
+def send_reengagement_batch(level, users):
+    """Sends one level's email to many users as a single personalised batch. Returns one bool per user."""
     try:
-        email = user_doc.get("email")
-        name = user_doc.get("profile", {}).get("display_name", "Friend")
-        
-        subject, html_content = get_email_templates(level, name)
-        
-        print(f"📧 Sending Level {level} email to {email}")
-        ok, msg = send_brevo_email(email, subject, html_content)
-        
-        if ok:
-            db.users.update_one(
-                {"_id": user_doc["_id"]},
-                {"$set": {
-                    "profile.last_reengagement_sent": datetime.now(timezone.utc),
-                    "profile.reengagement_level": level
-                }}
-            )
-            return True
-        return False
+        subject, html_template = get_email_templates(level, "{{ params.name }}")
+        recipients = [{"email": u["email"], "params": {"name": u.get("profile", {}).get("display_name", "Friend")}} for u in users]
+        print(f"📧 Sending Level {level} email to {len(recipients)} user(s)")
+        return email_transport.get_transport().send_batch(subject, html_template, recipients)
     except Exception as e:
         print(f"Error sending reengagement mail: {e}")
-        return False
+        return [False] * len(users)
+
+# Re-engagement ladder: (days inactive, level), highest first. Trigger monthly after the first month.
+REENGAGEMENT_LEVELS = [(365, 8), (180, 7), (90, 6), (60, 5), (28, 4), (21, 3), (14, 2), (7, 1)]
+DAILY_MISS_YOU_MESSAGE = "I haven't seen you in a while! Come back and chat with me soon. 💕"
+INACTIVITY_JOB = "inactive_users"
+INACTIVITY_BATCH_SIZE = int(os.getenv("INACTIVITY_BATCH_SIZE", 1000))
+INACTIVITY_EMAIL_WORKERS = int(os.getenv("INACTIVITY_EMAIL_WORKERS", 8))  # Concurrent level batches
+INACTIVITY_LEASE_SECONDS = 15 * 60      # Renewed after every batch
+INACTIVITY_MIN_INTERVAL_SECONDS = 20 * 3600
+
+def _as_utc(value):
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+def _reengagement_level(days_inactive):
+    for days, level in REENGAGEMENT_LEVELS:
+        if days_inactive >= days: return level
+    return 0
+
+def _reengagement_due(profile, level, now):
+    """Cooldown: only upgrade the level, and leave a gap since the last email."""
+    last_sent = profile.get("last_reengagement_sent")
+    if not last_sent: return True
+    if level <= profile.get("reengagement_level", 0): return False
+    # For early levels (weeks), 6 days gap is fine. For later levels (months), at least 25 days.
+    gap_needed = 6 if level <= 4 else 25
+    return (now - _as_utc(last_sent)).days >= gap_needed
+
+def _process_inactive_batch(users, now, email_pool):
+    """
+    Handles one cursor batch with two bulk_writes plus one email batch per level (sent in parallel). Flags are written before
+    anything is sent, so the users collection doubles as the checkpoint: after a crash the next
+    run's server-side filter no longer matches these users and nothing is sent twice. Emails
+    that fail are un-flagged afterwards so a later run retries them.
+    """
+    daily_ops, daily_ids, daily_docs = [], [], []
+    claim_ops, claimed = [], []
+    for user in users:
+        profile = user.get("profile", {})
+        ref_date = profile.get("last_active") or user.get("created_at")
+        if not ref_date: continue
+        days_inactive = (now - _as_utc(ref_date)).days
+
+        if days_inactive >= 1 and not profile.get("daily_msg_sent", False):
+            daily_ops.append(UpdateOne({"_id": user["_id"], "profile.daily_msg_sent": {"$ne": True}}, {"$set": {"profile.daily_msg_sent": True}}))
+            daily_ids.append(user["_id"])
+            daily_docs.append(database.build_chat_doc(user["_id"], "luvisa", DAILY_MISS_YOU_MESSAGE, now))
+
+        level = _reengagement_level(days_inactive)
+        if level and user.get("email") and _reengagement_due(profile, level, now):
+            claim_ops.append(UpdateOne(
+                {"_id": user["_id"], "profile.reengagement_level": {"$not": {"$gte": level}}},
+                {"$set": {"profile.last_reengagement_sent": now, "profile.reengagement_level": level}}
+            ))
+            claimed.append((user, level))
+
+    if daily_ops:
+        database.bulk_update_users(db, daily_ops, daily_ids)
+        database.insert_chat_docs(db, daily_docs)
+    if claim_ops:
+        database.bulk_update_users(db, claim_ops, [user["_id"] for user, _ in claimed])
+
+    by_level = {}
+    for user, level in claimed: by_level.setdefault(level, []).append(user)
+    groups = list(by_level.items())
+    failed = []
+    for (level, group), results in zip(groups, email_pool.map(lambda g: send_reengagement_batch(*g), groups)):
+        failed.extend(user for user, ok in zip(group, results) if not ok)
+    revert_ops = []
+    for user in failed:
+        profile = user.get("profile", {})
+        previous = {"profile.reengagement_level": profile.get("reengagement_level", 0)}
+        update = {"$set": previous}
+        if profile.get("last_reengagement_sent"): previous["profile.last_reengagement_sent"] = profile["last_reengagement_sent"]
+        else: update["$unset"] = {"profile.last_reengagement_sent": ""}
+        revert_ops.append(UpdateOne({"_id": user["_id"], "profile.last_reengagement_sent": now}, update))
+    database.bulk_update_users(db, revert_ops, [user["_id"] for user in failed])
+
+    return {"daily": len(daily_ops), "emails": len(claimed) - len(failed), "email_failures": len(failed)}
 
 def check_for_inactive_users():
     print("⏰ Checking for inactive users...")
+    if db is None:
+        print("⚠️ Job DB connection failed.")
+        return
+
+    owner = f"{os.getpid()}-{secrets.token_hex(4)}"
     try:
-        job_db = database.get_db()
-        if job_db is None: 
-            print("⚠️ Job DB connection failed.")
+        if not database.claim_job(db, INACTIVITY_JOB, owner, INACTIVITY_LEASE_SECONDS, INACTIVITY_MIN_INTERVAL_SECONDS):
+            print("⏭️ Inactivity check already running or done recently; skipping.")
             return
 
-        users = job_db.users.find({})
         now = datetime.now(timezone.utc)
-        
-        count = 0
-        for user in users:
-            try:
-                profile = user.get("profile", {})
-                last_active = profile.get("last_active")
-                created_at = user.get("created_at")
-                
-                # Fallback to creation date if never active
-                ref_date = last_active if last_active else created_at
-                
-                if not ref_date: continue
-                
-                # Ensure TZ aware
-                if ref_date.tzinfo is None: ref_date = ref_date.replace(tzinfo=timezone.utc)
-                
-                days_inactive = (now - ref_date).days
-                
-                # --- NEW: Check for 24h inactivity message ---
-                if days_inactive >= 1:
-                    already_sent_daily = profile.get("daily_msg_sent", False)
-                    if not already_sent_daily:
-                        try:
-                            msg_content = "I haven't seen you in a while! Come back and chat with me soon. 💕"
-                            database.add_message_to_history(job_db, user["_id"], "luvisa", msg_content, datetime.now(timezone.utc))
-                            job_db.users.update_one(
-                                {"_id": user["_id"]}, 
-                                {"$set": {"profile.daily_msg_sent": True}}
-                            )
-                            # count += 1 # Optional: count this action?
-                            print(f"Sent 24h miss-you message to {user.get('email')}")
-                        except Exception as e_daily:
-                            print(f"Failed to send daily msg to {user.get('email')}: {e_daily}")
-                # --- END NEW ---
-
-                # Logic: Trigger monthly after the first month
-                level = 0
-                if days_inactive >= 365: level = 8   # 1 Year
-                elif days_inactive >= 180: level = 7 # 6 Months
-                elif days_inactive >= 90: level = 6  # 3 Months
-                elif days_inactive >= 60: level = 5  # 2 Months
-                elif days_inactive >= 28: level = 4  # 1 Month
-                elif days_inactive >= 21: level = 3  # 3 Weeks
-                elif days_inactive >= 14: level = 2  # 2 Weeks
-                elif days_inactive >= 7: level = 1   # 1 Week
-                
-                if level == 0: continue # Not inactive enough
-                
-                # Check cooldown (don't spam, send once per week/level)
-                last_sent = profile.get("last_reengagement_sent")
-                current_level_sent = profile.get("reengagement_level", 0)
-                
-                should_send = False
-                
-                if not last_sent:
-                    should_send = True
-                else:
-                    if last_sent.tzinfo is None: last_sent = last_sent.replace(tzinfo=timezone.utc)
-                    days_since_last_email = (now - last_sent).days
-                    
-                    # Prevent spam: Ensure we are upgrading level AND adequate time has passed
-                    if level > current_level_sent:
-                        # For early levels (weeks), 6 days gap is fine.
-                        # For later levels (months), insure at least 20 days gap to avoid accidental spam if script runs oddly
-                        gap_needed = 6 if level <= 4 else 25 
-                        
-                        if days_since_last_email >= gap_needed:
-                            should_send = True
-                
-                if should_send:
-                    send_reengagement_email(job_db, user, level)
-                    count += 1
-                    
-            except Exception as inner_e:
-                print(f"Error checking user {user.get('email')}: {inner_e}")
-                
-        print(f"✅ Inactivity check done. Emails sent: {count}")
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # BSON precision, so reverts can match on it
+        progress = {"scanned": 0, "daily": 0, "emails": 0, "email_failures": 0}
+        cursor = database.inactive_user_candidates(db, now, REENGAGEMENT_LEVELS, batch_size=INACTIVITY_BATCH_SIZE)
+        with ThreadPoolExecutor(max_workers=INACTIVITY_EMAIL_WORKERS, thread_name_prefix="reengage") as email_pool:
+            batch = []
+            for user in cursor:
+                batch.append(user)
+                if len(batch) < INACTIVITY_BATCH_SIZE: continue
+                for key, value in _process_inactive_batch(batch, now, email_pool).items(): progress[key] += value
+                progress["scanned"] += len(batch)
+                batch = []
+                if not database.renew_job(db, INACTIVITY_JOB, owner, INACTIVITY_LEASE_SECONDS, progress):
+                    print("⚠️ Inactivity job lease lost; stopping.")
+                    return
+            if batch:
+                for key, value in _process_inactive_batch(batch, now, email_pool).items(): progress[key] += value
+                progress["scanned"] += len(batch)
+
+        database.finish_job(db, INACTIVITY_JOB, owner, progress)
+        print(f"✅ Inactivity check done. Scanned {progress['scanned']}, miss-you messages {progress['daily']}, emails sent {progress['emails']} ({progress['email_failures']} failed).")
         
     except Exception as e:
         print(f"🔥 Error in check_for_inactive_users: {e}")
 
+STATS_JOB = "recompute_stats"
+STATS_RECOMPUTE_HOURS = float(os.getenv("STATS_RECOMPUTE_HOURS", 6))
+
+def recompute_dashboard_stats():
+    """Rebuilds the materialized dashboard stats from source; one worker per interval."""
+    if db is None: return
+    owner = f"{os.getpid()}-{secrets.token_hex(4)}"
+    try:
+        if not database.claim_job(db, STATS_JOB, owner, 15 * 60, STATS_RECOMPUTE_HOURS * 3600 * 0.9): return
+        totals = database.recompute_stats(db)
+        database.finish_job(db, STATS_JOB, owner, totals)
+        print(f"📊 Dashboard stats recomputed: {totals['users']} users, {totals['messages']} messages.")
+    except Exception as e:
+        print(f"🔥 Error in recompute_dashboard_stats: {e}")
+
 # ---------------------------------
 # --- NOTIFICATION HELPER ---
 # ---------------------------------
@@ -915,7 +907,9 @@ def _generate_server_notifications(db, user_doc):
         if did_add_new:
             updates_to_make["profile.has_seen_notifications"] = False
         
-        db.users.update_one({"_id": user_id}, {"$set": updates_to_make})
+        # Cached copy is patched now so the caller sees it; the pruning write itself is queued
+        database.patch_cached_user(user_id, updates_to_make)
+        background.submit(db.users.update_one, {"_id": user_id}, {"$set": updates_to_make})
         return fresh_notifications
 
     except Exception as e:
@@ -935,6 +929,7 @@ def get_user_profile_route():
         if not user_doc: return jsonify({"success": False, "message": "User not found."}), 404
 
         notifications = _generate_server_notifications(db, user_doc)
+        # Served from the user cache, which _generate_server_notifications patched on write
         user_doc = database.get_user_by_email(db, email)
         profile = user_doc.get("profile", {})
 
@@ -988,7 +983,7 @@ def mark_notifications_read():
     try:
         user_doc = database.get_user_by_email(db, email)
         if not user_doc: return jsonify({"success": False, "message": "User not found."}), 404
-        db.users.update_one({"_id": user_doc["_id"]}, {"$set": {"profile.has_seen_notifications": True}})
+        database.update_user_fields(db, user_doc["_id"], {"profile.has_seen_notifications": True})
         return jsonify({"success": True, "message": "Notifications marked as read."}), 200
     except Exception as e:
         return jsonify({"success": False, "message": "Server error."}), 500
@@ -1053,6 +1048,7 @@ def update_profile_route():
         
         if remove_avatar:
             db.users.update_one({"_id": user_id}, {"$unset": {"profile.profile_pic": ""}})
+            database.invalidate_user(user_id)
         elif avatar_file and avatar_file.filename != "":
             image_data = avatar_file.read()
             success = database.update_profile_picture(db, user_id, image_data, avatar_file.mimetype)
@@ -1082,17 +1078,8 @@ def update_profile_route():
 # -----------------------
 # Chat + AI
 # -----------------------
-def add_emojis_to_response(response_text):
-    inline_emoji_map = {"love": "❤️", "happy": "😊", "sad": "😥", "laugh": "😂", "smile": "😄", "cry": "😢",
-        "miss you": "🥺", "kiss": "😘", "hug": "🤗", "think": "🤔", "sweet": "🥰", "blush": "😊",
-        "heart": "❤️", "star": "⭐", "yay": "🎉", "oh no": "😟", "sorry": "😔", "please": "🙏",
-        "hi": "👋", "hello": "👋", "bye": "👋", "good night": "😴", "sleep": "😴", "dream": "💭"
-}
-    if not isinstance(response_text, str): response_text = str(response_text)
-    for keyword, emoji_char in inline_emoji_map.items():
-        pattern = r'\b' + re.escape(keyword) + r'\b'
-        response_text = re.sub(pattern, r'\g<0> ' + emoji_char, response_text, count=1, flags=re.IGNORECASE)
-    return response_text
+def add_emojis_to_response(response_text, companion_id="luvisa"):
+    return emoji_injector.add_emojis(response_text, companion_id)
 
 def filter_response(response_text):
     if not isinstance(response_text, str): response_text = str(response_text)
@@ -1139,10 +1126,7 @@ Guidelines for Response:
 """
 }
 
-def chat_with_model(prompt, history, user_name, profile_context=None, companion_id="luvisa"):
-    client = get_groq_client()
-    if not client: return "⚠️ AI temporarily unavailable"
-
+def build_model_messages(prompt, history, user_name, profile_context=None, companion_id="luvisa"):
     # Get context data
     streak = profile_context.get("streak", 1) if profile_context else 1
     
@@ -1165,67 +1149,175 @@ def chat_with_model(prompt, history, user_name, profile_context=None, companion_
     system_prompt = system_prompt.replace("{user_name}", user_name)
     if "{connection_instruction}" in system_prompt:
         system_prompt = system_prompt.replace("{connection_instruction}", connection_instruction)
+    if profile_context and profile_context.get("memory"):
+        system_prompt += profile_context["memory"]
 
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # Add history (Keep your existing logic)
+    # Add history (Keep your existing logic), newest first within the model's token budget
     # Note: Ensure 'luvisa' is changed to 'victor' or 'assistant' in your database sender checks if you change the name
-    ai_history = [{"role": "assistant" if m.get("sender") == "ai" else "user", "content": m.get("message", "")} for m in history[-60:]]
-    messages.extend(ai_history)
-    messages.append({"role": "user", "content": prompt})
+    role_of = lambda m: "assistant" if m.get("sender") == "ai" else "user"
+    return prompt_builder.build_messages(system_prompt, history, prompt, GROQ_PROMPT_BUDGET, role_of, max_messages=LUVISA_HISTORY_WINDOW)
+
+def _user_cache_scope(owner_id, *context):
+    # Replies draw on the owner's private history and memory summary, so cache entries never cross
+    # users (or Together spaces); a new summary, name or streak tier also starts a fresh scope.
+    if owner_id is None: return None
+    digest = hashlib.sha1("\x1f".join(str(c) for c in context).encode("utf-8")).hexdigest()[:16]
+    return f"{owner_id}|{digest}"
+
+def _model_cache_scope(owner_id, user_name, profile_context=None):
+    streak = profile_context.get("streak", 1) if profile_context else 1
+    tier = 0 if streak < 3 else (1 if streak < 10 else 2)
+    memory = profile_context.get("memory", "") if profile_context else ""
+    return _user_cache_scope(owner_id, user_name, tier, memory)
+
+def _touch_summary(user_id, companion_id, client):
+    """Counts the turn towards the next summary, kicks one off if due, and returns the current summary doc."""
+    try:
+        summary_doc = database.touch_chat_summary(db, user_id, companion_id)
+        summarizer.maybe_schedule(db, client, GROQ_MODEL, user_id, companion_id, summary_doc)
+        return summary_doc
+    except Exception as e:
+        print("Summary lookup error:", e)
+        return None
+
+def _usage_tokens(completion):
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+def chat_with_model(prompt, history, user_name, profile_context=None, companion_id="luvisa", owner_id=None):
+    client = get_groq_client()
+    if not client: return "⚠️ AI temporarily unavailable"
+
+    scope = _model_cache_scope(owner_id, user_name, profile_context)
+    cached = response_cache.lookup(companion_id, prompt, history, scope=scope) if scope else None
+    if cached: return cached
+
+    messages = build_model_messages(prompt, history, user_name, profile_context, companion_id)
 
     try:
         # Lower temperature slightly (0.7-0.8) for a Life Coach to keep them grounded and consistent
         completion = client.chat.completions.create(model=GROQ_MODEL, messages=messages, temperature=0.8, max_tokens=800)
-        return filter_response(completion.choices[0].message.content)
+        reply = filter_response(completion.choices[0].message.content)
+        if scope: response_cache.store(companion_id, prompt, history, reply, tokens=_usage_tokens(completion), scope=scope)
+        return reply
     except Exception as e:
         print("Groq chat error:", e)
         return "⚠️ I'm having trouble connecting right now, but I'm here."
 
-# --- NEW: File Processing Helper ---
-def process_file_upload(file_storage):
+# -----------------------
+# Streaming replies (SSE)
+# -----------------------
+def wants_stream(data=None):
+    """True when the client asked for a token stream (form field or JSON 'stream')."""
+    flag = request.form.get("stream") if request.form else None
+    if flag is None and data: flag = data.get("stream")
+    return str(flag).lower() in ("1", "true", "yes")
+
+def stream_completion(client, messages, fallback, **params):
+    """Yields reply text as Groq streams it. Falls back to `fallback` if nothing arrived."""
+    if not client:
+        yield fallback
+        return
+    sent_any = False
+    try:
+        stream = client.chat.completions.create(messages=messages, stream=True, **params)
+        for chunk in stream:
+            if not chunk.choices: continue
+            piece = chunk.choices[0].delta.content
+            if piece:
+                sent_any = True
+                yield piece
+    except Exception as e:
+        print("Groq stream error:", e)
+        if not sent_any: yield fallback
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def sse_chat_response(pieces, finalize):
     """
-    Reads file content based on type. Rejects videos.
-    Returns: String text content of the file.
+    Streams `pieces` to the browser as SSE 'token' events, then calls
+    finalize(full_text) and sends its result as the 'done' event.
+    If the stream stops early (client disconnect or error), finalize(partial_text, complete=False)
+    still runs so the part the user already saw is saved.
     """
-    filename = file_storage.filename
+    def generate():
+        parts = []
+        finalized = False
+        try:
+            for piece in pieces:
+                parts.append(piece)
+                yield _sse_event("token", {"text": piece})
+            finalized = True
+            reply = finalize("".join(parts))
+            yield _sse_event("done", {"success": True, "reply": reply})
+        except Exception as e:
+            print("Stream response error:", e)
+            yield _sse_event("done", {"success": False, "message": "Stream interrupted."})
+        finally:
+            # A disconnect closes the generator with GeneratorExit at the yield, which skips the except above
+            if not finalized and parts:
+                try:
+                    finalize("".join(parts), complete=False)
+                except Exception as e:
+                    print("Stream finalize error:", e)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+# --- NEW: File Processing Helper ---
+def _is_video_upload(filename):
     mime_type, _ = mimetypes.guess_type(filename)
-    
-    # 1. STRICTLY BLOCK VIDEO
-    if (mime_type and mime_type.startswith('video')) or filename.lower().endswith(('.mp4', '.mov', '.avi', '.mkv')):
-        return f"[System: The file '{filename}' was rejected. Video files are not supported.]"
+    return (mime_type and mime_type.startswith('video')) or filename.lower().endswith(('.mp4', '.mov', '.avi', '.mkv'))
+
+def _format_file_block(filename, result, max_chars):
+    content, truncated, error = result
+    if error == "too_large":
+        return f"\n[System: The file '{filename}' was rejected. Files over {file_ingest.FILE_MAX_BYTES // (1024 * 1024)} MB are not supported.]"
+    if error == "timeout":
+        return f"\n[System: The file '{filename}' took too long to read and was skipped.]"
+    if error:
+        return f"\n[System: Error reading file '{filename}'. It may be corrupted or unsupported.]"
+    if truncated:
+        content += f"\n[System: '{filename}' was truncated to its first {max_chars} characters.]"
+    return f"\n\n--- FILE CONTENT: {filename} ---\n{content}\n--- END OF FILE ---\n"
 
-    try:
-        file_ext = os.path.splitext(filename)[1].lower()
-        content = ""
-
-        # 2. PDF Handling
-        if file_ext == '.pdf':
-            reader = PdfReader(file_storage)
-            text = []
-            for page in reader.pages:
-                text.append(page.extract_text())
-            content = "\n".join(text)
-
-        # 3. Word Doc Handling
-        elif file_ext in ['.doc', '.docx']:
-            doc = Document(file_storage)
-            content = "\n".join([para.text for para in doc.paragraphs])
-
-        # 4. Code/Text Handling (Fallback)
+def collect_file_context(files, max_chars=None):
+    """
+    Reads every attachment and returns their text blocks joined in upload order. Rejects videos.
+    PDF/Word parsing runs in parallel in file_ingest's process pool, with a per-file timeout.
+    The FILE_CONTEXT_MAX_CHARS budget is split evenly across the files.
+    """
+    if not files: return ""
+    if max_chars is None:
+        max_chars = min(file_ingest.FILE_MAX_CHARS, file_ingest.TOTAL_MAX_CHARS // len(files))
+
+    blocks = [None] * len(files)
+    readable = []
+    for i, file_storage in enumerate(files):
+        # 1. STRICTLY BLOCK VIDEO
+        if _is_video_upload(file_storage.filename):
+            blocks[i] = f"[System: The file '{file_storage.filename}' was rejected. Video files are not supported.]"
         else:
-            # Read bytes, try decoding
-            raw_bytes = file_storage.read()
-            try:
-                content = raw_bytes.decode('utf-8')
-            except UnicodeDecodeError:
-                content = raw_bytes.decode('latin-1') # Fallback encoding
-
-        return f"\n\n--- FILE CONTENT: {filename} ---\n{content}\n--- END OF FILE ---\n"
+            readable.append(i)
 
+    # 2. PDF / Word / Code / Text, extracted up to max_chars each
+    uploads = [(files[i].stream, os.path.splitext(files[i].filename)[1].lower()) for i in readable]
+    try:
+        results = file_ingest.extract_many(uploads, max_chars)
     except Exception as e:
-        print(f"Error reading file {filename}: {e}")
-        return f"\n[System: Error reading file '{filename}'. It may be corrupted or unsupported.]"
+        print(f"Error reading files: {e}")
+        results = [("", False, "error")] * len(readable)
+    for i, result in zip(readable, results):
+        blocks[i] = _format_file_block(files[i].filename, result, max_chars)
+    return "".join(blocks)
+
+def process_file_upload(file_storage, max_chars=file_ingest.FILE_MAX_CHARS):
+    """
+    Reads file content based on type. Rejects videos.
+    Returns: String text content of the file.
+    """
+    return collect_file_context([file_storage], max_chars)
     
 
 # --- UPDATED: Chat Endpoint (Luvisa) ---
@@ -1252,9 +1344,7 @@ def chat_endpoint():
         return jsonify({"success": False, "message": "Email and message required."}), 400
 
     # Process Files
-    file_context = ""
-    for file in files:
-        file_context += process_file_upload(file)
+    file_context = collect_file_context(files)
     
     # Combine text + file content for the AI
     full_prompt = (text or "") + file_context
@@ -1265,32 +1355,45 @@ def chat_endpoint():
     user_id = user_doc["_id"]
     now = datetime.now(timezone.utc)
     
+    # Get history
+    # companion_id is available from top of function
+    
+    history_docs = database.get_chat_history(db, user_id, companion_id=companion_id, limit=LUVISA_HISTORY_WINDOW)
+    history = [{"sender": r.get("sender"), "message": r.get("message", ""), "tokens": r.get("tokens")} for r in history_docs]
+
     # 1. Save User Message (Store original text + note about files, not full content to save DB space if needed)
     # Ideally, we store the full prompt so context is preserved.
-    # 1. Save User Message
-    # companion_id already extracted above
+    # Saved after reading history: the prompt is sent to the model explicitly, not via history
     database.add_message_to_history(db, user_id, "user", full_prompt, now, companion_id=companion_id)
 
-    # XP Logic
-    try:
-        profile = user_doc.get("profile", {})
-        current_xp = profile.get("xp", 0) + 1
-        new_level = calculate_level(current_xp)
-        database.update_user_xp_and_level(db, user_id, current_xp, new_level)
-    except Exception: pass
-
-    # Get history
-    # companion_id is available from top of function
-    
-    history_docs = database.get_chat_history(db, user_id, companion_id=companion_id)
-    history = [{"sender": r.get("sender"), "message": r.get("message", "")} for r in history_docs]
+    # XP Logic (queued, batched per user)
+    queue_xp_gain(user_doc)
 
     profile = user_doc.get("profile", {})
     user_name = profile.get("display_name", email.split("@")[0])
-    profile_context = {"streak": profile.get("streak", 1)}
-    
-    reply = chat_with_model(full_prompt, history, user_name, profile_context, companion_id=companion_id)
-    enhanced = add_emojis_to_response(reply)
+
+    # Long-term memory: rolling summary of older turns, refreshed in the background
+    summary_doc = _touch_summary(user_id, companion_id, get_groq_client())
+    profile_context = {"streak": profile.get("streak", 1), "memory": summarizer.memory_block(summary_doc, user_name)}
+
+    if wants_stream(data):
+        scope = _model_cache_scope(user_id, user_name, profile_context)
+        cached = response_cache.lookup(companion_id, full_prompt, history, scope=scope)
+        def finalize(raw_reply, complete=True):
+            reply = filter_response(raw_reply)
+            if complete and not cached: response_cache.store(companion_id, full_prompt, history, reply, scope=scope)
+            enhanced = add_emojis_to_response(reply, companion_id)
+            database.add_message_to_history(db, user_id, companion_id, enhanced, datetime.now(timezone.utc), companion_id=companion_id)
+            return enhanced
+        if cached:
+            pieces = [cached]
+        else:
+            messages = build_model_messages(full_prompt, history, user_name, profile_context, companion_id)
+            pieces = stream_completion(get_groq_client(), messages, "⚠️ I'm having trouble connecting right now, but I'm here.", model=GROQ_MODEL, temperature=0.8, max_tokens=800)
+        return sse_chat_response(pieces, finalize)
+
+    reply = chat_with_model(full_prompt, history, user_name, profile_context, companion_id=companion_id, owner_id=user_id)
+    enhanced = add_emojis_to_response(reply, companion_id)
     
     database.add_message_to_history(db, user_id, companion_id, enhanced, datetime.now(timezone.utc), companion_id=companion_id)
 
@@ -1301,6 +1404,7 @@ def chat_endpoint():
 # -----------------------
 # UPDATED: Use a valid, high-performance model
 CODER_MODEL = "llama-3.3-70b-versatile"
+CODER_PROMPT_BUDGET = int(os.getenv("CODER_PROMPT_BUDGET_TOKENS", 16000))  # Input tokens per request for CODER_MODEL
 _coder_client = None
 
 def get_coder_client():
@@ -1309,15 +1413,11 @@ def get_coder_client():
     key = os.getenv("GROQ_CODER_API_KEY") or os.getenv("GROQ_API_KEY") # Fallback to main key
     if not key: return None
     try:
-        _coder_client = Groq(api_key=key)
+        _coder_client = llm_gateway.get_client(key)
         return _coder_client
     except Exception: return None
 
-def chat_with_coder(prompt, history):
-    client = get_coder_client()
-    if not client: 
-        return "⚠️ Coder AI unavailable."
-
+def build_coder_messages(prompt, history):
     # --- ADVANCED SYSTEM PROMPT ---
     system_prompt = """
     You are "Deo", an elite Senior Software Architect.
@@ -1333,18 +1433,20 @@ def chat_with_coder(prompt, history):
     If the user asks for a specific functionality (e.g., "calculator"), provide the COMPLETE working script, including the UI or main execution loop.
     """
 
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # Clean history to ensure valid format
-    clean_history = []
-    for m in history[-10:]:
-        role = "assistant" if m.get("sender") == "coder" else "user"
-        content = m.get("message", "")
-        if content:
-            clean_history.append({"role": role, "content": content})
-            
-    messages.extend(clean_history)
-    messages.append({"role": "user", "content": prompt})
+    # Clean history to ensure valid format (empty messages are skipped by the builder)
+    role_of = lambda m: "assistant" if m.get("sender") == "coder" else "user"
+    return prompt_builder.build_messages(system_prompt, history, prompt, CODER_PROMPT_BUDGET, role_of, max_messages=CODER_HISTORY_WINDOW)
+
+def chat_with_coder(prompt, history, owner_id):
+    client = get_coder_client()
+    if not client: 
+        return "⚠️ Coder AI unavailable."
+
+    scope = _user_cache_scope(owner_id)
+    cached = response_cache.lookup("coder", prompt, history, scope=scope)
+    if cached: return cached
+
+    messages = build_coder_messages(prompt, history)
 
     try:
         completion = client.chat.completions.create(
@@ -1354,7 +1456,9 @@ def chat_with_coder(prompt, history):
             max_tokens=4096,  # Allow long code responses
             top_p=0.9
         )
-        return completion.choices[0].message.content
+        reply = completion.choices[0].message.content
+        response_cache.store("coder", prompt, history, reply, tokens=_usage_tokens(completion), scope=scope)
+        return reply
         
     except Exception as e:
         print(f"Coder chat error: {str(e)}")
@@ -1371,6 +1475,7 @@ def coder_chat_endpoint():
         email = request.form.get("email")
         text = request.form.get("text")
         files = request.files.getlist("files")
+        data = {}
     else:
         data = request.json or {}
         email = data.get("email")
@@ -1381,9 +1486,7 @@ def coder_chat_endpoint():
         return jsonify({"success": False, "message": "Email and message required."}), 400
 
     # Process Files
-    file_context = ""
-    for file in files:
-        file_context += process_file_upload(file)
+    file_context = collect_file_context(files)
 
     full_prompt = (text or "") + file_context
 
@@ -1393,12 +1496,25 @@ def coder_chat_endpoint():
     user_id = user_doc["_id"]
     now = datetime.now(timezone.utc)
     
+    history_docs = database.get_chat_history(db, user_id, companion_id="coder", limit=CODER_HISTORY_WINDOW)
+    history = [{"sender": r.get("sender"), "message": r.get("message", ""), "tokens": r.get("tokens")} for r in history_docs]
     database.add_message_to_history(db, user_id, "user", full_prompt, now, companion_id="coder")
 
-    history_docs = database.get_chat_history(db, user_id, companion_id="coder")
-    history = [{"sender": r.get("sender"), "message": r.get("message", "")} for r in history_docs]
+    if wants_stream(data):
+        scope = _user_cache_scope(user_id)
+        cached = response_cache.lookup("coder", full_prompt, history, scope=scope)
+        def finalize(reply, complete=True):
+            if complete and not cached: response_cache.store("coder", full_prompt, history, reply, scope=scope)
+            database.add_message_to_history(db, user_id, "coder", reply, datetime.now(timezone.utc), companion_id="coder")
+            return reply
+        if cached:
+            pieces = [cached]
+        else:
+            messages = build_coder_messages(full_prompt, history)
+            pieces = stream_completion(get_coder_client(), messages, "⚠️ Error generating code. Please try again.", model=CODER_MODEL, temperature=0.1, max_tokens=4096, top_p=0.9)
+        return sse_chat_response(pieces, finalize)
 
-    reply = chat_with_coder(full_prompt, history)
+    reply = chat_with_coder(full_prompt, history, user_id)
     
     database.add_message_to_history(db, user_id, "coder", reply, datetime.now(timezone.utc), companion_id="coder")
 
@@ -1420,15 +1536,11 @@ def get_coach_client():
     
     if not key: return None
     try:
-        _coach_client = Groq(api_key=key)
+        _coach_client = llm_gateway.get_client(key)
         return _coach_client
     except Exception: return None
 
-def chat_with_coach(prompt, history, user_name):
-    # 2. Use the specific Coach Client
-    client = get_coach_client()
-    if not client: return "⚠️ Coach AI unavailable."
-
+def build_coach_messages(prompt, history, user_name, memory=""):
     # Specific Persona for the Coach
     system_prompt = f"""
     You are an expert AI Life Coach speaking to {user_name}.
@@ -1438,14 +1550,22 @@ def chat_with_coach(prompt, history, user_name):
     - Ask thought-provoking questions to help them find clarity.
     - Offer actionable advice and strategies for personal growth, productivity, and mental well-being.
     - Maintain a professional yet warm and supportive tone.
-    """
+    """ + memory
 
-    messages = [{"role": "system", "content": system_prompt}]
-    
     # Coach History
-    coach_history = [{"role": "assistant" if m.get("sender") == "coach" else "user", "content": m.get("message", "")} for m in history[-20:]]
-    messages.extend(coach_history)
-    messages.append({"role": "user", "content": prompt})
+    role_of = lambda m: "assistant" if m.get("sender") == "coach" else "user"
+    return prompt_builder.build_messages(system_prompt, history, prompt, GROQ_PROMPT_BUDGET, role_of, max_messages=COACH_HISTORY_WINDOW)
+
+def chat_with_coach(prompt, history, user_name, memory="", owner_id=None):
+    # 2. Use the specific Coach Client
+    client = get_coach_client()
+    if not client: return "⚠️ Coach AI unavailable."
+
+    scope = _user_cache_scope(owner_id, user_name, memory)
+    cached = response_cache.lookup("coach", prompt, history, scope=scope) if scope else None
+    if cached: return cached
+
+    messages = build_coach_messages(prompt, history, user_name, memory)
 
     try:
         completion = client.chat.completions.create(
@@ -1454,7 +1574,9 @@ def chat_with_coach(prompt, history, user_name):
             temperature=0.7, 
             max_tokens=800
         )
-        return completion.choices[0].message.content
+        reply = completion.choices[0].message.content
+        if scope: response_cache.store("coach", prompt, history, reply, tokens=_usage_tokens(completion), scope=scope)
+        return reply
     except Exception as e:
         print("Coach chat error:", e)
         return "⚠️ I'm having trouble connecting to my guidance systems."
@@ -1471,6 +1593,7 @@ def coach_chat_endpoint():
     if request.content_type and 'multipart/form-data' in request.content_type:
         email = request.form.get("email")
         text = request.form.get("text")
+        data = {}
     else:
         data = request.json or {}
         email = data.get("email")
@@ -1486,15 +1609,30 @@ def coach_chat_endpoint():
     profile = user_doc.get("profile", {})
     user_name = profile.get("display_name", email.split("@")[0])
     
-    # 1. Save User Message
-    database.add_message_to_history(db, user_id, "user", text, datetime.now(timezone.utc), companion_id="coach")
+    # 1. Get History (+ rolling summary of older turns)
+    history_docs = database.get_chat_history(db, user_id, companion_id="coach", limit=COACH_HISTORY_WINDOW)
+    history = [{"sender": r.get("sender"), "message": r.get("message", ""), "tokens": r.get("tokens")} for r in history_docs]
 
-    # 2. Get History
-    history_docs = database.get_chat_history(db, user_id, companion_id="coach")
-    history = [{"sender": r.get("sender"), "message": r.get("message", "")} for r in history_docs]
+    # 2. Save User Message (after the read: the prompt is sent to the model explicitly)
+    database.add_message_to_history(db, user_id, "user", text, datetime.now(timezone.utc), companion_id="coach")
+    memory = summarizer.memory_block(_touch_summary(user_id, "coach", get_coach_client()), user_name)
 
     # 3. Generate Reply
-    reply = chat_with_coach(text, history, user_name)
+    if wants_stream(data):
+        scope = _user_cache_scope(user_id, user_name, memory)
+        cached = response_cache.lookup("coach", text, history, scope=scope)
+        def finalize(reply, complete=True):
+            if complete and not cached: response_cache.store("coach", text, history, reply, scope=scope)
+            database.add_message_to_history(db, user_id, "coach", reply, datetime.now(timezone.utc), companion_id="coach")
+            return reply
+        if cached:
+            pieces = [cached]
+        else:
+            messages = build_coach_messages(text, history, user_name, memory)
+            pieces = stream_completion(get_coach_client(), messages, "⚠️ I'm having trouble connecting to my guidance systems.", model=GROQ_MODEL, temperature=0.7, max_tokens=800)
+        return sse_chat_response(pieces, finalize)
+
+    reply = chat_with_coach(text, history, user_name, memory, owner_id=user_id)
     
     # 4. Save Coach Reply
     database.add_message_to_history(db, user_id, "coach", reply, datetime.now(timezone.utc), companion_id="coach")
@@ -1527,11 +1665,18 @@ def load_chat_history_route():
         user_doc = database.get_user_by_email(db, email)
         if not user_doc: return jsonify({"success": False, "message": "User not found."}), 404
         
+        try: limit = min(int(request.args.get("limit", CHAT_HISTORY_PAGE_SIZE)), CHAT_HISTORY_MAX_PAGE_SIZE)
+        except ValueError: limit = CHAT_HISTORY_PAGE_SIZE
+        cursor = request.args.get("cursor")
+
         # Pass companion filter to DB
-        history = database.get_chat_history(db, user_doc["_id"], companion_id=companion)
+        try:
+            history, next_cursor = database.get_chat_history_page(db, user_doc["_id"], companion_id=companion, limit=max(limit, 1), cursor=cursor)
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid cursor."}), 400
         
         formatted = [{"sender": r["sender"], "message": r["message"], "time": r.get("timestamp").strftime("%Y-%m-%d %H:%M:%S") if r.get("timestamp") else ""} for r in history]
-        return jsonify({"success": True, "history": formatted}), 200
+        return jsonify({"success": True, "history": formatted, "next_cursor": next_cursor}), 200
     except Exception as e:
         print("Load history error:", e)
         return jsonify({"success": False, "message": "Error loading history."}), 500
@@ -1554,7 +1699,9 @@ def forget_memory_route():
 # -----------------------
 # API: Together Spaces
 # -----------------------
-SPACE_DURATION_SECONDS = 300 
+SPACE_DURATION_SECONDS = database.TOGETHER_SPACE_TTL_SECONDS
+TOGETHER_HISTORY_WINDOW = 30      # Messages the AI sees per reply
+TOGETHER_HISTORY_PAGE_SIZE = 500  # Max messages per /api/together/history response
 
 @app.route("/api/together/create", methods=["POST"])
 def create_together_space():
@@ -1566,14 +1713,13 @@ def create_together_space():
     if not space_name or not password: return jsonify({"success": False, "message": "Data required."}), 400
     
     try:
+        # Expired spaces are removed by the created_at TTL index; one may linger for up to a
+        # minute, so only live spaces count as taking the name.
         cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=SPACE_DURATION_SECONDS)
-        try: db.together_spaces.delete_many({"created_at": {"$lt": cutoff_time}})
-        except Exception: pass
-
-        existing = db.together_spaces.find_one({"name": space_name})
+        existing = db.together_spaces.find_one({"name": space_name, "created_at": {"$gt": cutoff_time}}, {"_id": 1})
         if existing: return jsonify({"success": False, "message": "Space name taken."}), 409
         
-        hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+        hashed = password_hasher.hash_password(password)
         now = datetime.now(timezone.utc)
         
         welcome_msg = f"Welcome to '{space_name}'! Closing in 5 mins."
@@ -1584,12 +1730,14 @@ def create_together_space():
             "hashed_password": hashed,
             "created_at": now,
             "ai_active": with_ai, 
-            "history": [{"sender": "luvisa", "sender_name": "Luvisa 💗", "message": welcome_msg, "timestamp": now}]
+            "history": [{"sender": "luvisa", "sender_name": "Luvisa 💗", "message": welcome_msg, "timestamp": now}],
+            "msg_count": 1
         }
         
         result = db.together_spaces.insert_one(space_doc)
         return jsonify({"success": True, "message": "Space created!", "space_id": str(result.inserted_id), "expires_at": int(now.timestamp()) + SPACE_DURATION_SECONDS}), 201
 
+    except password_hasher.HasherBusy: return _hasher_busy_response()
     except Exception: return jsonify({"success": False, "message": "Server error."}), 500
 
 @app.route("/api/together/join", methods=["POST"])
@@ -1604,10 +1752,11 @@ def join_together_space():
         space = db.together_spaces.find_one({"name": space_name, "created_at": {"$gt": cutoff_time}})
 
         if not space: return jsonify({"success": False, "message": "Space not found/expired."}), 404
-        if not bcrypt.checkpw(password.encode("utf-8"), space["hashed_password"]): return jsonify({"success": False, "message": "Invalid password."}), 401
+        if not password_hasher.check_password(password, space["hashed_password"]): return jsonify({"success": False, "message": "Invalid password."}), 401
         
         return jsonify({"success": True, "message": "Joined!", "space_id": str(space["_id"]), "expires_at": int(space["created_at"].timestamp()) + SPACE_DURATION_SECONDS}), 200
 
+    except password_hasher.HasherBusy: return _hasher_busy_response()
     except Exception: return jsonify({"success": False, "message": "Server error."}), 500
 
 @app.route("/api/together/toggle_ai", methods=["POST"])
@@ -1619,10 +1768,13 @@ def toggle_together_ai():
     if not space_id or state is None: return jsonify({"success": False, "message": "Data required."}), 400
 
     try:
-        db.together_spaces.update_one({"_id": ObjectId(space_id)}, {"$set": {"ai_active": state}})
         now = datetime.now(timezone.utc)
         status_msg = "Luvisa (AI) ON." if state else "Luvisa (AI) OFF."
-        db.together_spaces.update_one({"_id": ObjectId(space_id)}, {"$push": {"history": {"sender": "luvisa", "sender_name": "Luvisa 💗", "message": status_msg, "timestamp": now}}})
+        status_message = {"sender": "luvisa", "sender_name": "Luvisa 💗", "message": status_msg, "timestamp": now}
+        seq, space = database.push_together_message(db, space_id, status_message, set_fields={"ai_active": state})
+        if space is None: return jsonify({"success": False, "message": "Space expired."}), 404
+        together_hub.hub.publish_state(space_id, state)
+        together_hub.hub.publish(space_id, seq, together_hub.format_message(status_message))
 
         return jsonify({"success": True, "message": "AI state updated."}), 200
     except Exception: return jsonify({"success": False, "message": "Server error."}), 500
@@ -1640,42 +1792,99 @@ def chat_in_together_space():
         now = datetime.now(timezone.utc)
         user_message = {"sender": "user", "sender_name": sender_name, "message": text, "timestamp": now}
         
-        space = db.together_spaces.find_one({"_id": ObjectId(space_id)})
-        if not space: return jsonify({"success": False, "message": "Space expired."}), 404
-        
-        db.together_spaces.update_one({"_id": ObjectId(space_id)}, {"$push": {"history": user_message}})
+        # One round trip: append, confirm the space exists, and fetch the recent context.
+        seq, space = database.push_together_message(db, space_id, user_message, recent=TOGETHER_HISTORY_WINDOW + 1)
+        if space is None: return jsonify({"success": False, "message": "Space expired."}), 404
+        together_hub.hub.publish(space_id, seq, together_hub.format_message(user_message))
         
         if space.get("ai_active", True):
-            history_docs = list(db.together_spaces.find_one({"_id": ObjectId(space_id)}, {"history": 1}).get("history", []))
-            history = [{"sender": r.get("sender"), "message": r.get("message", "")} for r in history_docs]
-            reply = chat_with_model(text, history, sender_name, companion_id="luvisa")
+            # The last entry is the message just sent; chat_with_model appends the prompt itself.
+            history_docs = space.get("history", [])[:-1]
+            history = [{"sender": r.get("sender"), "message": r.get("message", ""), "tokens": r.get("tokens")} for r in history_docs]
+            reply = chat_with_model(text, history, sender_name, companion_id="luvisa", owner_id=f"together:{space_id}")
             
             ai_message = {"sender": "luvisa", "sender_name": "Luvisa 💗", "message": reply, "timestamp": datetime.now(timezone.utc)}
-            db.together_spaces.update_one({"_id": ObjectId(space_id)}, {"$push": {"history": ai_message}})
+            seq, _ = database.push_together_message(db, space_id, ai_message)
+            if seq is not None: together_hub.hub.publish(space_id, seq, together_hub.format_message(ai_message))
         
         return jsonify({"success": True, "message": "Message sent."}), 200
     except Exception: return jsonify({"success": False, "message": "Server error."}), 500
 
 @app.route("/api/together/history", methods=["GET"])
 def get_together_history():
+    """Messages after ?since=<seq> (default: from the start), each tagged with its seq."""
     space_id = request.args.get("space_id")
     if not space_id: return jsonify({"success": False, "message": "ID required."}), 400
+    try: since = max(int(request.args.get("since", -1)), -1)
+    except ValueError: return jsonify({"success": False, "message": "Invalid since."}), 400
     
     try:
-        space = db.together_spaces.find_one({"_id": ObjectId(space_id)})
+        space = database.get_together_messages(db, space_id, since=since, limit=TOGETHER_HISTORY_PAGE_SIZE)
         if not space: return jsonify({"success": False, "message": "Space expired."}), 404
         
-        history = space.get("history", [])
-        formatted = [{
-            "sender": r["sender"], 
-            "sender_name": r.get("sender_name", "Luvisa 💗" if r["sender"] == "luvisa" else "User"),
-            "message": r["message"], 
-            "time": r.get("timestamp").strftime("%Y-%m-%d %H:%M:%S") if r.get("timestamp") else ""
-        } for r in history]
-        
-        return jsonify({"success": True, "history": formatted, "ai_active": space.get("ai_active", True)}), 200
+        formatted = [dict(together_hub.format_message(r), seq=since + 1 + i) for i, r in enumerate(space.get("history", []))]
+        last_seq = formatted[-1]["seq"] if formatted else since
+        return jsonify({"success": True, "history": formatted, "last_seq": last_seq, "ai_active": space.get("ai_active", True)}), 200
     except Exception: return jsonify({"success": False, "message": "Server error."}), 500
 
+TOGETHER_STREAM_HEARTBEAT_SECONDS = 15
+
+@app.route("/api/together/stream", methods=["GET"])
+def stream_together_space():
+    """
+    SSE feed for a space. Each message event carries its seq as the event id, so a reconnecting
+    EventSource (Last-Event-ID) or a client passing ?since=<seq> only receives what it missed.
+    """
+    space_id = request.args.get("space_id")
+    if not space_id: return jsonify({"success": False, "message": "ID required."}), 400
+    try: since = max(int(request.headers.get("Last-Event-ID") or request.args.get("since", -1)), -1)
+    except ValueError: since = -1
+
+    # Subscribe before reading the backlog so nothing published in between is lost.
+    subscription = together_hub.hub.subscribe(space_id, db)
+    try: space = database.get_together_messages(db, space_id, since=since)
+    except Exception: space = None
+    if not space:
+        together_hub.hub.unsubscribe(space_id, subscription)
+        return jsonify({"success": False, "message": "Space expired."}), 404
+
+    expires_at = space["created_at"].replace(tzinfo=timezone.utc).timestamp() + SPACE_DURATION_SECONDS
+
+    def message_event(seq, payload):
+        return f"id: {seq}\n" + _sse_event("message", dict(payload, seq=seq))
+
+    def events():
+        last_seq = since
+        try:
+            yield _sse_event("state", {"ai_active": space.get("ai_active", True)})
+            for msg in space.get("history", []):
+                last_seq += 1
+                yield message_event(last_seq, together_hub.format_message(msg))
+            together_hub.hub.mark_seen(space_id, last_seq)
+
+            while time.time() < expires_at:
+                try: kind, seq, payload = subscription.get(timeout=min(TOGETHER_STREAM_HEARTBEAT_SECONDS, max(expires_at - time.time(), 0.1)))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if kind == "state":
+                    yield _sse_event("state", payload)
+                    continue
+                if seq <= last_seq: continue
+                if seq > last_seq + 1:
+                    # Dropped events (slow client or adapter hiccup): fill the gap from the DB.
+                    gap = database.get_together_messages(db, space_id, since=last_seq, limit=seq - last_seq - 1) or {}
+                    for msg in gap.get("history", []):
+                        last_seq += 1
+                        yield message_event(last_seq, together_hub.format_message(msg))
+                last_seq = seq
+                yield message_event(seq, payload)
+            yield _sse_event("expired", {"space_id": space_id})
+        finally:
+            together_hub.hub.unsubscribe(space_id, subscription)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # -----------------------
 # Secret Journal
 # -----------------------
@@ -1691,9 +1900,9 @@ def generate_daily_journal(db, user_doc):
     if not client: return None
 
     try:
-        history_docs = database.get_chat_history(db, user_id)
+        history_docs = database.get_chat_history(db, user_id, limit=20)
         if not history_docs: chat_text = "No interactions today."
-        else: chat_text = "\n".join([f"{m['sender']}: {m.get('message','')}" for m in history_docs[-20:]])
+        else: chat_text = "\n".join([f"{m['sender']}: {m.get('message','')}" for m in history_docs])
     except Exception: chat_text = "No interactions."
     
     user_name = user_doc.get("profile", {}).get("display_name", "User")
@@ -1809,13 +2018,26 @@ def serve_admin(): return send_from_directory(STATIC_FOLDER, "admin.html")
 # -----------------------
 # Run server
 # -----------------------
-if __name__ == "__main__":
-    # --- Start Scheduler for Background Tasks ---
+# --- Scheduler for Background Tasks ---
+# Started at import so it also runs under gunicorn, where __main__ never executes. Every worker
+# runs one; jobs take a job_runs lease (or are idempotent) so a run happens once per interval.
+# (With gunicorn --preload, call start_scheduler() from a post_fork hook instead.)
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes")
+_scheduler_pid = None
+
+def start_scheduler():
+    global _scheduler_pid
+    if _scheduler_pid == os.getpid(): return
+    _scheduler_pid = os.getpid()
     scheduler = BackgroundScheduler()
     scheduler.add_job(check_for_inactive_users, 'interval', hours=24) # Run daily
     scheduler.add_job(lambda: database.delete_old_messages(db, 7), 'interval', hours=24) # Auto-delete old messages
+    scheduler.add_job(recompute_dashboard_stats, 'interval', hours=STATS_RECOMPUTE_HOURS) # Correct stats drift
     scheduler.start()
-    print("✅ Scheduler started: Checking inactive users & cleaning old messages daily.")
+    print(f"✅ Scheduler started (pid {_scheduler_pid}): Checking inactive users & cleaning old messages daily.")
 
+if SCHEDULER_ENABLED and db is not None: start_scheduler()
+
+if __name__ == "__main__":
     port = int(os.getenv("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
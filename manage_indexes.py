@@ -0,0 +1,47 @@
+import sys
+import database
+
+def main():
+    print("--- Friendix Index Manager ---")
+    check_only = "--check" in sys.argv[1:]
+
+    # 1. Connect to Database
+    try:
+        database.load_config()
+        db = database.get_db()
+        if db is None:
+            print("🔥 Error: Could not connect to MongoDB.")
+            return 1
+        print("✅ Connected to Database.")
+    except Exception as e:
+        print(f"🔥 Connection Error: {e}")
+        return 1
+
+    # 2. Create indexes (idempotent)
+    if not check_only:
+        failures = database.ensure_indexes(db)
+        if failures:
+            print(f"❌ {len(failures)} index(es) could not be created.")
+            return 1
+        print("✅ All indexes present.")
+
+    # 3. Verify TTL indexes (expiry of spaces, resets, OTPs)
+    mismatches = database.check_ttl_indexes(db)
+    if mismatches:
+        for coll_name, name, expected, actual in mismatches:
+            print(f"❌ TTL {coll_name}.{name}: expected {expected}s, found {actual}")
+        return 1
+    print("✅ TTL indexes match.")
+
+    # 4. Verify query plans
+    offenders = database.verify_query_plans(db)
+    if offenders:
+        for label in offenders:
+            print(f"❌ COLLSCAN: {label}")
+        return 1
+    print("✅ No hot query uses a collection scan.")
+    return 0
+
+if __name__ == "__main__":
+    # Usage: python manage_indexes.py [--check]
+    sys.exit(main())
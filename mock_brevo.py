@@ -0,0 +1,47 @@
+import sys
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for the Brevo API when developing or testing email flows locally:
+#   python mock_brevo.py [port] [fail_every]
+#   BREVO_API_URL=http://localhost:8025/v3 BREVO_API_KEY=test python main.py
+# fail_every=N answers every Nth request with 503 to exercise the transport's retries.
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+FAIL_EVERY = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+
+class MockBrevoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    requests_seen = 0
+    messages_sent = 0
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        MockBrevoHandler.requests_seen += 1
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        if self.path.rstrip("/") != "/v3/smtp/email": return self._reply(404, {"code": "not_found"})
+        if not self.headers.get("api-key"): return self._reply(401, {"code": "unauthorized"})
+        if FAIL_EVERY and MockBrevoHandler.requests_seen % FAIL_EVERY == 0: return self._reply(503, {"code": "unavailable"})
+
+        versions = payload.get("messageVersions") or [{"to": payload.get("to", [])}]
+        recipients = [to["email"] for version in versions for to in version.get("to", [])]
+        MockBrevoHandler.messages_sent += len(recipients)
+        print(f"📧 {payload.get('subject')!r} -> {len(recipients)} recipient(s): {', '.join(recipients[:5])}{' ...' if len(recipients) > 5 else ''}")
+        self._reply(201, {"messageIds": [f"<mock-{MockBrevoHandler.messages_sent - i}@brevo>" for i in range(len(recipients))]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    print(f"--- Mock Brevo on http://localhost:{PORT}/v3 ---")
+    ThreadingHTTPServer(("127.0.0.1", PORT), MockBrevoHandler).serve_forever()
@@ -0,0 +1,250 @@
+import os
+import time
+import heapq
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+OTP_EXPIRY_SECONDS = 5 * 60
+MAX_ENTRIES = int(os.getenv("OTP_STORE_MAX_ENTRIES", 100000))
+MAX_VERIFY_ATTEMPTS = int(os.getenv("OTP_MAX_VERIFY_ATTEMPTS", 5))  # Wrong guesses before the code is burned
+SEND_LIMIT = int(os.getenv("OTP_SEND_LIMIT", 3))                     # Codes per email per window
+SEND_WINDOW_SECONDS = int(os.getenv("OTP_SEND_WINDOW_SECONDS", 10 * 60))
+
+# "memory" (per process), "local" (SQLite on tmpfs, shared by every worker on the host),
+# "mongo" (shared by every host). Default: mongo when a db is available.
+BACKEND = os.getenv("OTP_STORE_BACKEND", "")
+LOCAL_PATH = os.getenv("OTP_STORE_PATH", "/dev/shm/friendix_otp.sqlite3" if os.path.isdir("/dev/shm") else "friendix_otp.sqlite3")
+
+
+class OTPStore:
+    """
+    Interface shared by the backends. Keys are namespaced (e.g. "signup") so several flows can
+    share one backend.
+      put(email, otp)          -> stores/replaces the code
+      consume(email, otp)      -> (valid, message); check and delete happen atomically, so a code
+                                  verifies at most once even with concurrent requests on different workers
+      pending(email)           -> True while an unexpired, unconsumed code exists
+      allow_send(email)        -> (allowed, retry_after_seconds); fixed-window rate limit per email
+    """
+
+    def __init__(self, namespace="otp", ttl=OTP_EXPIRY_SECONDS, send_limit=SEND_LIMIT, send_window=SEND_WINDOW_SECONDS):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.send_limit = send_limit
+        self.send_window = send_window
+
+    def _key(self, email):
+        return f"{self.namespace}:{email}"
+
+
+class MemoryOTPStore(OTPStore):
+    """
+    Process-local store whose entries expire on their own. A min-heap of expiry times is swept
+    on every write, so expired codes are dropped even if nobody reads them and memory stays
+    bounded by the number of codes issued in the last `ttl` seconds (capped at MAX_ENTRIES).
+    Only correct with a single worker.
+    """
+
+    def __init__(self, namespace="otp", ttl=OTP_EXPIRY_SECONDS, maxsize=MAX_ENTRIES, **kwargs):
+        super().__init__(namespace, ttl, **kwargs)
+        self.maxsize = maxsize
+        self._entries = {}  # email -> [otp, expires_at, attempts]
+        self._expiry = []   # heap of (expires_at, email); stale rows are skipped
+        self._sends = {}    # email -> (window_end, count)
+        self._lock = threading.Lock()
+
+    def _sweep(self, now):
+        while self._expiry and (self._expiry[0][0] <= now or len(self._entries) > self.maxsize):
+            expires_at, email = heapq.heappop(self._expiry)
+            entry = self._entries.get(email)
+            if entry and entry[1] == expires_at: del self._entries[email]
+
+    def put(self, email, otp):
+        now = time.monotonic()
+        with self._lock:
+            expires_at = now + self.ttl
+            self._entries[email] = [otp, expires_at, 0]
+            heapq.heappush(self._expiry, (expires_at, email))
+            self._sweep(now)
+        return otp
+
+    def consume(self, email, otp_value):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(email)
+            if not entry: return False, "No OTP found."
+            if entry[1] <= now:
+                del self._entries[email]
+                return False, "OTP expired."
+            if str(entry[0]) != str(otp_value).strip():
+                entry[2] += 1
+                if entry[2] >= MAX_VERIFY_ATTEMPTS: del self._entries[email]
+                return False, "Invalid OTP."
+            del self._entries[email]
+            return True, "OTP valid."
+
+    def pending(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            return bool(entry) and entry[1] > time.monotonic()
+
+    def allow_send(self, email):
+        now = time.monotonic()
+        with self._lock:
+            window_end, count = self._sends.get(email, (0, 0))
+            if window_end <= now: window_end, count = now + self.send_window, 0
+            if count >= self.send_limit: return False, int(window_end - now) + 1
+            self._sends[email] = (window_end, count + 1)
+            if len(self._sends) > self.maxsize:
+                self._sends = {k: v for k, v in self._sends.items() if v[0] > now}
+            return True, 0
+
+    def __len__(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return len(self._entries)
+
+
+class LocalOTPStore(OTPStore):
+    """
+    Host-local store shared by every gunicorn worker: a SQLite file on tmpfs (/dev/shm), so it
+    lives in shared memory and needs no extra server process. Each check-and-consume runs in one
+    write transaction, which SQLite serializes across processes.
+    """
+
+    def __init__(self, namespace="otp", ttl=OTP_EXPIRY_SECONDS, path=LOCAL_PATH, **kwargs):
+        super().__init__(namespace, ttl, **kwargs)
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS otps (key TEXT PRIMARY KEY, otp TEXT, expires_at REAL, attempts INTEGER DEFAULT 0)")
+            conn.execute("CREATE INDEX IF NOT EXISTS otps_expires_at ON otps (expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS otp_sends (key TEXT PRIMARY KEY, window_end REAL, count INTEGER)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # Codes are disposable; skip fsync
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def put(self, email, otp):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM otps WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM otp_sends WHERE window_end <= ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO otps (key, otp, expires_at, attempts) VALUES (?, ?, ?, 0)", (self._key(email), str(otp), now + self.ttl))
+        return otp
+
+    def consume(self, email, otp_value):
+        key, now = self._key(email), time.time()
+        with self._conn() as conn:
+            row = conn.execute("SELECT otp, expires_at, attempts FROM otps WHERE key = ?", (key,)).fetchone()
+            if not row: return False, "No OTP found."
+            otp, expires_at, attempts = row
+            if expires_at <= now:
+                conn.execute("DELETE FROM otps WHERE key = ?", (key,))
+                return False, "OTP expired."
+            if otp != str(otp_value).strip():
+                if attempts + 1 >= MAX_VERIFY_ATTEMPTS: conn.execute("DELETE FROM otps WHERE key = ?", (key,))
+                else: conn.execute("UPDATE otps SET attempts = attempts + 1 WHERE key = ?", (key,))
+                return False, "Invalid OTP."
+            conn.execute("DELETE FROM otps WHERE key = ?", (key,))
+            return True, "OTP valid."
+
+    def pending(self, email):
+        with self._conn() as conn:
+            row = conn.execute("SELECT 1 FROM otps WHERE key = ? AND expires_at > ?", (self._key(email), time.time())).fetchone()
+        return row is not None
+
+    def allow_send(self, email):
+        key, now = self._key(email), time.time()
+        with self._conn() as conn:
+            row = conn.execute("SELECT window_end, count FROM otp_sends WHERE key = ?", (key,)).fetchone()
+            window_end, count = row if row and row[0] > now else (now + self.send_window, 0)
+            if count >= self.send_limit: return False, int(window_end - now) + 1
+            conn.execute("INSERT OR REPLACE INTO otp_sends (key, window_end, count) VALUES (?, ?, ?)", (key, window_end, count + 1))
+        return True, 0
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a SQLite connection (takes the write lock up front)."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class MongoOTPStore(OTPStore):
+    """
+    Store shared across hosts. Codes live in `otps` and send counters in `otp_sends`, both
+    reaped by TTL indexes on expire_at (see database.INDEXES). Consumption is a single
+    find_one_and_delete matching the code, so it is atomic on the server.
+    """
+
+    def __init__(self, db, namespace="otp", ttl=OTP_EXPIRY_SECONDS, **kwargs):
+        super().__init__(namespace, ttl, **kwargs)
+        self.codes = db.otps
+        self.sends = db.otp_sends
+
+    def put(self, email, otp):
+        now = datetime.now(timezone.utc)
+        self.codes.replace_one(
+            {"_id": self._key(email)},
+            {"otp": str(otp), "expire_at": datetime.fromtimestamp(now.timestamp() + self.ttl, timezone.utc), "attempts": 0},
+            upsert=True
+        )
+        return otp
+
+    def consume(self, email, otp_value):
+        key, now = self._key(email), datetime.now(timezone.utc)
+        if self.codes.find_one_and_delete({"_id": key, "otp": str(otp_value).strip(), "expire_at": {"$gt": now}}, projection={"_id": 1}):
+            return True, "OTP valid."
+        # Wrong or expired: count the attempt, and burn the code once it hits the limit.
+        doc = self.codes.find_one_and_update({"_id": key}, {"$inc": {"attempts": 1}}, projection={"expire_at": 1, "attempts": 1}, return_document=ReturnDocument.AFTER)
+        if not doc: return False, "No OTP found."
+        expired = doc["expire_at"].replace(tzinfo=timezone.utc) <= now
+        if expired or doc["attempts"] >= MAX_VERIFY_ATTEMPTS: self.codes.delete_one({"_id": key})
+        return (False, "OTP expired.") if expired else (False, "Invalid OTP.")
+
+    def pending(self, email):
+        return self.codes.find_one({"_id": self._key(email), "expire_at": {"$gt": datetime.now(timezone.utc)}}, {"_id": 1}) is not None
+
+    def allow_send(self, email):
+        key, now = self._key(email), datetime.now(timezone.utc)
+        window_end = datetime.fromtimestamp(now.timestamp() + self.send_window, timezone.utc)
+        # Drop an expired window the TTL monitor hasn't reaped yet, then count this send with one
+        # atomic upsert: concurrent requests all land on the same counter, so a burst can't slip past.
+        self.sends.delete_one({"_id": key, "expire_at": {"$lte": now}})
+        try:
+            doc = self.sends.find_one_and_update(
+                {"_id": key},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expire_at": window_end}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return self.allow_send(email)  # Lost the race creating the window; retry against it
+        if doc["count"] > self.send_limit:
+            return False, int(doc["expire_at"].replace(tzinfo=timezone.utc).timestamp() - now.timestamp()) + 1
+        return True, 0
+
+
+def create_store(namespace, db=None, backend=None):
+    """Builds the configured backend; falls back to memory when Mongo is selected but unavailable."""
+    backend = (backend or BACKEND or ("mongo" if db is not None else "memory")).lower()
+    if backend == "mongo" and db is not None: return MongoOTPStore(db, namespace)
+    if backend == "local": return LocalOTPStore(namespace)
+    if backend == "mongo": print("⚠️ OTP_STORE_BACKEND=mongo but no database; using per-process memory store.")
+    return MemoryOTPStore(namespace)
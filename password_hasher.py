@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+# Cost (log2 rounds) for new hashes. Set per environment: e.g. 4-6 in dev/tests, 12+ in production.
+ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt releases the GIL, so a few native threads hash in parallel while request threads keep
+# running. The pool size caps how much CPU a login burst can take from chat traffic.
+WORKERS = int(os.getenv("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", 64))  # Beyond this, fail fast instead of queueing
+
+
+class HasherBusy(Exception):
+    """Too many hashes queued; the caller should answer 503 rather than wait."""
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched("threading")
+    except ImportError:
+        return False
+
+
+class PasswordHasher:
+    def __init__(self, rounds=ROUNDS, workers=WORKERS, max_pending=MAX_PENDING):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.counters = {"hashed": 0, "checked": 0, "rehash_needed": 0, "rejected_busy": 0}
+
+    def _get_pool(self):
+        # Native threads don't survive fork, so each worker process builds its own pool. Under
+        # gevent, threading is monkey-patched into greenlets, which would run bcrypt on the event
+        # loop; gevent's ThreadPool uses real OS threads and only blocks the calling greenlet.
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    if _gevent_patched():
+                        from gevent.threadpool import ThreadPool
+                        self._pool = ThreadPool(self.workers)
+                    else:
+                        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.counters["rejected_busy"] += 1
+                raise HasherBusy()
+            self._pending += 1
+        try:
+            pool = self._get_pool()
+            if isinstance(pool, ThreadPoolExecutor): return pool.submit(fn, *args).result()
+            return pool.apply(fn, args)
+        finally:
+            with self._lock: self._pending -= 1
+
+    def hash(self, password):
+        self.counters["hashed"] += 1
+        return self._run(bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(self.rounds))
+
+    def check(self, password, hashed):
+        if not password or not hashed: return False
+        if isinstance(hashed, str): hashed = hashed.encode("utf-8")
+        self.counters["checked"] += 1
+        try: return self._run(bcrypt.checkpw, password.encode("utf-8"), hashed)
+        except ValueError: return False  # Not a bcrypt hash
+
+    def needs_rehash(self, hashed):
+        """True when a stored hash uses a different cost than ROUNDS ($2b$<cost>$...)."""
+        if isinstance(hashed, bytes): hashed = hashed.decode("ascii", "ignore")
+        try: cost = int(hashed.split("$")[2])
+        except (IndexError, ValueError): return True
+        if cost != self.rounds: self.counters["rehash_needed"] += 1
+        return cost != self.rounds
+
+    def stats(self):
+        with self._lock:
+            return {"rounds": self.rounds, "workers": self.workers, "pending": self._pending, **self.counters}
+
+
+_hasher = PasswordHasher()
+
+def hash_password(password): return _hasher.hash(password)
+def check_password(password, hashed): return _hasher.check(password, hashed)
+def needs_rehash(hashed): return _hasher.needs_rehash(hashed)
+def stats(): return _hasher.stats()
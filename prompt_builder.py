@@ -0,0 +1,62 @@
+import os
+import re
+
+# Default input-token budget (system prompt + history + current prompt). Callers pass the budget
+# for the model they use; main.py defines one next to each model constant.
+DEFAULT_BUDGET = int(os.getenv("PROMPT_BUDGET_TOKENS", 8000))
+FILE_BLOCK_MAX_TOKENS = int(os.getenv("FILE_BLOCK_MAX_TOKENS", 3000))
+# The current prompt may use at most this share of the budget; history gets the rest.
+PROMPT_SHARE = 0.6
+
+# Rough BPE approximation: words split into pieces of up to 4 chars, each punctuation mark on its own
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+_FILE_BLOCK_RE = re.compile(r"(--- FILE CONTENT: [^\n]*---\n)(.*?)(\n--- END OF FILE ---)", re.DOTALL)
+
+
+def estimate_tokens(text):
+    """Fast local token estimate (within ~10-15% of real tokenizers on English prose and code)."""
+    if not text: return 0
+    return len(_TOKEN_RE.findall(text)) + 4  # + per-message overhead
+
+def truncate_text(text, max_tokens):
+    """Cuts `text` after roughly `max_tokens` tokens. Only scans as far as the cut point."""
+    if not text or len(text) <= max_tokens: return text
+    for i, match in enumerate(_TOKEN_RE.finditer(text)):
+        if i == max_tokens:
+            return text[:match.start()] + "\n[... truncated ...]"
+    return text
+
+def truncate_file_blocks(text, max_tokens=FILE_BLOCK_MAX_TOKENS):
+    """Shortens each '--- FILE CONTENT ---' block (see process_file_upload) to at most `max_tokens`."""
+    if not text or "--- FILE CONTENT:" not in text: return text
+    return _FILE_BLOCK_RE.sub(lambda m: m.group(1) + truncate_text(m.group(2), max_tokens) + m.group(3), text)
+
+def message_tokens(message):
+    """Uses the estimate stored with the chat document when present."""
+    cached = message.get("tokens")
+    return cached if cached is not None else estimate_tokens(message.get("message", ""))
+
+def build_messages(system_prompt, history, prompt, budget, role_of, max_messages=None):
+    """
+    Assembles [system, *history, user] so the estimated size stays within `budget` input tokens.
+    History is filled newest-first; oversized file blocks are cut down before anything is dropped.
+    `role_of(message)` maps a stored message to 'assistant' or 'user'.
+    """
+    prompt = truncate_text(truncate_file_blocks(prompt), int(budget * PROMPT_SHARE))
+    remaining = budget - estimate_tokens(system_prompt) - estimate_tokens(prompt)
+
+    recent = history[-max_messages:] if max_messages else history
+    picked = []
+    for m in reversed(recent):
+        content = m.get("message", "")
+        if not content: continue
+        tokens = message_tokens(m)
+        if tokens > FILE_BLOCK_MAX_TOKENS and "--- FILE CONTENT:" in content:
+            content = truncate_file_blocks(content)
+            tokens = estimate_tokens(content)
+        if tokens > remaining: break
+        remaining -= tokens
+        picked.append({"role": role_of(m), "content": content})
+    picked.reverse()
+
+    return [{"role": "system", "content": system_prompt}] + picked + [{"role": "user", "content": prompt}]
@@ -0,0 +1,161 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Opt-in: nothing is cached unless RESPONSE_CACHE_ENABLED is set.
+ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_SIZE", 5000))
+TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 6 * 3600))
+HISTORY_DEPTH = int(os.getenv("RESPONSE_CACHE_HISTORY_DEPTH", 2))
+SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.75))
+MAX_PROMPT_CHARS = 500        # Longer prompts are never cached
+MAX_SIMILAR_PROMPT_CHARS = 120  # Fuzzy matching is only for short, chatty prompts
+BUCKET_SIZE = 64
+
+# Per-companion mode: "similar" (exact + n-gram tier), "exact", or "off"
+COMPANION_MODES = {
+    "luvisa": "similar",
+    "victor": "similar",
+    "coach": "exact",
+    "coder": "exact",
+}
+
+_REPEAT_RE = re.compile(r"(.)\1{2,}")
+_NON_WORD_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    """'Hiii!!  Good  Night 😴' -> 'hii good night'"""
+    text = _NON_WORD_RE.sub(" ", (text or "").lower())
+    text = _REPEAT_RE.sub(r"\1\1", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+def _shingles(text, n=3):
+    padded = f" {text} "
+    return frozenset(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+
+def _jaccard(a, b):
+    if not a or not b: return 0.0
+    return len(a & b) / len(a | b)
+
+def _history_fingerprint(history, canon):
+    """Hash of the last few messages before the current prompt."""
+    recent = list(history or [])
+    tail = recent[-HISTORY_DEPTH:] if HISTORY_DEPTH else []
+    joined = "\x1f".join(f"{m.get('sender')}:{canon(m.get('message', ''))}" for m in tail)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # exact key -> entry dict
+        self._buckets = {}             # bucket key -> [exact keys]
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "tokens_saved": 0}
+
+    def _keys(self, mode, companion_id, prompt, history, scope):
+        # "exact" companions (e.g. coder) match on the raw text; case and punctuation matter in code
+        canon = normalize_prompt if mode == "similar" else (lambda text: (text or "").strip())
+        normalized = canon(prompt)
+        bucket = f"{companion_id}|{scope}|{_history_fingerprint(history, canon)}"
+        return normalized, bucket, f"{bucket}|{normalized}"
+
+    def _mode(self, companion_id, prompt):
+        if not ENABLED or not prompt or len(prompt) > MAX_PROMPT_CHARS: return "off"
+        return COMPANION_MODES.get(companion_id, "exact")
+
+    def lookup(self, companion_id, prompt, history, scope=""):
+        """Returns a cached reply or None. `scope` must identify the user (and any per-user context such as the memory summary) so replies never cross users."""
+        mode = self._mode(companion_id, prompt)
+        with self._lock:
+            if mode == "off":
+                self.counters["bypassed"] += 1
+                return None
+            normalized, bucket, key = self._keys(mode, companion_id, prompt, history, scope)
+            now = time.monotonic()
+
+            entry = self._live(key, now)
+            if entry:
+                self.counters["exact_hits"] += 1
+                self.counters["tokens_saved"] += entry["tokens"]
+                return entry["reply"]
+
+            if mode == "similar" and len(normalized) <= MAX_SIMILAR_PROMPT_CHARS:
+                grams = _shingles(normalized)
+                best, best_score = None, SIMILARITY_THRESHOLD
+                for other_key in list(self._buckets.get(bucket, [])):
+                    other = self._live(other_key, now)
+                    if not other: continue
+                    score = _jaccard(grams, other["shingles"])
+                    if score >= best_score: best, best_score = other, score
+                if best:
+                    self.counters["similar_hits"] += 1
+                    self.counters["tokens_saved"] += best["tokens"]
+                    return best["reply"]
+
+            self.counters["misses"] += 1
+            return None
+
+    def store(self, companion_id, prompt, history, reply, tokens=None, scope=""):
+        mode = self._mode(companion_id, prompt)
+        if mode == "off" or not reply or reply.startswith("⚠️"): return
+        normalized, bucket, key = self._keys(mode, companion_id, prompt, history, scope)
+        entry = {
+            "reply": reply,
+            "tokens": tokens if tokens is not None else len(reply) // 4,
+            "expires": time.monotonic() + self.ttl,
+            "bucket": bucket,
+            "shingles": _shingles(normalized),
+        }
+        with self._lock:
+            if key in self._entries: self._drop(key)
+            self._entries[key] = entry
+            members = self._buckets.setdefault(bucket, [])
+            members.append(key)
+            if len(members) > BUCKET_SIZE: self._drop(members[0])
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            self.counters["stores"] += 1
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        if entry["expires"] <= now:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if not entry: return
+        members = self._buckets.get(entry["bucket"], [])
+        if key in members: members.remove(key)
+        if not members: self._buckets.pop(entry["bucket"], None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["exact_hits"] + stats["similar_hits"]) / lookups, 3) if lookups else 0.0
+            stats["size"] = len(self._entries)
+            stats["enabled"] = ENABLED
+            return stats
+
+
+_cache = ResponseCache()
+
+def lookup(companion_id, prompt, history, scope=""):
+    return _cache.lookup(companion_id, prompt, history, scope)
+
+def store(companion_id, prompt, history, reply, tokens=None, scope=""):
+    _cache.store(companion_id, prompt, history, reply, tokens, scope)
+
+def stats():
+    return _cache.stats()
@@ -0,0 +1,73 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import database
+import prompt_builder
+
+# Re-summarize after this many new turns; the summary itself is capped to keep prompts small.
+SUMMARY_EVERY = int(os.getenv("SUMMARY_EVERY_MESSAGES", 20))
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_BATCH = 80
+# Summaries are slow LLM calls, so they get their own small pool rather than the shared background
+# queue (where they would hold up batched XP/notification writes). Past SUMMARY_MAX_QUEUED
+# conversations in flight, new ones are skipped; they are picked up again on a later turn.
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", 2))
+SUMMARY_MAX_QUEUED = int(os.getenv("SUMMARY_MAX_QUEUED", 50))
+
+_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+
+_running = set()
+_running_lock = threading.Lock()
+
+SUMMARY_PROMPT = """You maintain the long-term memory of a companion app.
+Merge the EXISTING MEMORY with the NEW MESSAGES into one updated memory about the user.
+Keep durable facts: names, relationships, preferences, goals, ongoing situations, important events, feelings they shared.
+Drop small talk and anything already resolved. Write in third person, plain sentences, at most 150 words.
+
+EXISTING MEMORY:
+{summary}
+
+NEW MESSAGES:
+{messages}"""
+
+
+def summarize_conversation(db, client, model, user_id, companion_id):
+    """Folds messages newer than the stored summary into it. Returns True if a new summary was saved."""
+    doc = database.get_chat_summary(db, user_id, companion_id) or {}
+    messages = database.get_messages_since(db, user_id, companion_id, doc.get("summarized_until"), limit=SUMMARY_BATCH)
+    if not messages: return False
+
+    transcript = "\n".join(f"{m.get('sender')}: {prompt_builder.truncate_file_blocks(m.get('message', ''), 200)}" for m in messages)
+    prompt = SUMMARY_PROMPT.format(summary=doc.get("summary") or "(none yet)", messages=transcript)
+    completion = client.chat.completions.create(model=model, messages=[{"role": "user", "content": prompt}], temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS)
+    summary = (completion.choices[0].message.content or "").strip()
+    if not summary: return False
+
+    # pending counts user turns (see database.touch_chat_summary); only the ones folded in here are consumed
+    consumed = sum(1 for m in messages if m.get("sender") == "user")
+    database.save_chat_summary(db, user_id, companion_id, summary, messages[-1]["timestamp"], consumed)
+    return True
+
+def maybe_schedule(db, client, model, user_id, companion_id, summary_doc):
+    """Starts a background summary once enough turns have piled up. At most one job per conversation at a time."""
+    if not client or not summary_doc or summary_doc.get("pending", 0) < SUMMARY_EVERY: return
+    key = (str(user_id), database._summary_companion(companion_id))
+    with _running_lock:
+        if key in _running or len(_running) >= SUMMARY_MAX_QUEUED: return
+        _running.add(key)
+
+    def run():
+        try:
+            summarize_conversation(db, client, model, user_id, companion_id)
+        except Exception as e:
+            print(f"🔥 Summary error for {key}: {e}")
+        finally:
+            with _running_lock: _running.discard(key)
+
+    _executor.submit(run)
+
+def memory_block(summary_doc, user_name):
+    """System-prompt section with the rolling summary, or '' when there is none yet."""
+    summary = (summary_doc or {}).get("summary")
+    if not summary: return ""
+    return f"\n**What you remember about {user_name} from earlier chats:**\n{prompt_builder.truncate_text(summary, SUMMARY_MAX_TOKENS)}\n"
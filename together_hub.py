@@ -0,0 +1,143 @@
+import os
+import time
+import queue
+import threading
+from pymongo.errors import OperationFailure, PyMongoError
+import database
+
+# How new Together messages reach SSE subscribers in other gunicorn workers:
+#   "changestream" - tail a MongoDB change stream (needs a replica set / Atlas)
+#   "poll"         - one $slice read per watched space per POLL_SECONDS, shared by all local subscribers
+#   "local"        - in-process only (single worker)
+#   "auto"         - change stream, falling back to poll
+ADAPTER = os.getenv("TOGETHER_PUSH_ADAPTER", "auto")
+POLL_SECONDS = float(os.getenv("TOGETHER_POLL_SECONDS", 1))
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class TogetherHub:
+    """
+    In-process fan-out of Together Space events to SSE subscribers.
+    Events are ("message", seq, payload) or ("state", None, {"ai_active": bool}).
+    seq is the message's index in the space's history array, so duplicates from
+    several sources (local publish + adapter) are dropped by comparing seqs.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # space_id -> set(queue.Queue)
+        self._last_seq = {}     # space_id -> highest seq published
+        self._lock = threading.Lock()
+        self._tailer = None
+
+    def subscribe(self, space_id, db=None):
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(space_id, set()).add(q)
+        if db is not None: self._ensure_tailer(db)
+        return q
+
+    def unsubscribe(self, space_id, q):
+        with self._lock:
+            subs = self._subscribers.get(space_id)
+            if not subs: return
+            subs.discard(q)
+            if not subs:
+                self._subscribers.pop(space_id, None)
+                self._last_seq.pop(space_id, None)
+
+    def mark_seen(self, space_id, seq):
+        """
+        Starts a newly watched space's cursor at the backlog its first subscriber read from the DB,
+        so the poller doesn't replay it. Spaces already being tailed keep their cursor; later
+        subscribers dedupe the overlap themselves.
+        """
+        with self._lock:
+            if space_id in self._subscribers and space_id not in self._last_seq:
+                self._last_seq[space_id] = seq
+
+    def watched_spaces(self):
+        with self._lock:
+            return {space_id: self._last_seq.get(space_id, -1) for space_id in self._subscribers}
+
+    def publish(self, space_id, seq, payload):
+        with self._lock:
+            if seq <= self._last_seq.get(space_id, -1) or space_id not in self._subscribers: return
+            self._last_seq[space_id] = seq
+            targets = list(self._subscribers[space_id])
+        self._deliver(targets, ("message", seq, payload))
+
+    def publish_state(self, space_id, ai_active):
+        with self._lock:
+            targets = list(self._subscribers.get(space_id, ()))
+        self._deliver(targets, ("state", None, {"ai_active": ai_active}))
+
+    def _deliver(self, targets, event):
+        for q in targets:
+            try: q.put_nowait(event)
+            except queue.Full: pass  # slow client; it resyncs from the DB on reconnect
+
+    def _ensure_tailer(self, db):
+        if self._tailer is not None or ADAPTER == "local": return
+        with self._lock:
+            if self._tailer is not None: return
+            self._tailer = threading.Thread(target=self._tail, args=(db,), name="together-tailer", daemon=True)
+            self._tailer.start()
+
+    def _tail(self, db):
+        if ADAPTER in ("auto", "changestream"):
+            try:
+                self._tail_change_stream(db)
+                return
+            except OperationFailure as e:
+                print(f"⚠️ Together change stream unavailable ({e}); polling instead.")
+        self._tail_polling(db)
+
+    def _tail_change_stream(self, db):
+        pipeline = [{"$match": {"operationType": "update"}}]
+        while True:
+            try:
+                with db.together_spaces.watch(pipeline) as stream:
+                    for change in stream:
+                        self._apply_change(change)
+            except OperationFailure:
+                raise
+            except PyMongoError as e:
+                print(f"⚠️ Together change stream error: {e}; reconnecting.")
+                time.sleep(1)
+
+    def _apply_change(self, change):
+        space_id = str(change["documentKey"]["_id"])
+        with self._lock:
+            if space_id not in self._subscribers: return
+        fields = change.get("updateDescription", {}).get("updatedFields", {})
+        for key, value in fields.items():
+            if key.startswith("history."):
+                self.publish(space_id, int(key.split(".")[1]), format_message(value))
+            elif key == "history":
+                for seq, msg in enumerate(value): self.publish(space_id, seq, format_message(msg))
+            elif key == "ai_active":
+                self.publish_state(space_id, value)
+
+    def _tail_polling(self, db):
+        while True:
+            time.sleep(POLL_SECONDS)
+            for space_id, last_seq in self.watched_spaces().items():
+                try: space = database.get_together_messages(db, space_id, since=last_seq)
+                except PyMongoError as e:
+                    print(f"⚠️ Together poll error: {e}")
+                    continue
+                if not space: continue
+                for offset, msg in enumerate(space.get("history", [])):
+                    self.publish(space_id, last_seq + 1 + offset, format_message(msg))
+
+
+def format_message(r):
+    return {
+        "sender": r["sender"],
+        "sender_name": r.get("sender_name", "Luvisa 💗" if r["sender"] == "luvisa" else "User"),
+        "message": r["message"],
+        "time": r.get("timestamp").strftime("%Y-%m-%d %H:%M:%S") if r.get("timestamp") else ""
+    }
+
+
+hub = TogetherHub()
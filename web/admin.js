@@ -1,7 +1,7 @@
 document.addEventListener('DOMContentLoaded', () => {
     // ... [Keep existing Auth logic] ...
     // --- AUTHENTICATION CHECK ---
-    const savedPassword = sessionStorage.getItem('admin_session_key');
+    const savedToken = sessionStorage.getItem('admin_token');
     const savedEmail = sessionStorage.getItem('admin_email');
 
     const overlay = document.getElementById('adminLoginOverlay');
@@ -9,7 +9,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const loginBtn = document.getElementById('adminLoginBtn');
     const errorText = document.getElementById('adminLoginError');
 
-    if (savedPassword && savedEmail) {
+    if (savedToken && savedEmail) {
         overlay.style.display = 'none';
         loadAdminData();
     } else {
@@ -39,7 +39,9 @@ document.addEventListener('DOMContentLoaded', () => {
             });
 
             if (res.ok) {
-                sessionStorage.setItem('admin_session_key', passVal);
+                // The password is only sent once; later calls carry the signed session token.
+                const data = await res.json();
+                sessionStorage.setItem('admin_token', data.token);
                 sessionStorage.setItem('admin_email', emailVal);
                 overlay.style.display = 'none';
                 loadAdminData();
@@ -90,7 +92,8 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     // ... [Rest of your listeners remain the same] ...
-    document.getElementById('logoutBtn').addEventListener('click', () => {
+    document.getElementById('logoutBtn').addEventListener('click', async () => {
+        try { await fetch('/api/admin/logout', { method: 'POST', headers: getHeaders() }); } catch (e) { /* logging out anyway */ }
         sessionStorage.clear();
         window.location.reload();
     });
@@ -110,7 +113,7 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     document.getElementById('saveUserBtn').addEventListener('click', saveUserStats);
-    document.getElementById('msgSearchBtn').addEventListener('click', searchMessages);
+    document.getElementById('msgSearchBtn').addEventListener('click', () => searchMessages(1));
     document.getElementById('refreshLogsBtn')?.addEventListener('click', fetchLogs);
     document.getElementById('refreshModBtn')?.addEventListener('click', fetchModeration);
     document.getElementById('refreshFeedbackBtn')?.addEventListener('click', fetchFeedback);
@@ -141,16 +144,29 @@ document.addEventListener('DOMContentLoaded', () => {
     document.getElementById('exportUsersBtn').addEventListener('click', exportUsersCSV);
 
     setInterval(fetchHealth, 5000);
+    setInterval(refreshSession, 10 * 60 * 1000); // Tokens live 30 minutes
 });
 
 // ... [Keep the rest of the API logic from previous admin.js - no changes needed below this point] ...
 function getHeaders() {
     return {
         'Content-Type': 'application/json',
-        'x-admin-password': sessionStorage.getItem('admin_session_key')
+        'x-admin-token': sessionStorage.getItem('admin_token')
     };
 }
 
+async function refreshSession() {
+    if (!sessionStorage.getItem('admin_token')) return;
+    try {
+        const res = await fetch('/api/admin/session/refresh', { method: 'POST', headers: getHeaders() });
+        if (res.status === 401) return handleAuthFail();
+        const data = await res.json();
+        if (data.success) sessionStorage.setItem('admin_token', data.token);
+    } catch (e) {
+        console.warn('Session refresh failed:', e);
+    }
+}
+
 function getEmailParam() {
     return `admin_email=${encodeURIComponent(sessionStorage.getItem('admin_email'))}`;
 }
@@ -208,7 +224,7 @@ async function fetchHealth() {
 let growthChartInstance = null;
 async function fetchGrowthChart() {
     try {
-        const res = await fetch(`/api/admin/analytics/growth?${getEmailParam()}`, { headers: getHeaders() });
+        const res = await fetch(`/api/admin/analytics/growth?days=30&${getEmailParam()}`, { headers: getHeaders() });
         const data = await res.json();
         if (data.success) renderChart(data.chartData);
     } catch (e) { }
@@ -331,20 +347,24 @@ async function fetchLogs() {
     } catch (e) { tbody.innerHTML = '<tr><td colspan="4">Error loading logs.</td></tr>'; }
 }
 
-async function searchMessages() {
+let msgSearchPage = 1;
+async function searchMessages(page = 1) {
     const query = document.getElementById('msgSearchInput').value.trim();
     if (!query) return;
 
     const tbody = document.getElementById('messagesTableBody');
-    tbody.innerHTML = '<tr><td colspan="4">Searching...</td></tr>';
+    const moreRow = document.getElementById('msgSearchMore');
+    if (moreRow) moreRow.remove();
+    if (page === 1) tbody.innerHTML = '<tr><td colspan="4">Searching...</td></tr>';
 
     try {
-        const res = await fetch(`/api/admin/messages/search?query=${encodeURIComponent(query)}&${getEmailParam()}`, { headers: getHeaders() });
+        const res = await fetch(`/api/admin/messages/search?query=${encodeURIComponent(query)}&page=${page}&${getEmailParam()}`, { headers: getHeaders() });
         const data = await res.json();
 
         if (data.success) {
-            tbody.innerHTML = '';
-            if (data.messages.length === 0) {
+            msgSearchPage = page;
+            if (page === 1) tbody.innerHTML = '';
+            if (page === 1 && data.messages.length === 0) {
                 tbody.innerHTML = '<tr><td colspan="4">No messages found matching query.</td></tr>';
                 return;
             }
@@ -356,6 +376,9 @@ async function searchMessages() {
                         <td>${m.message}</td>
                     </tr>`;
             });
+            if (data.has_more) {
+                tbody.innerHTML += `<tr id="msgSearchMore"><td colspan="4"><button class="primary-btn" onclick="searchMessages(${msgSearchPage + 1})">Load more</button></td></tr>`;
+            }
         }
     } catch (e) { tbody.innerHTML = '<tr><td colspan="4">Error searching.</td></tr>'; }
 }
@@ -529,7 +552,7 @@ async function toggleMaintenance(e) {
 async function exportUsersCSV() {
     try {
         const res = await fetch(`/api/admin/export/users?${getEmailParam()}`, {
-            headers: { 'x-admin-password': sessionStorage.getItem('admin_session_key') }
+            headers: { 'x-admin-token': sessionStorage.getItem('admin_token') }
         });
 
         if (res.status === 401) return handleAuthFail();
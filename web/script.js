@@ -687,29 +687,82 @@ async function loadAndApplyProfile(user) {
     } catch (err) { console.error('Load profile network error:', err); }
 }
 
+// /api/chat_history returns the newest page; older pages are fetched on demand via next_cursor.
+let olderHistory = { user: null, companion: null, cursor: null, anchor: null };
+
+function historyMessageType(m) {
+    if (m.sender === 'user') return 'user';
+    if (m.sender === 'coder' || m.sender === 'coach') return m.sender;
+    return 'luvisa';
+}
+
+async function fetchHistoryPage(user, companion, cursor = null) {
+    let url = `/api/chat_history?email=${encodeURIComponent(user)}&companion=${companion}`;
+    if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+    const response = await fetch(url);
+    const data = await response.json();
+    if (!response.ok || !data.success) throw new Error(data.message || 'Failed to load history');
+    return data;
+}
+
+function renderLoadOlderButton() {
+    let btn = document.getElementById('loadOlderBtn');
+    if (!olderHistory.cursor) { if (btn) btn.remove(); return; }
+    if (!btn) {
+        btn = document.createElement('button');
+        btn.id = 'loadOlderBtn';
+        btn.className = 'load-older-btn';
+        btn.textContent = 'Load older messages';
+        btn.addEventListener('click', loadOlderHistory);
+        chatbox.prepend(btn);
+    }
+    btn.disabled = false;
+}
+
+async function loadOlderHistory() {
+    const btn = document.getElementById('loadOlderBtn');
+    if (!olderHistory.cursor || !btn) return;
+    btn.disabled = true;
+    const { user, companion } = olderHistory;
+    try {
+        const data = await fetchHistoryPage(user, companion, olderHistory.cursor);
+        if (olderHistory.user !== user || olderHistory.companion !== companion) return; // Switched chats meanwhile
+        const previousHeight = chatbox.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        const nodes = data.history.map(m => buildMessage(historyMessageType(m), m.message, m.time));
+        nodes.forEach(node => fragment.appendChild(node));
+        chatbox.insertBefore(fragment, olderHistory.anchor);
+        if (nodes.length) olderHistory.anchor = nodes[0];
+        // Keep the messages the user was looking at in place
+        chatbox.scrollTop += chatbox.scrollHeight - previousHeight;
+        olderHistory.cursor = data.next_cursor;
+    } catch (err) { console.error('Load older history error:', err); }
+    renderLoadOlderButton();
+}
+
 async function loadChatHistory(user, companion = 'luvisa') {
     try {
-        const response = await fetch(`/api/chat_history?email=${encodeURIComponent(user)}&companion=${companion}`);
-        const data = await response.json();
-        if (response.ok && data.success) {
-            chatbox.innerHTML = '';
-            let welcome = "I'm Luvisa, Your partner for intelligent conversation.";
-            if (companion === 'coder') welcome = "I am Deo, an elite coding intelligence. I'm here to build, debug, and optimize software.";
-            if (companion === 'coach') welcome = "I am your partner in clarity. When life gets loud, I help you find the quiet you need to reconnect with your purpose, prioritize your peace, and build a roadmap to the future you deserve.";
-            appendMessage(companion, welcome, null);
-            data.history.forEach(m => {
-                let type = 'user';
-                if (m.sender === 'luvisa') type = 'luvisa';
-                if (m.sender === 'coder') type = 'coder';
-                if (m.sender === 'coach') type = 'coach';
-                appendMessage(m.sender === 'user' ? 'user' : type, m.message, m.time);
-            });
-            scrollToBottom();
-        } else { console.error('Failed load history:', data.message); }
-    } catch (err) { console.error('Load history network error:', err); }
+        const data = await fetchHistoryPage(user, companion);
+        chatbox.innerHTML = '';
+        let welcome = "I'm Luvisa, Your partner for intelligent conversation.";
+        if (companion === 'coder') welcome = "I am Deo, an elite coding intelligence. I'm here to build, debug, and optimize software.";
+        if (companion === 'coach') welcome = "I am your partner in clarity. When life gets loud, I help you find the quiet you need to reconnect with your purpose, prioritize your peace, and build a roadmap to the future you deserve.";
+        appendMessage(companion, welcome, null);
+        const rendered = data.history.map(m => appendMessage(historyMessageType(m), m.message, m.time));
+        olderHistory = { user, companion, cursor: data.next_cursor, anchor: rendered[0] || null };
+        renderLoadOlderButton();
+        scrollToBottom();
+    } catch (err) { console.error('Load history error:', err); }
 }
 
 function appendMessage(type, text, atTime = null, files = []) {
+    const wrapper = buildMessage(type, text, atTime, files);
+    chatbox.appendChild(wrapper);
+    scrollToBottom();
+    return wrapper;
+}
+
+function buildMessage(type, text, atTime = null, files = []) {
     const wrapper = document.createElement('div');
     let styleClass = (type === 'user') ? 'user-message' : 'luvisa-message';
     wrapper.className = `message ${styleClass}`;
@@ -756,8 +809,6 @@ function appendMessage(type, text, atTime = null, files = []) {
     timeDiv.textContent = formatTime(atTime);
     wrapper.appendChild(bubble);
     wrapper.appendChild(timeDiv);
-    chatbox.appendChild(wrapper);
-    scrollToBottom();
     return wrapper;
 }
 
@@ -803,22 +854,71 @@ async function sendMessage() {
     const formData = new FormData();
     formData.append('email', username);
     formData.append('text', text);
+    formData.append('stream', 'true');
     selectedFiles.forEach(file => { formData.append('files', file); });
     selectedFiles = [];
     updateFilePreview();
 
     try {
         const response = await fetch(endpoint, { method: 'POST', body: formData });
-        const data = await response.json();
-        if (typing?.parentNode) typing.parentNode.removeChild(typing);
-
-        if (response.ok && data.success) {
-            appendMessage(currentCompanion, data.reply);
-        } else {
-            appendMessage(currentCompanion, data.message || "Sorry... Error.");
+        const isStream = (response.headers.get('Content-Type') || '').includes('text/event-stream');
+        if (!isStream) {
+            const data = await response.json();
+            if (typing?.parentNode) typing.parentNode.removeChild(typing);
+            if (response.ok && data.success) {
+                appendMessage(currentCompanion, data.reply);
+            } else {
+                appendMessage(currentCompanion, data.message || "Sorry... Error.");
+            }
+            return;
         }
+        await readReplyStream(response, typing);
     } catch (err) {
         if (typing?.parentNode) typing.parentNode.removeChild(typing);
         appendMessage(currentCompanion, "Connection trouble.");
     }
+}
+
+// Renders SSE 'token' events into a live bubble, then swaps in the final reply from 'done'
+async function readReplyStream(response, typing) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let partial = '';
+    let liveText = null;
+
+    const handleEvent = (event, data) => {
+        if (event === 'token') {
+            if (!liveText) {
+                if (typing?.parentNode) typing.parentNode.removeChild(typing);
+                const wrapper = appendMessage(currentCompanion, ' ');
+                liveText = wrapper.querySelector('.message-text');
+            }
+            partial += data.text;
+            liveText.textContent = partial;
+            scrollToBottom();
+        } else if (event === 'done') {
+            if (liveText) liveText.closest('.message').remove();
+            if (typing?.parentNode) typing.parentNode.removeChild(typing);
+            appendMessage(currentCompanion, data.success ? data.reply : (data.message || "Sorry... Error."));
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            let event = 'message';
+            let payload = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) payload += line.slice(6);
+            });
+            if (payload) handleEvent(event, JSON.parse(payload));
+        }
+    }
 }
\ No newline at end of file
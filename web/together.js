@@ -21,8 +21,10 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentSpaceId = null;
     let spaceExpiryTime = null;
     let historyPollInterval = null;
+    let historyStream = null;
+    let lastSeq = -1;
     let timerInterval = null;
-    let lastMessageCount = 0;
+    let pendingEchoes = []; // Optimistic bubbles waiting for the server's copy
 
     const displayName = localStorage.getItem('luvisa_display_name') || 'A user';
 
@@ -123,8 +125,11 @@ document.addEventListener('DOMContentLoaded', () => {
         });
 
         startTimers();
-        loadChatHistory(); // Load history (and AI state)
-        historyPollInterval = setInterval(loadChatHistory, 3000);
+        if (window.EventSource) {
+            openHistoryStream(); // Pushes history, new messages and AI state
+        } else {
+            startHistoryPolling();
+        }
 
         // Background is already set, so no need to call it again here
 
@@ -247,17 +252,50 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function stopSession(message) {
+        if (historyStream) historyStream.close();
         clearInterval(historyPollInterval);
         clearInterval(timerInterval);
         alert(message);
         window.location.href = 'together.html';
     }
 
+    function startHistoryPolling() {
+        loadChatHistory(); // Load history (and AI state)
+        historyPollInterval = setInterval(loadChatHistory, 3000);
+    }
+
+    // Server-Sent Events: the server replays anything after the last seq we saw
+    // (EventSource resends it as Last-Event-ID on reconnect), then pushes live.
+    function openHistoryStream() {
+        historyStream = new EventSource(`/api/together/stream?space_id=${currentSpaceId}`);
+
+        historyStream.addEventListener('state', (e) => {
+            const data = JSON.parse(e.data);
+            if (aiToggleCheckbox) aiToggleCheckbox.checked = data.ai_active;
+        });
+
+        historyStream.addEventListener('message', (e) => {
+            if (renderIncoming(JSON.parse(e.data))) playNotify();
+        });
+
+        historyStream.addEventListener('expired', () => {
+            stopSession('Space expired. Thank you for chatting!');
+        });
+
+        historyStream.onerror = () => {
+            // CLOSED means the browser gave up (e.g. 404 or a proxy without SSE): poll instead.
+            if (historyStream.readyState === EventSource.CLOSED) {
+                historyStream = null;
+                startHistoryPolling();
+            }
+        };
+    }
+
     async function loadChatHistory() {
         if (!currentSpaceId || !chatbox) return;
 
         try {
-            const response = await fetch(`/api/together/history?space_id=${currentSpaceId}`);
+            const response = await fetch(`/api/together/history?space_id=${currentSpaceId}&since=${lastSeq}`);
             if (!response.ok) {
                 if (response.status === 404) {
                     stopSession('This space has expired or was not found.');
@@ -272,31 +310,41 @@ document.addEventListener('DOMContentLoaded', () => {
                 aiToggleCheckbox.checked = data.ai_active;
             }
 
-            if (data.history.length === lastMessageCount) return;
-
-            chatbox.innerHTML = '';
-            data.history.forEach(m => {
-                const isMe = (m.sender === 'user' && m.sender_name === displayName);
-                appendMessage(m.sender, m.message, m.time, m.sender_name, isMe);
-            });
-            chatbox.scrollTop = chatbox.scrollHeight;
-            lastMessageCount = data.history.length;
-
-            if (data.history.length > 0 && data.history[data.history.length - 1].sender === 'luvisa') {
-                if (notifySound) notifySound.play().catch(e => console.warn("Audio err:", e));
-            }
+            let lastIncoming = false;
+            data.history.forEach(m => { lastIncoming = renderIncoming(m); });
+            if (lastIncoming) playNotify();
 
         } catch (err) {
             console.error('History load error:', err);
         }
     }
 
+    // Appends a message from the server once (by seq). Returns true if it was a new Luvisa message.
+    function renderIncoming(m) {
+        if (m.seq <= lastSeq) return false;
+        lastSeq = m.seq;
+        const isMe = (m.sender === 'user' && m.sender_name === displayName);
+        const pending = isMe ? pendingEchoes.findIndex(p => p.text === m.message) : -1;
+        if (pending !== -1) {
+            pendingEchoes.splice(pending, 1)[0].el.remove();
+        }
+        appendMessage(m.sender, m.message, m.time, m.sender_name, isMe);
+        chatbox.scrollTop = chatbox.scrollHeight;
+        return m.sender === 'luvisa';
+    }
+
+    function playNotify() {
+        if (notifySound) notifySound.play().catch(e => console.warn("Audio err:", e));
+    }
+
     async function sendMessage() {
         if (!userInput || !currentSpaceId) return;
         const text = userInput.value.trim();
         if (!text) return;
 
-        appendMessage('user', text, null, displayName, true);
+        // Shown immediately; swapped for the server's copy when it arrives in order.
+        const el = appendMessage('user', text, null, displayName, true);
+        if (el) pendingEchoes.push({ text, el });
 
         userInput.value = '';
 
@@ -317,7 +365,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
-            loadChatHistory();
+            if (!historyStream) loadChatHistory();
 
         } catch (err) {
             appendMessage('luvisa', "Sorry, connection trouble 😥", null, "Luvisa 💗", false);